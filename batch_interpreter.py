@@ -0,0 +1,270 @@
+from __future__ import annotations
+import dataclasses
+import numpy as np
+from ir import *
+
+# Vectorized version of the Interpreter : runs one allocated ir over a whole batch of inputs at once.
+# Every register holds a vector with one value per lane (input), BinOps are applied element-wise, and branches
+# partition the lanes into groups that continue separately. Groups waiting on the same block are merged back
+# together so that loops keep running vectorized.
+# Values are int64, unlike the Interpreter which uses python ints.
+# In superblocks (see superblock.py), the lanes failing a guard leave through its side exit, the others go on with the
+# rest of the block.
+
+@dataclasses.dataclass
+class LaneGroup:
+    block: BasicBlock
+    # Indices of the lanes of the batch this group runs
+    lanes: np.ndarray
+    registers: list[np.ndarray]
+    spilled_local_vals: dict[int, np.ndarray]
+    spilled_tree_vals: dict[int, np.ndarray]
+
+    def select(self, mask: np.ndarray, block: BasicBlock) -> LaneGroup:
+        return LaneGroup(
+            block=block,
+            lanes=self.lanes[mask],
+            registers=[reg[mask] for reg in self.registers],
+            spilled_local_vals={k: v[mask] for k, v in self.spilled_local_vals.items()},
+            spilled_tree_vals={k: v[mask] for k, v in self.spilled_tree_vals.items()},
+        )
+
+    @staticmethod
+    def merge(groups: list[LaneGroup]) -> LaneGroup:
+        if len(groups) == 1:
+            return groups[0]
+
+        def merge_memory(memories: list[dict[int, np.ndarray]]) -> dict[int, np.ndarray]:
+            keys = set()
+            for memory in memories:
+                keys |= memory.keys()
+
+            # Slots one of the groups never wrote hold garbage for its lanes
+            return {
+                k: np.concatenate([memory.get(k, np.zeros(len(g.lanes), dtype=np.int64)) for memory, g in zip(memories, groups)])
+                for k in keys
+            }
+
+        return LaneGroup(
+            block=groups[0].block,
+            lanes=np.concatenate([g.lanes for g in groups]),
+            registers=[np.concatenate(regs) for regs in zip(*(g.registers for g in groups))],
+            spilled_local_vals=merge_memory([g.spilled_local_vals for g in groups]),
+            spilled_tree_vals=merge_memory([g.spilled_tree_vals for g in groups]),
+        )
+
+class BatchInterpreter:
+    ir: Ir
+    num_regs: int
+    # Counters are summed over all the lanes, so that they match the sum of the counters of Interpreter runs
+    spill_count: int
+    restore_count: int
+    move_count: int
+    # Number of times a block was executed for a lane group (not per lane)
+    block_runs: int
+    max_steps: int | None
+    step_count: int
+
+    def __init__(self, num_regs: int, ir: Ir, max_steps: int | None = None) -> None:
+        self.ir = ir
+        self.num_regs = num_regs
+
+        self.spill_count = 0
+        self.restore_count = 0
+        self.move_count = 0
+        self.block_runs = 0
+
+        self.max_steps = max_steps
+        self.step_count = 0
+
+    # Seeds the first locals of every lane with its row of arguments, like Interpreter.enter
+    def enter(self, args: np.ndarray) -> LaneGroup:
+        lane_count = args.shape[0]
+        assert args.shape[1] <= self.ir.local_vars, "too many arguments"
+
+        group = LaneGroup(
+            block=self.ir.blocks.first,
+            lanes=np.arange(lane_count),
+            registers=[np.zeros(lane_count, dtype=np.int64) for _ in range(self.num_regs)],
+            spilled_local_vals={i: np.zeros(lane_count, dtype=np.int64) for i in range(self.ir.local_vars)},
+            spilled_tree_vals=dict(),
+        )
+
+        for i in range(args.shape[1]):
+            group.spilled_local_vals[i] = args[:, i].copy()
+
+        for active_in in self.ir.blocks.first.active_in_set:
+            if active_in.val.of < args.shape[1]:
+                group.registers[active_in.reg] = args[:, active_in.val.of].copy()
+
+        return group
+
+    def jump(self, group: LaneGroup, edge: BlockEdge) -> None:
+        lane_count = len(group.lanes)
+        group.block = edge.target
+
+        # Side exits leave from the middle of the block
+        active_out_set = edge.active_out_set if edge.active_out_set is not None else edge.source.active_out_set
+        active_in_set = edge.target.active_in_set
+
+        new_registers = group.registers[:]
+
+        for active_out in active_out_set:
+            if not any (active_out.val.of == active_in.val.of for active_in in active_in_set):
+                group.spilled_local_vals[active_out.val.of] = group.registers[active_out.reg]
+                self.spill_count += lane_count
+
+        for active_in in active_in_set:
+            if not any(active_out.val.of == active_in.val.of for active_out in active_out_set):
+                new_registers[active_in.reg] = group.spilled_local_vals[active_in.val.of]
+                self.restore_count += lane_count
+
+        for active_out in active_out_set:
+            for active_in in active_in_set:
+                # A value staying in the same register doesn't need a move
+                if active_out.val.of == active_in.val.of and active_out.reg != active_in.reg:
+                    new_registers[active_in.reg] = group.registers[active_out.reg]
+                    self.move_count += lane_count
+
+        group.registers = new_registers
+
+    def spills_restores_moves(self, group: LaneGroup, spills: list[RegSpill], restores: list[RegRestore], moves: list[RegMove]) -> None:
+        lane_count = len(group.lanes)
+        new_registers = group.registers[:]
+
+        for spill in spills:
+            if isinstance(spill.val.of, int):
+                group.spilled_local_vals[spill.val.of] = group.registers[spill.reg]
+            else:
+                group.spilled_tree_vals[spill.val.of.ir_idx] = group.registers[spill.reg]
+            self.spill_count += lane_count
+
+        for restore in restores:
+            if isinstance(restore.val.of, int):
+                new_registers[restore.reg] = group.spilled_local_vals[restore.val.of]
+            else:
+                new_registers[restore.reg] = group.spilled_tree_vals[restore.val.of.ir_idx]
+            self.restore_count += lane_count
+
+        for move in moves:
+            new_registers[move.reg_to] = group.registers[move.reg_from]
+            self.move_count += lane_count
+
+        group.registers = new_registers
+
+    # Runs the block of the group. Returns the groups that continue to other blocks, and fills results for the lanes that returned
+    def run_block(self, group: LaneGroup, results: np.ndarray) -> list[LaneGroup]:
+        self.block_runs += 1
+        next_groups = []
+
+        for tree in group.block.tree_execution_order():
+            self.step_count += 1
+            if self.max_steps is not None and self.step_count > self.max_steps:
+                raise Exception("Step limit exceeded")
+
+            taken_edges = []
+            side_exit = None
+
+            self.spills_restores_moves(group, tree.pre_spills, tree.pre_restores, tree.pre_moves)
+
+            # Registers are never written in place : arrays can be shared between registers and memory
+            match tree.kind:
+                case TreeKind.LdLocal:
+                    # Handled by the reg allocator
+                    pass
+                case TreeKind.StLocal:
+                    # Handled by the reg allocator
+                    pass
+                case TreeKind.Const:
+                    group.registers[tree.reg] = np.full(len(group.lanes), tree.operands[0], dtype=np.int64)
+                case TreeKind.Discard:
+                    # Do nothing
+                    pass
+                case TreeKind.BinOp:
+                    lhs = group.registers[tree.subtrees[0].use_reg]
+                    rhs = group.registers[tree.subtrees[1].use_reg]
+                    if tree.swapped_operands():
+                        lhs, rhs = rhs, lhs
+
+                    match tree.operands[0]:
+                        case Operator.Add:
+                            res = lhs + rhs
+                        case Operator.Sub:
+                            res = lhs - rhs
+                        case Operator.Mul:
+                            res = lhs * rhs
+                        case Operator.Div:
+                            # Lanes dividing by zero get 0 instead of stopping the whole batch
+                            with np.errstate(divide="ignore"):
+                                res = np.floor_divide(lhs, rhs)
+                        case Operator.Eq:
+                            res = (lhs == rhs).astype(np.int64)
+
+                    group.registers[tree.reg] = res
+                case TreeKind.Call:
+                    callee = CALLEES[tree.operands[0]][1]
+                    group.registers[tree.reg] = callee(*[group.registers[subtree.use_reg] for subtree in tree.subtrees])
+                case TreeKind.Ret:
+                    results[group.lanes] = group.registers[tree.subtrees[0].use_reg]
+                    return next_groups
+                case TreeKind.Branch:
+                    taken = group.registers[tree.subtrees[0].use_reg] == 1
+                    taken_edges = [(taken, tree.operands[0]), (~taken, tree.operands[1])]
+                case TreeKind.Jmp:
+                    taken_edges = [(None, tree.operands[0])]
+                case TreeKind.Guard:
+                    leaving = (group.registers[tree.subtrees[0].use_reg] == 1) != (tree.operands[1] == 1)
+                    side_exit = (leaving, tree.operands[0])
+
+            self.spills_restores_moves(group, tree.post_spills, tree.post_restores, tree.post_moves)
+
+            # The lanes failing the guard jump once its post spills, restores and moves are done, like the Interpreter
+            if side_exit is not None:
+                leaving, edge = side_exit
+                if leaving.all():
+                    self.jump(group, edge)
+                    next_groups.append(group)
+                    return next_groups
+                if leaving.any():
+                    exiting = group.select(leaving, group.block)
+                    self.jump(exiting, edge)
+                    next_groups.append(exiting)
+                    group = group.select(~leaving, group.block)
+
+        # Jump once the terminator's post spills, restores and moves are done, partitioning the lanes between the
+        # targets of branches
+        for mask, edge in taken_edges:
+            if mask is None or mask.all():
+                next_group = group
+            elif mask.any():
+                next_group = group.select(mask, group.block)
+            else:
+                continue
+
+            self.jump(next_group, edge)
+            next_groups.append(next_group)
+
+        return next_groups
+
+    # args has one row of arguments per lane. Returns the results of every lane
+    def run(self, args: np.ndarray) -> np.ndarray:
+        args = np.asarray(args, dtype=np.int64)
+        if args.ndim == 1:
+            args = args.reshape(-1, 1)
+
+        results = np.zeros(args.shape[0], dtype=np.int64)
+
+        # Groups waiting to run, by block (id). The block with the lowest il_idx goes first, which usually lets lanes
+        # that left a loop early wait for the others at the exit so they can be merged back together
+        waiting: dict[int, list[LaneGroup]] = {}
+        first = self.enter(args)
+        waiting[id(first.block)] = [first]
+
+        while len(waiting) != 0:
+            block_id = min(waiting, key=lambda block_id: waiting[block_id][0].block.il_idx)
+            group = LaneGroup.merge(waiting.pop(block_id))
+
+            for next_group in self.run_block(group, results):
+                waiting.setdefault(id(next_group.block), []).append(next_group)
+
+        return results
@@ -0,0 +1,419 @@
+from __future__ import annotations
+import argparse
+import dataclasses
+import gc
+import multiprocessing
+import time
+from stack_instruction import *
+from stack_interpreter import StackInterpreter
+from interpreter import Interpreter, CycleCosts, BlockCycles
+from fuzz import ALLOCATORS, EXPERIMENTAL_ALLOCATORS, UNCONSTRAINED_ALLOCATORS, TWO_ADDRESS_ALLOCATORS, allocate
+from rlsra import Rlsra, RecordPool
+from lsra import Lsra
+from corpus import *
+from spill_strategy import SPILL_STRATEGIES, FurthestUse
+from peephole import peephole as run_peephole
+from layout import layout, LayoutStats
+from resolution import resolve_edges, ResolutionStats
+
+# Allocates every program of the benchmark corpus with every allocator, runs it with the Interpreter and compares the
+# dynamic spill / restore / move counts. The moves are counted for a three-address target, and for a two-address target
+# (the copies of the left operands of BinOps that aren't written over it, see TWO_ADDRESS_ALLOCATORS)
+
+# Relative cost of the operations : spills and restores go through memory, moves don't
+@dataclasses.dataclass
+class CostWeights:
+    spill: float = 2.0
+    restore: float = 2.0
+    move: float = 1.0
+
+@dataclasses.dataclass
+class BenchResult:
+    spills: int = 0
+    restores: int = 0
+    moves: int = 0
+    # Time spent in the allocator (compile time)
+    alloc_seconds: float = 0.0
+    two_address_moves: int = 0
+    # Simulated run time, when measured with CycleCosts
+    cycles: int = 0
+
+    def __add__(self, other: BenchResult) -> BenchResult:
+        return BenchResult(
+            self.spills + other.spills,
+            self.restores + other.restores,
+            self.moves + other.moves,
+            self.alloc_seconds + other.alloc_seconds,
+            self.two_address_moves + other.two_address_moves,
+            self.cycles + other.cycles
+        )
+
+    def cost(self, weights: CostWeights) -> float:
+        return self.spills * weights.spill + self.restores * weights.restore + self.moves * weights.move
+
+# calls : allocate and run with the default calling convention (see CallingConvention)
+# peephole : run the peephole pass after the allocator, its time is counted in the allocation time
+# costs : also count the cycles of the run
+def measure(program: BenchmarkProgram, allocator: str, num_regs: int, spill_strategy: str = FurthestUse.name, calls: bool = False, peephole: bool = False, costs: CycleCosts | None = None) -> BenchResult:
+    ir, alloc_seconds = allocate_program(program, allocator, num_regs, spill_strategy, calls, peephole)
+    interpreter = run_program(program, ir, allocator, num_regs, spill_strategy, calls, costs)
+    return BenchResult(interpreter.spill_count, interpreter.restore_count, interpreter.move_count, alloc_seconds, interpreter.move_count + interpreter.tied_copy_count, interpreter.cycles())
+
+# Returns the allocated ir and the allocation time
+def allocate_program(program: BenchmarkProgram, allocator: str, num_regs: int, spill_strategy: str = FurthestUse.name, calls: bool = False, peephole: bool = False) -> tuple[Ir, float]:
+    convention = CallingConvention.default(num_regs) if calls and allocator not in UNCONSTRAINED_ALLOCATORS else None
+    ir = import_to_ir(program.fn)
+    # Collections of the garbage left by the previous programs would land randomly in the timings of large functions
+    gc.collect()
+    gc.disable()
+    start = time.perf_counter()
+    try:
+        allocate(ir, allocator, num_regs, spill_strategy, convention)
+        if peephole:
+            run_peephole(ir, convention)
+    finally:
+        alloc_seconds = time.perf_counter() - start
+        gc.enable()
+
+    return ir, alloc_seconds
+
+# Runs the allocated ir and checks its result
+def run_program(program: BenchmarkProgram, ir: Ir, allocator: str, num_regs: int, spill_strategy: str = FurthestUse.name, calls: bool = False, costs: CycleCosts | None = None) -> Interpreter:
+    convention = CallingConvention.default(num_regs) if calls and allocator not in UNCONSTRAINED_ALLOCATORS else None
+    interpreter = Interpreter(num_regs=num_regs, ir=ir, convention=convention, two_address=allocator in TWO_ADDRESS_ALLOCATORS, costs=costs)
+    result = interpreter.run(program.args)
+
+    expected = StackInterpreter(program.fn).run(program.args)
+    assert result == expected, f"{program.name} : {allocator} ({spill_strategy}) with {num_regs} regs returned {result} instead of {expected}"
+
+    return interpreter
+
+# Cycles of every block the run went through, in block order, with the loop depth of the block
+def measure_block_cycles(program: BenchmarkProgram, allocator: str, num_regs: int, spill_strategy: str = FurthestUse.name, calls: bool = False, peephole: bool = False, costs: CycleCosts = CycleCosts()) -> list[tuple[BasicBlock, int, BlockCycles]]:
+    ir, _ = allocate_program(program, allocator, num_regs, spill_strategy, calls, peephole)
+    interpreter = run_program(program, ir, allocator, num_regs, spill_strategy, calls, costs)
+
+    ir.recompute_dominators()
+    ir.recompute_loops()
+    blocks = []
+    for block in ir.block_execution_order():
+        cycles = interpreter.block_cycles.get(id(block))
+        if cycles != None:
+            blocks.append((block, block.loop.depth() if block.loop != None else 0, cycles))
+    return blocks
+
+@dataclasses.dataclass
+class LayoutResult:
+    stats: LayoutStats = dataclasses.field(default_factory=LayoutStats)
+    # Edges whose active sets disagree once allocated, without and with the layout (see resolve_edges)
+    before: ResolutionStats = dataclasses.field(default_factory=ResolutionStats)
+    after: ResolutionStats = dataclasses.field(default_factory=ResolutionStats)
+    # Edges of the allocated irs, without and with the layout
+    edges_before: int = 0
+    edges_after: int = 0
+
+def add_resolution(total: ResolutionStats, stats: ResolutionStats) -> None:
+    for field in dataclasses.fields(ResolutionStats):
+        setattr(total, field.name, getattr(total, field.name) + getattr(stats, field.name))
+
+def count_edges(ir: Ir) -> int:
+    return sum(1 for block in ir.block_execution_order() if block.active_in_set != None for _ in block.outgoing_edges())
+
+# Allocates every program with the allocator the -layout variant is built on, without and with the layout, and resolves
+# the edges of both allocations
+def measure_layout(corpus: list[BenchmarkProgram], allocator: str, num_regs: int, spill_strategy: str = FurthestUse.name, calls: bool = False) -> LayoutResult:
+    base = allocator.removesuffix("-layout")
+    convention = CallingConvention.default(num_regs) if calls else None
+    result = LayoutResult()
+    for program in corpus:
+        for with_layout in [False, True]:
+            ir = import_to_ir(program.fn)
+            if with_layout:
+                layout(ir, result.stats)
+            allocate(ir, base, num_regs, spill_strategy, convention)
+            edges = count_edges(ir)
+            stats = resolve_edges(ir)
+            if with_layout:
+                result.edges_after += edges
+                add_resolution(result.after, stats)
+            else:
+                result.edges_before += edges
+                add_resolution(result.before, stats)
+    return result
+
+def measure_corpus(corpus: list[BenchmarkProgram], allocator: str, num_regs: int, spill_strategy: str = FurthestUse.name, calls: bool = False) -> BenchResult:
+    total = BenchResult()
+    for program in corpus:
+        total = total + measure(program, allocator, num_regs, spill_strategy, calls)
+    return total
+
+def _measure_corpus_star(args: tuple[list[BenchmarkProgram], str, int, str, bool]) -> BenchResult:
+    return measure_corpus(*args)
+
+@dataclasses.dataclass
+class TuningResult:
+    num_regs: int
+    # Strategy with the lowest cost
+    best: str
+    results: dict[str, BenchResult]
+
+# Runs every spill strategy over the corpus for every register count and picks the cheapest one for each
+def tune_spill_strategy(
+    corpus: list[BenchmarkProgram],
+    allocator: str,
+    num_regs_list: list[int],
+    strategies: list[str] | None = None,
+    weights: CostWeights = CostWeights(),
+    jobs: int | None = None,
+    calls: bool = False
+) -> list[TuningResult]:
+    strategies = strategies or list(SPILL_STRATEGIES.keys())
+    work = [(corpus, allocator, num_regs, strategy, calls) for num_regs in num_regs_list for strategy in strategies]
+
+    if jobs == 1:
+        results = list(map(_measure_corpus_star, work))
+    else:
+        with multiprocessing.Pool(processes=jobs) as pool:
+            results = pool.map(_measure_corpus_star, work)
+
+    tuning = []
+    for num_regs in num_regs_list:
+        by_strategy = {strategy: result for (_, _, n, strategy, _), result in zip(work, results) if n == num_regs}
+        # Ties go to the first strategy (furthest use unless strategies were given)
+        best = min(by_strategy, key=lambda strategy: by_strategy[strategy].cost(weights))
+        tuning.append(TuningResult(num_regs=num_regs, best=best, results=by_strategy))
+
+    return tuning
+
+# Allocators that can be reused from one function to the next (see RecordPool)
+REUSABLE_ALLOCATORS = ["rlsra", "lsra"]
+
+@dataclasses.dataclass
+class ReuseResult:
+    alloc_seconds: float = 0.0
+    # Garbage collections during the allocations, of every generation
+    collections: list[int] = dataclasses.field(default_factory=lambda: [0, 0, 0])
+    # Values and annotations taken from the pool, and created
+    reused: int = 0
+    created: int = 0
+
+# Allocates many functions in a row, with a new allocator for each of them or with a single allocator and its pool. The
+# irs are imported beforehand, the reused allocator gets every ir back once it has been run (as a JIT would after
+# emitting the code)
+def measure_reuse(corpus: list[BenchmarkProgram], allocator: str, num_regs: int, reuse: bool) -> ReuseResult:
+    result = ReuseResult()
+    irs = [import_to_ir(program.fn) for program in corpus]
+    expected = [StackInterpreter(program.fn).run(program.args) for program in corpus]
+
+    def on_collection(phase: str, info: dict[str, int]) -> None:
+        if phase == "start":
+            result.collections[info["generation"]] += 1
+
+    pools = []
+    instance = None
+    gc.collect()
+    gc.callbacks.append(on_collection)
+    try:
+        for program, ir, value in zip(corpus, irs, expected):
+            start = time.perf_counter()
+            if instance is None or not reuse:
+                pools.append(RecordPool())
+                instance = Rlsra(num_regs=num_regs, pool=pools[-1]) if allocator == "rlsra" else Lsra(num_regs=num_regs, pool=pools[-1])
+            if allocator == "rlsra":
+                instance.do_reverse_linear_scan(ir)
+            else:
+                instance.do_linear_scan(ir)
+            result.alloc_seconds += time.perf_counter() - start
+
+            returned = Interpreter(num_regs=num_regs, ir=ir).run(program.args)
+            assert returned == value, f"{program.name} : {allocator} with {num_regs} regs returned {returned} instead of {value}"
+            if reuse:
+                instance.pool.release(ir)
+    finally:
+        gc.callbacks.remove(on_collection)
+
+    result.reused = sum(pool.reused for pool in pools)
+    result.created = sum(pool.created for pool in pools)
+    return result
+
+@dataclasses.dataclass
+class FastPathResult:
+    alloc_seconds: float = 0.0
+    # Blocks allocated, and the ones whose pressure fits in the registers (see pressure.py)
+    blocks: int = 0
+    spill_free_blocks: int = 0
+    # The allocation is the same with and without the fast path
+    spills: int = 0
+    restores: int = 0
+    moves: int = 0
+
+# Allocates every function with and without the spill free fast path of the allocators
+def measure_fast_path(corpus: list[BenchmarkProgram], allocator: str, num_regs: int, fast_path: bool) -> FastPathResult:
+    result = FastPathResult()
+    for program in corpus:
+        ir = import_to_ir(program.fn)
+        instance = Rlsra(num_regs=num_regs, fast_path=fast_path) if allocator == "rlsra" else Lsra(num_regs=num_regs, fast_path=fast_path)
+        gc.collect()
+        gc.disable()
+        start = time.perf_counter()
+        try:
+            if allocator == "rlsra":
+                instance.do_reverse_linear_scan(ir)
+            else:
+                instance.do_linear_scan(ir)
+        finally:
+            result.alloc_seconds += time.perf_counter() - start
+            gc.enable()
+
+        result.blocks += sum(1 for _ in ir.block_execution_order())
+        result.spill_free_blocks += instance.spill_free_blocks
+
+        interpreter = Interpreter(num_regs=num_regs, ir=ir)
+        returned = interpreter.run(program.args)
+        expected = StackInterpreter(program.fn).run(program.args)
+        assert returned == expected, f"{program.name} : {allocator} with {num_regs} regs returned {returned} instead of {expected}"
+        result.spills += interpreter.spill_count
+        result.restores += interpreter.restore_count
+        result.moves += interpreter.move_count
+
+    return result
+
+# NAME=CYCLES, NAME being a field of CycleCosts or an Operator
+def parse_cost(text: str) -> tuple[str, int]:
+    name, _, cycles = text.partition("=")
+    if name not in Operator.__members__ and name not in [field.name for field in dataclasses.fields(CycleCosts) if field.name != "binops"]:
+        raise argparse.ArgumentTypeError(f"unknown cost {name}")
+    return name, int(cycles)
+
+def percent(value: float, baseline: float) -> str:
+    if baseline == 0:
+        return ""
+    return f"({100 * (value - baseline) / baseline:+.1f}%)"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the dynamic spill / restore / move counts of the allocators on the benchmark corpus")
+    parser.add_argument("--allocator", choices=ALLOCATORS, action="append", help="can be repeated, the first one is the baseline. Defaults to all allocators but the experimental ones")
+    parser.add_argument("--regs", type=int, nargs="+", default=[2, 3, 4, 6])
+    parser.add_argument("--generated", type=int, default=40, help="number of generated programs in the corpus")
+    parser.add_argument("--large", type=int, default=0, metavar="COUNT", help="use COUNT huge generated functions instead of the corpus, to compare allocation times")
+    parser.add_argument("--calls", action="store_true", help="use generated programs with calls, allocated and run with the default calling convention")
+    parser.add_argument("--reuse", type=int, default=0, metavar="COUNT", help="allocate COUNT small generated functions in a row with a new allocator for each of them, and with a single reused allocator")
+    parser.add_argument("--fast-path", type=int, default=0, metavar="COUNT", help="allocate COUNT small generated functions with and without the fast path for the blocks whose pressure fits in the registers")
+    parser.add_argument("--peephole", action="store_true", help="also show every allocator followed by the peephole pass")
+    parser.add_argument("--verbose", action="store_true", help="show the counts of every program (and the cycles of its blocks with --cycles)")
+    parser.add_argument("--cycles", action="store_true", help="also count the cycles of the runs with the latency model of the Interpreter (see CycleCosts)")
+    parser.add_argument("--cost", type=parse_cost, action="append", default=[], metavar="NAME=CYCLES", help="can be repeated, changes a latency of --cycles (ex : spill=5, Div=30)")
+    parser.add_argument("--program", help="only run this program of the corpus")
+    parser.add_argument("--strategy", choices=SPILL_STRATEGIES.keys(), default=FurthestUse.name, help="spill heuristic used by the allocators")
+    parser.add_argument("--tune", action="store_true", help="instead of comparing allocators, find the cheapest spill heuristic of every allocator for every register count")
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes for --tune (defaults to the number of cores)")
+    parser.add_argument("--weights", type=float, nargs=3, default=[2.0, 2.0, 1.0], metavar=("SPILL", "RESTORE", "MOVE"), help="cost of the operations for --tune")
+    args = parser.parse_args()
+
+    allocators = args.allocator or [allocator for allocator in ALLOCATORS if allocator not in EXPERIMENTAL_ALLOCATORS]
+    if args.large != 0:
+        corpus = large_programs(args.large)
+    elif args.calls:
+        corpus = generated_programs(args.generated, calls=True)
+    else:
+        corpus = benchmark_corpus(args.generated)
+    if args.program != None:
+        corpus = [program for program in corpus if program.name == args.program]
+        if len(corpus) == 0:
+            parser.error(f"unknown program {args.program}")
+
+    costs = None
+    if args.cycles:
+        costs = CycleCosts()
+        for name, cycles in args.cost:
+            if name in Operator.__members__:
+                costs.binops[Operator[name]] = cycles
+            else:
+                setattr(costs, name, cycles)
+
+    if args.reuse != 0:
+        corpus = generated_programs(args.reuse)
+        for num_regs in args.regs:
+            print(f"{num_regs} registers :")
+            for allocator in [allocator for allocator in allocators if allocator in REUSABLE_ALLOCATORS]:
+                for reuse in [False, True]:
+                    result = measure_reuse(corpus, allocator, num_regs, reuse)
+                    name = f"{allocator} {'reused' if reuse else 'new'}"
+                    print(
+                        f"  {name:<16} alloc {1000 * result.alloc_seconds:>8.1f} ms collections {'/'.join(map(str, result.collections)):<12}" +
+                        f" records created {result.created:>8} reused {result.reused:>8}"
+                    )
+        exit(0)
+
+    if args.fast_path != 0:
+        corpus = generated_programs(args.fast_path)
+        for num_regs in args.regs:
+            print(f"{num_regs} registers :")
+            for allocator in [allocator for allocator in allocators if allocator in REUSABLE_ALLOCATORS]:
+                baseline = None
+                for fast_path in [False, True]:
+                    result = measure_fast_path(corpus, allocator, num_regs, fast_path)
+                    if baseline is None:
+                        baseline = result
+                    assert (result.spills, result.restores, result.moves) == (baseline.spills, baseline.restores, baseline.moves), f"{allocator} allocates differently with the fast path"
+                    name = f"{allocator} {'fast path' if fast_path else 'no fast path'}"
+                    print(
+                        f"  {name:<22} alloc {1000 * result.alloc_seconds:>8.1f} ms {percent(result.alloc_seconds, baseline.alloc_seconds):<10}" +
+                        f" spill free blocks {result.spill_free_blocks:>6}/{result.blocks}"
+                    )
+        exit(0)
+
+    if args.tune:
+        weights = CostWeights(*args.weights)
+        for allocator in allocators:
+            print(f"{allocator} :")
+            for tuning in tune_spill_strategy(corpus, allocator, args.regs, weights=weights, jobs=args.jobs, calls=args.calls):
+                print(f"  {tuning.num_regs} registers : best {tuning.best}")
+                baseline = tuning.results[FurthestUse.name].cost(weights)
+                for strategy, result in tuning.results.items():
+                    cost = result.cost(weights)
+                    print(f"    {strategy:<16} cost {cost:>10.0f} {percent(cost, baseline):<10} spills {result.spills:>8} restores {result.restores:>8} moves {result.moves:>8}")
+        exit(0)
+
+    # Wide enough for the longest name, experimental variants followed by the peephole pass included
+    width = max(16, max(len(allocator) for allocator in allocators) + (len(" +peephole") if args.peephole else 0) + (len(" (experimental)") if any(allocator in EXPERIMENTAL_ALLOCATORS for allocator in allocators) else 0))
+    for num_regs in args.regs:
+        print(f"{num_regs} registers :")
+        baseline = None
+        for allocator, peephole in [(allocator, peephole) for allocator in allocators for peephole in ([False, True] if args.peephole else [False])]:
+            name = allocator + (" +peephole" if peephole else "") + (" (experimental)" if allocator in EXPERIMENTAL_ALLOCATORS else "")
+            total = BenchResult()
+            for program in corpus:
+                result = measure(program, allocator, num_regs, args.strategy, args.calls, peephole, costs)
+                if args.verbose:
+                    print(f"    {name:<{width}} {program.name:<20} spills {result.spills:>8} restores {result.restores:>8} moves {result.moves:>8} alloc {1000 * result.alloc_seconds:>8.2f} ms" + (f" cycles {result.cycles:>10}" if args.cycles else ""))
+                    if args.cycles:
+                        for block, depth, cycles in measure_block_cycles(program, allocator, num_regs, args.strategy, args.calls, peephole, costs):
+                            print(
+                                f"      BB{block.il_idx:<5} loop depth {depth} entries {cycles.entries:>7} cycles {cycles.total():>9}" +
+                                f" : ops {cycles.ops:>8} spills {cycles.spills:>7} restores {cycles.restores:>7} moves {cycles.moves:>7} jumps {cycles.jumps:>7} edges {cycles.edges:>7}"
+                            )
+                total = total + result
+
+            if baseline is None:
+                baseline = total
+            print(
+                f"  {name:<{width}}" +
+                f" spills {total.spills:>8} {percent(total.spills, baseline.spills):<10}" +
+                f" restores {total.restores:>8} {percent(total.restores, baseline.restores):<10}" +
+                f" moves {total.moves:>8} {percent(total.moves, baseline.moves):<10}" +
+                f" 2-addr moves {total.two_address_moves:>8} {percent(total.two_address_moves, baseline.two_address_moves):<10}" +
+                f" alloc {1000 * total.alloc_seconds:>8.1f} ms {percent(total.alloc_seconds, baseline.alloc_seconds):<10}" +
+                (f" cycles {total.cycles:>10} {percent(total.cycles, baseline.cycles)}" if args.cycles else "")
+            )
+
+            if allocator.endswith("-layout") and not peephole:
+                result = measure_layout(corpus, allocator, num_regs, args.strategy, args.calls)
+                stats = result.stats
+                before, after = result.before, result.after
+                print(
+                    f"    layout threaded {stats.threaded} merged {stats.merged} removed blocks {stats.removed_blocks}" +
+                    f" fall throughs {stats.fall_throughs_before} -> {stats.fall_throughs_after}" +
+                    f" resolved edges {before.resolved_edges}/{result.edges_before} -> {after.resolved_edges}/{result.edges_after}" +
+                    f" edge spills {before.spills} -> {after.spills} restores {before.restores} -> {after.restores} moves {before.moves} -> {after.moves}"
+                )
@@ -0,0 +1,148 @@
+from __future__ import annotations
+import dataclasses
+import itertools
+import random
+from stack_instruction import *
+from fuzz import *
+
+# Benchmark corpus used to compare allocators : a few hand written programs with typical shapes (hot loops, values
+# living across loops, expression heavy code) and a batch of generated programs
+
+@dataclasses.dataclass
+class BenchmarkProgram:
+    name: str
+    fn: StackFunction
+    args: list[int]
+
+def fib_program(n: int) -> BenchmarkProgram:
+    ins: list[StackInstruction] = [
+        StackInstruction(StackInstructionKind.Push, [0]),
+        StackInstruction(StackInstructionKind.StLocal, [1]),
+        StackInstruction(StackInstructionKind.Push, [1]),
+        StackInstruction(StackInstructionKind.StLocal, [2]),
+
+        # 4:
+        StackInstruction(StackInstructionKind.LdLocal, [0]),
+        StackInstruction(StackInstructionKind.Push, [0]),
+        StackInstruction(StackInstructionKind.Eq, []),
+        StackInstruction(StackInstructionKind.Branch, [21, 8]),
+
+        # 8:
+        StackInstruction(StackInstructionKind.LdLocal, [1]),
+        StackInstruction(StackInstructionKind.LdLocal, [2]),
+        StackInstruction(StackInstructionKind.Add, []),
+        StackInstruction(StackInstructionKind.StLocal, [3]),
+        StackInstruction(StackInstructionKind.LdLocal, [2]),
+        StackInstruction(StackInstructionKind.StLocal, [1]),
+        StackInstruction(StackInstructionKind.LdLocal, [3]),
+        StackInstruction(StackInstructionKind.StLocal, [2]),
+        StackInstruction(StackInstructionKind.LdLocal, [0]),
+        StackInstruction(StackInstructionKind.Push, [1]),
+        StackInstruction(StackInstructionKind.Sub, []),
+        StackInstruction(StackInstructionKind.StLocal, [0]),
+        StackInstruction(StackInstructionKind.Jmp, [4]),
+
+        # 21:
+        StackInstruction(StackInstructionKind.LdLocal, [1]),
+        StackInstruction(StackInstructionKind.Ret, []),
+    ]
+    return BenchmarkProgram(name="fib", fn=StackFunction(local_vars=4, instructions=ins), args=[n])
+
+def add(lhs: Expr, rhs: Expr) -> Expr:
+    return BinExpr(StackInstructionKind.Add, lhs, rhs)
+
+def sub(lhs: Expr, rhs: Expr) -> Expr:
+    return BinExpr(StackInstructionKind.Sub, lhs, rhs)
+
+def mul(lhs: Expr, rhs: Expr) -> Expr:
+    return BinExpr(StackInstructionKind.Mul, lhs, rhs)
+
+def local(i: int) -> Expr:
+    return LocalExpr(i)
+
+def const(value: int) -> Expr:
+    return ConstExpr(value)
+
+# Locals 0 to 3 live across the loop but are only used after it
+def loop_invariants_program() -> BenchmarkProgram:
+    program = FuzzProgram(
+        local_vars=7,
+        body=[
+            AssignStmt(4, const(1)),
+            AssignStmt(5, const(2)),
+            LoopStmt(counter=6, count=20, body=[
+                AssignStmt(4, add(add(local(4), local(5)), sub(local(6), mul(local(4), const(2))))),
+                AssignStmt(5, sub(add(local(5), local(6)), local(4))),
+            ]),
+        ],
+        ret=add(add(add(local(0), local(1)), add(local(2), local(3))), add(local(4), local(5))),
+        args=[3, 5, 7, 11],
+    )
+    return BenchmarkProgram(name="loop_invariants", fn=compile_program(program), args=program.args)
+
+def nested_loops_program() -> BenchmarkProgram:
+    program = FuzzProgram(
+        local_vars=8,
+        body=[
+            AssignStmt(3, const(0)),
+            AssignStmt(4, const(1)),
+            LoopStmt(counter=6, count=8, body=[
+                AssignStmt(3, add(local(3), local(0))),
+                LoopStmt(counter=7, count=6, body=[
+                    AssignStmt(4, add(mul(local(4), const(-1)), add(local(7), local(3)))),
+                    AssignStmt(5, sub(local(4), local(6))),
+                ]),
+                AssignStmt(3, sub(local(3), local(5))),
+            ]),
+        ],
+        ret=add(add(local(1), local(2)), add(local(3), local(4))),
+        args=[2, 4, 6],
+    )
+    return BenchmarkProgram(name="nested_loops", fn=compile_program(program), args=program.args)
+
+# Wide expressions with many live temps, no control flow
+def expressions_program() -> BenchmarkProgram:
+    def wide(depth: int, leaf: int) -> Expr:
+        if depth == 0:
+            return local(leaf % 4)
+        return add(wide(depth - 1, leaf), sub(wide(depth - 1, leaf + 1), wide(depth - 2, leaf + 2) if depth >= 2 else const(leaf)))
+
+    program = FuzzProgram(
+        local_vars=6,
+        body=[
+            AssignStmt(4, wide(4, 0)),
+            AssignStmt(5, add(wide(3, 1), local(4))),
+        ],
+        ret=add(local(4), local(5)),
+        args=[1, 2, 3, 4],
+    )
+    return BenchmarkProgram(name="expressions", fn=compile_program(program), args=program.args)
+
+def generated_programs(count: int, seed: int = 0, calls: bool = False) -> list[BenchmarkProgram]:
+    return list(itertools.islice(iter_generated_programs(seed, calls), count))
+
+# Endless, generated on demand : corpora too large to be kept in memory (see pipeline.py)
+def iter_generated_programs(seed: int = 0, calls: bool = False) -> Iterator[BenchmarkProgram]:
+    for i in itertools.count(seed):
+        program = ProgramGenerator(random.Random(i), data_vars=6, max_depth=3, params=2, calls=calls).gen_program()
+        yield BenchmarkProgram(name=f"generated_{i}", fn=compile_program(program), args=program.args)
+
+# Huge functions with many locals, to compare allocation times. The size of generated programs varies a lot, small ones
+# are skipped
+def large_programs(count: int, seed: int = 0, min_instructions: int = 5000) -> list[BenchmarkProgram]:
+    programs = []
+    rng = random.Random(seed)
+    while len(programs) < count:
+        program = ProgramGenerator(rng, data_vars=32, max_depth=2, max_stmts=30, max_expr_depth=4, params=4).gen_program()
+        fn = compile_program(program)
+        if len(fn.instructions) >= min_instructions:
+            programs.append(BenchmarkProgram(name=f"large_{seed}_{len(programs)}", fn=fn, args=program.args))
+    return programs
+
+def benchmark_corpus(generated: int = 40) -> list[BenchmarkProgram]:
+    return [
+        fib_program(25),
+        loop_invariants_program(),
+        nested_loops_program(),
+        expressions_program(),
+    ] + generated_programs(generated)
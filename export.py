@@ -0,0 +1,318 @@
+from __future__ import annotations
+import argparse
+import dataclasses
+import itertools
+import json
+import sys
+from stack_instruction import *
+from rlsra import Value, ActiveInOut, RegSpill, RegRestore, RegMove
+from resolution import edge_resolution
+from fuzz import ALLOCATORS, UNCONSTRAINED_ALLOCATORS, allocate
+from corpus import *
+from spill_strategy import SPILL_STRATEGIES, FurthestUse
+
+# Export of allocated irs, streamed to a buffered file : the lines are generated block by block and written a chunk at a
+# time (see Ir.dump), the output of a function is never held in memory as a whole.
+# - text : the format of Ir.dump
+# - jsonl : one JSON object per line, for other tools. A "function" record, then for every block a "block" record
+#   followed by a "tree" record per tree in execution order. Blocks are numbered in the order of the block list (block
+#   il_idx aren't unique once edges are split), values are {"local": n} or {"tree": ir_idx}
+# - dot : the control flow graph for Graphviz. The edges show where every value of the active out set of the source
+#   goes in the active in set of the target (a register, or memory when it's spilled on the edge), side exits are dashed
+# Diff mode compares two allocations of the same function tree by tree (see write_diff).
+
+FORMATS = ["text", "jsonl", "dot"]
+
+# Buffer of the files written to, the lines are joined into chunks before being written so it mostly saves system calls
+BUFFER_SIZE = 1 << 20
+
+def write_lines(out: TextIO, lines: Iterable[str]) -> None:
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == DUMP_CHUNK_LINES:
+            out.write("\n".join(chunk) + "\n")
+            chunk.clear()
+    if len(chunk) != 0:
+        out.write("\n".join(chunk) + "\n")
+
+def open_output(path: str | None) -> TextIO:
+    if path == None or path == "-":
+        return sys.stdout
+    return open(path, "w", buffering=BUFFER_SIZE)
+
+def block_numbers(ir: Ir) -> dict[int, int]:
+    return {id(block): i for i, block in enumerate(ir.block_execution_order())}
+
+def encode_value(val: Value) -> dict:
+    return {"local": val.of} if isinstance(val.of, int) else {"tree": val.of.ir_idx}
+
+def encode_active(active: ActiveInOut) -> dict:
+    return {"val": encode_value(active.val), "reg": active.reg}
+
+def encode_annotations(spills: list[RegSpill], restores: list[RegRestore], moves: list[RegMove]) -> dict:
+    return {
+        "spills": [{"val": encode_value(spill.val), "reg": spill.reg} for spill in spills],
+        "restores": [{"val": encode_value(restore.val), "reg": restore.reg} for restore in restores],
+        "moves": [{"val": encode_value(move.val_from), "from": move.reg_from, "to": move.reg_to} for move in moves],
+    }
+
+def encode_operand(operand: Any, numbers: dict[int, int]) -> Any:
+    if isinstance(operand, BlockEdge):
+        return {"block": numbers[id(operand.target)]}
+    if isinstance(operand, Value):
+        return encode_value(operand)
+    if isinstance(operand, Operator):
+        return operand.name
+    return operand
+
+def active_out_of(edge: BlockEdge) -> list[ActiveInOut] | None:
+    return edge.active_out_set if edge.active_out_set != None else edge.source.active_out_set
+
+# Writes the text format of Ir.dump
+def write_text(ir: Ir, out: TextIO) -> None:
+    ir.dump(out)
+
+def jsonl_lines(ir: Ir, name: str | None = None) -> Iterator[str]:
+    numbers = block_numbers(ir)
+    yield json.dumps({"type": "function", "name": name, "local_vars": ir.local_vars, "blocks": len(numbers), "trees": ir.ir_idx_count})
+
+    for block in ir.block_execution_order():
+        number = numbers[id(block)]
+        yield json.dumps({
+            "type": "block",
+            "block": number,
+            "il_idx": block.il_idx,
+            "predecessors": [numbers[id(edge.source)] for edge in block.predecessors],
+            "successors": [numbers[id(edge.target)] for edge in block.terminator_edges()],
+            "side_exits": [{"block": numbers[id(edge.target)], "active_out": [encode_active(active) for active in edge.active_out_set] if edge.active_out_set != None else None} for edge in block.side_exits],
+            "alive_in": sorted(block.alive_in_set) if block.alive_in_set != None else None,
+            "alive_out": sorted(block.alive_out_set) if block.alive_out_set != None else None,
+            "active_in": [encode_active(active) for active in block.active_in_set] if block.active_in_set != None else None,
+            "active_out": [encode_active(active) for active in block.active_out_set] if block.active_out_set != None else None,
+        })
+        for tree in block.tree_execution_order():
+            yield json.dumps({
+                "type": "tree",
+                "block": number,
+                "ir_idx": tree.ir_idx,
+                "kind": tree.kind.name,
+                "operands": [encode_operand(operand, numbers) for operand in tree.operands],
+                "subtrees": [subtree.ir_idx for subtree in tree.subtrees],
+                "reg": tree.reg,
+                "use_reg": tree.use_reg,
+                "pre": encode_annotations(tree.pre_spills, tree.pre_restores, tree.pre_moves),
+                "post": encode_annotations(tree.post_spills, tree.post_restores, tree.post_moves),
+            })
+
+def write_jsonl(ir: Ir, out: TextIO, name: str | None = None) -> None:
+    write_lines(out, jsonl_lines(ir, name))
+
+def dot_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\"", "\\\"")
+
+# Where every value of the active out set goes on the edge : "local 1 : r1 -> r2", "local 3 : r0 -> mem" (spilled),
+# "local 2 : mem -> r1" (restored)
+def edge_label(edge: BlockEdge) -> list[str]:
+    active_out_set = active_out_of(edge)
+    active_in_set = edge.target.active_in_set
+    if active_out_set == None or active_in_set == None:
+        return []
+    regs_in = {active.val.of if isinstance(active.val.of, int) else id(active.val.of): active.reg for active in active_in_set}
+    lines = []
+    seen = set()
+    for active in active_out_set:
+        key = active.val.of if isinstance(active.val.of, int) else id(active.val.of)
+        seen.add(key)
+        target = f"r{regs_in[key]}" if key in regs_in else "mem"
+        lines.append(f"{active.val} : r{active.reg} -> {target}")
+    for active in active_in_set:
+        key = active.val.of if isinstance(active.val.of, int) else id(active.val.of)
+        if key not in seen:
+            lines.append(f"{active.val} : mem -> r{active.reg}")
+    return lines
+
+def dot_lines(ir: Ir, name: str | None = None) -> Iterator[str]:
+    numbers = block_numbers(ir)
+    yield f"digraph \"{dot_escape(name if name != None else 'ir')}\" {{"
+    yield "  node [shape=box fontname=monospace];"
+    yield "  edge [fontname=monospace fontsize=10];"
+
+    for block in ir.block_execution_order():
+        number = numbers[id(block)]
+        spills = restores = moves = trees = 0
+        for tree in block.tree_execution_order():
+            trees += 1
+            spills += len(tree.pre_spills) + len(tree.post_spills)
+            restores += len(tree.pre_restores) + len(tree.post_restores)
+            moves += len(tree.pre_moves) + len(tree.post_moves)
+        label = [str(block), f"{trees} trees", f"spills {spills} restores {restores} moves {moves}"]
+        if block.active_in_set != None:
+            label.append("in : " + ", ".join(f"{active.val} r{active.reg}" for active in block.active_in_set))
+        yield f"  b{number} [label=\"" + "\\l".join(dot_escape(line) for line in label) + "\\l\"];"
+
+        for edge in block.outgoing_edges():
+            side_exit = any(edge is side_exit for side_exit in block.side_exits)
+            attributes = ["label=\"" + "\\l".join(dot_escape(line) for line in edge_label(edge)) + "\\l\""]
+            if side_exit:
+                attributes.append("style=dashed")
+            yield f"  b{number} -> b{numbers[id(edge.target)]} [" + " ".join(attributes) + "];"
+
+    yield "}"
+
+def write_dot(ir: Ir, out: TextIO, name: str | None = None) -> None:
+    write_lines(out, dot_lines(ir, name))
+
+def write_ir(ir: Ir, out: TextIO, format: str, name: str | None = None) -> None:
+    match format:
+        case "text":
+            write_text(ir, out)
+        case "jsonl":
+            write_jsonl(ir, out, name)
+        case "dot":
+            write_dot(ir, out, name)
+        case _:
+            raise Exception(f"unknown format {format}")
+
+@dataclasses.dataclass
+class DiffStats:
+    # Trees whose register, operands or annotations differ, and blocks whose active sets differ
+    trees: int = 0
+    blocks: int = 0
+    # Annotations of the second allocation minus the ones of the first, edges included
+    spills: int = 0
+    restores: int = 0
+    moves: int = 0
+
+    def same(self) -> bool:
+        return self.trees == 0 and self.blocks == 0
+
+def annotation_lines(spills: list[RegSpill], restores: list[RegRestore], moves: list[RegMove]) -> list[str]:
+    return [str(annotation) for annotation in itertools.chain(spills, restores, moves)]
+
+# Lines of both allocations when they differ
+def diff_lines(lines_a: list[str], lines_b: list[str]) -> list[str]:
+    if lines_a == lines_b:
+        return []
+    return ["- " + line for line in lines_a] + ["+ " + line for line in lines_b]
+
+def tree_line(tree: Tree) -> str:
+    return f"[{tree.ir_idx}] (r{tree.reg} use r{tree.use_reg}) {tree.kind.name}(" + ", ".join(map(str, tree.operands)) + ")"
+
+def edge_counts(block: BasicBlock) -> tuple[int, int, int]:
+    spills = restores = moves = 0
+    if block.active_in_set == None:
+        return 0, 0, 0
+    for edge in block.outgoing_edges():
+        if edge.target.active_in_set == None:
+            continue
+        edge_spills, edge_restores, edge_moves = edge_resolution(active_out_of(edge), edge.target.active_in_set)
+        spills, restores, moves = spills + len(edge_spills), restores + len(edge_restores), moves + len(edge_moves)
+    return spills, restores, moves
+
+def active_lines(active_set: list[ActiveInOut] | None) -> list[str]:
+    return [str(active) for active in active_set] if active_set != None else []
+
+# Compares two allocations of the same function : the irs must have the same blocks and trees (the same import with the
+# same passes), allocated by different allocators, register counts or strategies. The lines of the blocks and trees that
+# differ, the ones of the first allocation prefixed by "-" and the ones of the second by "+", then the totals
+def allocation_diff(a: Ir, b: Ir, stats: DiffStats) -> Iterator[str]:
+    blocks_a = list(a.block_execution_order())
+    blocks_b = list(b.block_execution_order())
+    if len(blocks_a) != len(blocks_b):
+        raise Exception(f"the irs don't have the same blocks ({len(blocks_a)} and {len(blocks_b)})")
+
+    for block_a, block_b in zip(blocks_a, blocks_b):
+        trees_a = list(block_a.tree_execution_order())
+        trees_b = list(block_b.tree_execution_order())
+        if [tree.kind for tree in trees_a] != [tree.kind for tree in trees_b]:
+            raise Exception(f"the trees of {block_a} and {block_b} don't match")
+
+        header = True
+        for name, set_a, set_b in [("active var in", block_a.active_in_set, block_b.active_in_set), ("active var out", block_a.active_out_set, block_b.active_out_set)]:
+            active = diff_lines(active_lines(set_a), active_lines(set_b))
+            if len(active) != 0:
+                if header:
+                    yield str(block_a)
+                    header = False
+                yield f"{name}:"
+                yield from active
+        if not header:
+            stats.blocks += 1
+
+        for tree_a, tree_b in zip(trees_a, trees_b):
+            pre = diff_lines(annotation_lines(tree_a.pre_spills, tree_a.pre_restores, tree_a.pre_moves), annotation_lines(tree_b.pre_spills, tree_b.pre_restores, tree_b.pre_moves))
+            line_a, line_b = tree_line(tree_a), tree_line(tree_b)
+            post = diff_lines(annotation_lines(tree_a.post_spills, tree_a.post_restores, tree_a.post_moves), annotation_lines(tree_b.post_spills, tree_b.post_restores, tree_b.post_moves))
+            if len(pre) == 0 and line_a == line_b and len(post) == 0:
+                continue
+            stats.trees += 1
+            if header:
+                yield str(block_a)
+                header = False
+            yield from pre
+            yield from diff_lines([line_a], [line_b]) if line_a != line_b else ["  " + line_a]
+            yield from post
+
+        for sign, block, trees in [(-1, block_a, trees_a), (1, block_b, trees_b)]:
+            for tree in trees:
+                stats.spills += sign * (len(tree.pre_spills) + len(tree.post_spills))
+                stats.restores += sign * (len(tree.pre_restores) + len(tree.post_restores))
+                stats.moves += sign * (len(tree.pre_moves) + len(tree.post_moves))
+            spills, restores, moves = edge_counts(block)
+            stats.spills += sign * spills
+            stats.restores += sign * restores
+            stats.moves += sign * moves
+
+    yield f"{stats.trees} trees and {stats.blocks} blocks differ, spills {stats.spills:+d} restores {stats.restores:+d} moves {stats.moves:+d}"
+
+def write_diff(a: Ir, b: Ir, out: TextIO, stats: DiffStats | None = None) -> DiffStats:
+    stats = stats if stats != None else DiffStats()
+    write_lines(out, allocation_diff(a, b, stats))
+    return stats
+
+def allocated_ir(fn: StackFunction, allocator: str, num_regs: int, spill_strategy: str = FurthestUse.name, calls: bool = False) -> Ir:
+    convention = CallingConvention.default(num_regs) if calls and allocator not in UNCONSTRAINED_ALLOCATORS else None
+    ir = import_to_ir(fn)
+    allocate(ir, allocator, num_regs, spill_strategy, convention)
+    return ir
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes the allocation of a program of the benchmark corpus as text, JSON lines or Graphviz, or compares two allocations of it")
+    parser.add_argument("program", help="name of the program in the corpus")
+    parser.add_argument("--format", choices=FORMATS, default="text")
+    parser.add_argument("--output", help="file to write to, defaults to the standard output")
+    parser.add_argument("--allocator", choices=ALLOCATORS, default="rlsra")
+    parser.add_argument("--strategy", choices=SPILL_STRATEGIES.keys(), default=FurthestUse.name, help="spill heuristic used by the allocator")
+    parser.add_argument("--regs", type=int, default=4)
+    parser.add_argument("--generated", type=int, default=40, help="number of generated programs in the corpus")
+    parser.add_argument("--calls", action="store_true", help="use generated programs with calls, allocated with the default calling convention")
+    parser.add_argument("--diff", choices=ALLOCATORS, metavar="ALLOCATOR", help="compare with the allocation of this allocator instead of exporting")
+    parser.add_argument("--diff-regs", type=int, help="register count of the compared allocation, defaults to --regs")
+    parser.add_argument("--diff-strategy", choices=SPILL_STRATEGIES.keys(), help="spill heuristic of the compared allocation, defaults to --strategy")
+    args = parser.parse_args()
+
+    corpus = generated_programs(args.generated, calls=True) if args.calls else benchmark_corpus(args.generated)
+    program = next((program for program in corpus if program.name == args.program), None)
+    if program == None:
+        parser.error(f"unknown program {args.program}")
+
+    ir = allocated_ir(program.fn, args.allocator, args.regs, args.strategy, args.calls)
+    out = open_output(args.output)
+    try:
+        if args.diff != None or args.diff_regs != None or args.diff_strategy != None:
+            other = allocated_ir(
+                program.fn,
+                args.diff if args.diff != None else args.allocator,
+                args.diff_regs if args.diff_regs != None else args.regs,
+                args.diff_strategy if args.diff_strategy != None else args.strategy,
+                args.calls
+            )
+            write_diff(ir, other, out)
+        else:
+            write_ir(ir, out, args.format, program.name)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        else:
+            out.flush()
@@ -0,0 +1,631 @@
+from __future__ import annotations
+import argparse
+import dataclasses
+import multiprocessing
+import random
+import traceback
+from typing import *
+from stack_instruction import *
+from stack_interpreter import StackInterpreter
+from rlsra import Rlsra, RecordPool
+from lsra import Lsra
+from graph_coloring import GraphColoring
+from interval_lsra import IntervalLsra
+from interpreter import Interpreter
+from resolution import resolve_edges, edge_resolution, has_annotations
+from sethi_ullman import reorder_subtrees
+from optimize import optimize
+from layout import layout
+from peephole import peephole as run_peephole
+from spill_strategy import SPILL_STRATEGIES, FurthestUse, get_spill_strategy
+
+# Differential fuzzer : generates random structured programs, runs them through import_to_ir and an allocator for
+# several register counts, then compares the results of the Interpreter with the StackInterpreter reference.
+# Failing programs are shrunk before being reported.
+
+# Allocators that don't follow calling conventions : with --calls, they still run the calls, as unconstrained trees
+UNCONSTRAINED_ALLOCATORS = ["interval", "coloring"]
+# Allocators for two-address targets : BinOps write their result over their left operand
+TWO_ADDRESS_ALLOCATORS = ["rlsra-2addr", "lsra-2addr"]
+# Variants whose pass doesn't lower the spills / restores on the benchmark corpus (see layout.py). They're fuzzed like the
+# others but bench.py only compares them when asked for
+EXPERIMENTAL_ALLOCATORS = ["rlsra-layout", "lsra-layout"]
+ALLOCATORS = ["rlsra", "rlsra-hoist", "rlsra-split", "rlsra-reorder", "rlsra-opt", "rlsra-layout", "rlsra-2addr", "lsra", "lsra-split", "lsra-reorder", "lsra-opt", "lsra-layout", "lsra-2addr", "interval", "coloring"]
+DEFAULT_NUM_REGS = [2, 3, 4, 6]
+
+# Programs are generated as small structured ASTs rather than raw instructions so that they can be shrunk
+# without having to fix up jump targets
+
+@dataclasses.dataclass
+class ConstExpr:
+    value: int
+
+@dataclasses.dataclass
+class LocalExpr:
+    local: int
+
+@dataclasses.dataclass
+class BinExpr:
+    op: StackInstructionKind
+    lhs: Expr
+    rhs: Expr
+
+@dataclasses.dataclass
+class CallExpr:
+    callee: str
+    args: list[Expr]
+
+Expr = ConstExpr | LocalExpr | BinExpr | CallExpr
+
+@dataclasses.dataclass
+class AssignStmt:
+    local: int
+    expr: Expr
+
+@dataclasses.dataclass
+class DiscardStmt:
+    expr: Expr
+
+@dataclasses.dataclass
+class IfStmt:
+    cond: Expr
+    then_body: list[Stmt]
+    else_body: list[Stmt]
+
+# Counted loop : counter is only ever written by the loop itself, so every loop terminates
+@dataclasses.dataclass
+class LoopStmt:
+    counter: int
+    count: int
+    body: list[Stmt]
+
+Stmt = AssignStmt | DiscardStmt | IfStmt | LoopStmt
+
+@dataclasses.dataclass
+class FuzzProgram:
+    local_vars: int
+    body: list[Stmt]
+    ret: Expr
+    # Passed in the first locals
+    args: list[int] = dataclasses.field(default_factory=list)
+
+@dataclasses.dataclass
+class Failure:
+    allocator: str
+    num_regs: int
+    kind: str
+    message: str
+
+    def same_as(self, other: Failure) -> bool:
+        return self.allocator == other.allocator and self.num_regs == other.num_regs and self.kind == other.kind
+
+@dataclasses.dataclass
+class FuzzResult:
+    seed: int
+    failure: Failure | None
+    program: FuzzProgram | None
+    instructions: list[StackInstruction] | None
+
+class ProgramGenerator:
+    rng: random.Random
+    data_vars: int
+    max_depth: int
+    max_stmts: int
+    max_expr_depth: int
+    calls: bool
+
+    params: int
+
+    def __init__(self, rng: random.Random, data_vars: int = 4, max_depth: int = 2, max_stmts: int = 5, max_expr_depth: int = 3, params: int = 2, calls: bool = False) -> None:
+        self.rng = rng
+        self.calls = calls
+        self.data_vars = data_vars
+        self.params = min(params, data_vars)
+        self.max_depth = max_depth
+        self.max_stmts = max_stmts
+        self.max_expr_depth = max_expr_depth
+
+    def gen_expr(self, depth: int, counters: list[int]) -> Expr:
+        if depth >= self.max_expr_depth or self.rng.random() < 0.3:
+            if self.rng.random() < 0.6:
+                readable = list(range(self.data_vars)) + counters
+                return LocalExpr(self.rng.choice(readable))
+            return ConstExpr(self.rng.randint(-3, 5))
+
+        if self.calls and self.rng.random() < 0.3:
+            callee = self.rng.choice(sorted(CALLEES))
+            return CallExpr(callee, [self.gen_expr(depth + 1, counters) for _ in range(CALLEES[callee][0])])
+
+        op = self.rng.choice([
+            StackInstructionKind.Add,
+            StackInstructionKind.Add,
+            StackInstructionKind.Sub,
+            StackInstructionKind.Mul,
+            StackInstructionKind.Div,
+            StackInstructionKind.Eq,
+        ])
+        lhs = self.gen_expr(depth + 1, counters)
+        if op == StackInstructionKind.Div:
+            # Keep the reference and the interpreter away from divisions by zero
+            rhs = ConstExpr(self.rng.choice([-2, -1, 1, 2, 3]))
+        elif op == StackInstructionKind.Mul:
+            # Multiplying by constants only keeps values from growing exponentially in loops
+            rhs = ConstExpr(self.rng.choice([-2, -1, 0, 2, 3]))
+        else:
+            rhs = self.gen_expr(depth + 1, counters)
+        return BinExpr(op, lhs, rhs)
+
+    def gen_body(self, depth: int, counters: list[int]) -> list[Stmt]:
+        body = []
+        for _ in range(self.rng.randint(1, self.max_stmts)):
+            r = self.rng.random()
+            if depth < self.max_depth and r < 0.15:
+                counter = self.data_vars + depth
+                body.append(LoopStmt(counter, self.rng.randint(0, 3), self.gen_body(depth + 1, counters + [counter])))
+            elif depth < self.max_depth and r < 0.3:
+                body.append(IfStmt(self.gen_expr(1, counters), self.gen_body(depth + 1, counters), self.gen_body(depth + 1, counters)))
+            elif r < 0.35:
+                body.append(DiscardStmt(self.gen_expr(0, counters)))
+            else:
+                body.append(AssignStmt(self.rng.randrange(self.data_vars), self.gen_expr(0, counters)))
+        return body
+
+    def gen_program(self) -> FuzzProgram:
+        # Every data local that isn't a parameter is initialized up front so that the programs never read uninitialized locals
+        init = [AssignStmt(i, ConstExpr(self.rng.randint(-3, 5))) for i in range(self.params, self.data_vars)]
+        body = self.gen_body(0, [])
+        args = [self.rng.randint(-5, 5) for _ in range(self.params)]
+        return FuzzProgram(local_vars=self.data_vars + self.max_depth, body=init + body, ret=self.gen_expr(0, []), args=args)
+
+def compile_program(program: FuzzProgram) -> StackFunction:
+    ins: list[StackInstruction] = []
+
+    def is_terminated() -> bool:
+        return ins != [] and ins[-1].kind in [StackInstructionKind.Jmp, StackInstructionKind.Branch, StackInstructionKind.Ret]
+
+    # import_to_ir only starts new blocks after terminators, so every jump target must be preceded by one
+    def terminate() -> None:
+        if not is_terminated():
+            ins.append(StackInstruction(StackInstructionKind.Jmp, [len(ins) + 1]))
+
+    def emit_expr(expr: Expr) -> None:
+        match expr:
+            case ConstExpr():
+                ins.append(StackInstruction(StackInstructionKind.Push, [expr.value]))
+            case LocalExpr():
+                ins.append(StackInstruction(StackInstructionKind.LdLocal, [expr.local]))
+            case BinExpr():
+                emit_expr(expr.lhs)
+                emit_expr(expr.rhs)
+                ins.append(StackInstruction(expr.op, []))
+            case CallExpr():
+                for arg in expr.args:
+                    emit_expr(arg)
+                ins.append(StackInstruction(StackInstructionKind.Call, [expr.callee]))
+
+    def emit_body(body: list[Stmt]) -> None:
+        for stmt in body:
+            match stmt:
+                case AssignStmt():
+                    emit_expr(stmt.expr)
+                    ins.append(StackInstruction(StackInstructionKind.StLocal, [stmt.local]))
+                case DiscardStmt():
+                    emit_expr(stmt.expr)
+                    ins.append(StackInstruction(StackInstructionKind.Pop, []))
+                case IfStmt():
+                    emit_expr(stmt.cond)
+                    branch = StackInstruction(StackInstructionKind.Branch, [len(ins) + 1, None])
+                    ins.append(branch)
+                    emit_body(stmt.then_body)
+                    then_jmp = StackInstruction(StackInstructionKind.Jmp, [None])
+                    ins.append(then_jmp)
+                    branch.operands[1] = len(ins)
+                    emit_body(stmt.else_body)
+                    terminate()
+                    then_jmp.operands[0] = len(ins)
+                case LoopStmt():
+                    ins.append(StackInstruction(StackInstructionKind.Push, [stmt.count]))
+                    ins.append(StackInstruction(StackInstructionKind.StLocal, [stmt.counter]))
+                    terminate()
+                    header = len(ins)
+                    ins.append(StackInstruction(StackInstructionKind.LdLocal, [stmt.counter]))
+                    ins.append(StackInstruction(StackInstructionKind.Push, [0]))
+                    ins.append(StackInstruction(StackInstructionKind.Eq, []))
+                    branch = StackInstruction(StackInstructionKind.Branch, [None, len(ins) + 1])
+                    ins.append(branch)
+                    emit_body(stmt.body)
+                    ins.append(StackInstruction(StackInstructionKind.LdLocal, [stmt.counter]))
+                    ins.append(StackInstruction(StackInstructionKind.Push, [1]))
+                    ins.append(StackInstruction(StackInstructionKind.Sub, []))
+                    ins.append(StackInstruction(StackInstructionKind.StLocal, [stmt.counter]))
+                    ins.append(StackInstruction(StackInstructionKind.Jmp, [header]))
+                    branch.operands[0] = len(ins)
+
+    emit_body(program.body)
+    emit_expr(program.ret)
+    ins.append(StackInstruction(StackInstructionKind.Ret, []))
+
+    return StackFunction(local_vars=program.local_vars, instructions=ins)
+
+# Passes the -reorder, -opt and -layout variants run on the ir before allocating it. They only depend on the ir, not on the
+# register count
+def prepare(ir: Ir, allocator: str) -> None:
+    if allocator.endswith("-reorder"):
+        reorder_subtrees(ir)
+    elif allocator.endswith("-opt"):
+        optimize(ir)
+    elif allocator.endswith("-layout"):
+        layout(ir)
+
+# The convention is ignored by the UNCONSTRAINED_ALLOCATORS
+# pool : shared by the Rlsra and Lsra allocations (see RecordPool), the caller releases the ir into it once done with it
+# prepared : prepare was already executed on the ir (see sweep.py)
+def allocate(ir: Ir, allocator: str, num_regs: int, spill_strategy: str = FurthestUse.name, convention: CallingConvention | None = None, pool: RecordPool | None = None, prepared: bool = False) -> None:
+    strategy = get_spill_strategy(spill_strategy)
+    if not prepared:
+        prepare(ir, allocator)
+    match allocator:
+        case "rlsra" | "rlsra-reorder" | "rlsra-opt" | "rlsra-layout":
+            Rlsra(num_regs=num_regs, spill_strategy=strategy, convention=convention, pool=pool).do_reverse_linear_scan(ir)
+        case "rlsra-hoist":
+            Rlsra(num_regs=num_regs, hoist_loop_spills=True, spill_strategy=strategy, convention=convention, pool=pool).do_reverse_linear_scan(ir)
+        case "rlsra-split":
+            Rlsra(num_regs=num_regs, split_live_ranges=True, spill_strategy=strategy, convention=convention, pool=pool).do_reverse_linear_scan(ir)
+        case "rlsra-2addr":
+            Rlsra(num_regs=num_regs, spill_strategy=strategy, convention=convention, two_address=True, pool=pool).do_reverse_linear_scan(ir)
+        case "lsra" | "lsra-reorder" | "lsra-opt" | "lsra-layout":
+            Lsra(num_regs=num_regs, spill_strategy=strategy, convention=convention, pool=pool).do_linear_scan(ir)
+        case "lsra-split":
+            Lsra(num_regs=num_regs, spill_strategy=strategy, split_live_ranges=True, convention=convention, pool=pool).do_linear_scan(ir)
+        case "lsra-2addr":
+            Lsra(num_regs=num_regs, spill_strategy=strategy, convention=convention, two_address=True, pool=pool).do_linear_scan(ir)
+        case "interval":
+            IntervalLsra(num_regs=num_regs).do_interval_scan(ir)
+        case "coloring":
+            GraphColoring(num_regs=num_regs).do_graph_coloring(ir)
+        case _:
+            raise Exception(f"Unknown allocator {allocator}")
+
+# Pool of the process for reuse : the annotations of the previous programs get reused by the next ones
+shared_pool = RecordPool()
+
+def check_program(program: FuzzProgram, allocators: list[str], num_regs_list: list[int], batch_lanes: int = 0, resolve: bool = False, spill_strategy: str = FurthestUse.name, calls: bool = False, reuse: bool = False, peephole: bool = False, superblocks: bool = False) -> Failure | None:
+    fn = compile_program(program)
+
+    reference = StackInterpreter(fn, max_steps=100_000)
+    try:
+        expected = reference.run(program.args)
+    except Exception:
+        # Programs the reference can't run (ex : shrunk into something invalid) aren't interesting
+        return None
+
+    for allocator in allocators:
+        for num_regs in num_regs_list:
+            convention = CallingConvention.default(num_regs) if calls and allocator not in UNCONSTRAINED_ALLOCATORS else None
+            try:
+                ir = import_to_ir(fn)
+                allocate(ir, allocator, num_regs, spill_strategy, convention, shared_pool if reuse else None)
+            except Exception as e:
+                return Failure(allocator, num_regs, "allocator crash", "".join(traceback.format_exception_only(e)).strip())
+
+            if resolve:
+                failure = check_resolution(ir, allocator, num_regs)
+                if failure is not None:
+                    return failure
+
+            if peephole:
+                try:
+                    run_peephole(ir, convention)
+                except Exception as e:
+                    return Failure(allocator, num_regs, "peephole crash", "".join(traceback.format_exception_only(e)).strip())
+
+            try:
+                # A bad allocation can turn loop counters into garbage, bound the run by what the reference needed
+                result = Interpreter(num_regs=num_regs, ir=ir, max_steps=2 * reference.step_count + 100, convention=convention, two_address=allocator in TWO_ADDRESS_ALLOCATORS).run(program.args)
+            except Exception as e:
+                return Failure(allocator, num_regs, "interpreter crash", "".join(traceback.format_exception_only(e)).strip())
+
+            if result != expected:
+                return Failure(allocator, num_regs, "mismatch", f"expected {expected}, got {result}")
+
+            if batch_lanes != 0 and len(program.args) != 0:
+                failure = check_batch(fn, ir, allocator, num_regs, len(program.args), batch_lanes)
+                if failure is not None:
+                    return failure
+
+            if reuse:
+                shared_pool.release(ir)
+
+            # Superblocks are only formed by Rlsra (see TracingFunction)
+            if superblocks and allocator == "rlsra":
+                failure = check_superblocks(fn, program.args, num_regs, expected, batch_lanes)
+                if failure is not None:
+                    return failure
+
+    return None
+
+# Calls with the arguments of the program that record traces, before checking the superblocks with other arguments
+SUPERBLOCK_CALLS = 3
+SUPERBLOCK_ARGS = 16
+
+# Forms superblocks for the loops the program runs through with its own arguments (a low threshold, so that even short
+# loops get one), then runs the allocation with the superblocks over other arguments : the lanes going another way than
+# the traces leave through the side exits of the guards. Checked with the Interpreter, and the BatchInterpreter when
+# batch_lanes isn't 0
+def check_superblocks(fn: StackFunction, args: list[int], num_regs: int, expected: int, batch_lanes: int = 0) -> Failure | None:
+    # Imported here, superblock.py imports the corpus which imports this module
+    from superblock import TracingFunction
+
+    try:
+        function = TracingFunction(fn, num_regs, trace_threshold=2)
+        for _ in range(SUPERBLOCK_CALLS):
+            result = function.call(args)
+            if result != expected:
+                return Failure("rlsra", num_regs, "superblock mismatch", f"expected {expected}, got {result} with the arguments of the traces")
+    except Exception as e:
+        return Failure("rlsra", num_regs, "superblock crash", "".join(traceback.format_exception_only(e)).strip())
+
+    ir, superblocks = function.pending if function.pending != None else (function.ir, function.superblocks)
+    if superblocks == 0 or len(args) == 0:
+        return None
+
+    rng = random.Random(num_regs)
+    rows = [[rng.randint(-5, 5) for _ in args] for _ in range(SUPERBLOCK_ARGS)]
+    expected_rows = []
+    steps = 0
+    for row in rows:
+        reference = StackInterpreter(fn, max_steps=100_000)
+        try:
+            expected_rows.append(reference.run(row))
+        except Exception:
+            return None
+        steps += reference.step_count
+
+        try:
+            result = Interpreter(num_regs=num_regs, ir=ir, max_steps=2 * reference.step_count + 100).run(row)
+        except Exception as e:
+            return Failure("rlsra", num_regs, "superblock interpreter crash", f"{row} : " + "".join(traceback.format_exception_only(e)).strip())
+        if result != expected_rows[-1]:
+            return Failure("rlsra", num_regs, "superblock mismatch", f"{row} : expected {expected_rows[-1]}, got {result}")
+
+    if batch_lanes == 0 or any(abs(e) >= 2**62 for e in expected_rows):
+        return None
+
+    import numpy as np
+    from batch_interpreter import BatchInterpreter
+    try:
+        results = BatchInterpreter(num_regs=num_regs, ir=ir, max_steps=2 * steps + 100).run(np.array(rows, dtype=np.int64))
+    except Exception as e:
+        return Failure("rlsra", num_regs, "superblock batch interpreter crash", "".join(traceback.format_exception_only(e)).strip())
+    for row, e, r in zip(rows, expected_rows, results):
+        if e != r:
+            return Failure("rlsra", num_regs, "superblock batch mismatch", f"{row} : expected {e}, got {r}")
+
+    return None
+
+# Materializes the edge spills / restores / moves, after which the Interpreter must have nothing left to do when jumping
+def check_resolution(ir: Ir, allocator: str, num_regs: int) -> Failure | None:
+    try:
+        resolve_edges(ir)
+    except Exception as e:
+        return Failure(allocator, num_regs, "resolution crash", "".join(traceback.format_exception_only(e)).strip())
+
+    for block in ir.block_execution_order():
+        if block.active_in_set is None:
+            continue
+        for edge in block.outgoing_edges():
+            if has_annotations(*edge_resolution(edge.source.active_out_set, edge.target.active_in_set)):
+                return Failure(allocator, num_regs, "unresolved edge", f"BB{edge.source.il_idx} -> BB{edge.target.il_idx}")
+
+    return None
+
+# Runs the allocated ir over many random arguments at once with the BatchInterpreter
+def check_batch(fn: StackFunction, ir: Ir, allocator: str, num_regs: int, params: int, batch_lanes: int) -> Failure | None:
+    # Imported here so that numpy is only needed for batch checks
+    import numpy as np
+    from batch_interpreter import BatchInterpreter
+
+    rng = np.random.default_rng(batch_lanes)
+    args = rng.integers(-5, 6, size=(batch_lanes, params))
+
+    expected = []
+    for row in args:
+        try:
+            expected.append(StackInterpreter(fn, max_steps=100_000).run([int(arg) for arg in row]))
+        except Exception:
+            return None
+    if any(abs(e) >= 2**62 for e in expected):
+        # Wouldn't fit in the int64 lanes
+        return None
+
+    try:
+        results = BatchInterpreter(num_regs=num_regs, ir=ir).run(args)
+    except Exception as e:
+        return Failure(allocator, num_regs, "batch interpreter crash", "".join(traceback.format_exception_only(e)).strip())
+
+    for lane, (e, r) in enumerate(zip(expected, results)):
+        if e != r:
+            return Failure(allocator, num_regs, "batch mismatch", f"lane {lane} ({list(args[lane])}) : expected {e}, got {r}")
+
+    return None
+
+# Candidate simplifications of an expression, smallest first
+def shrink_expr(expr: Expr) -> Iterable[Expr]:
+    match expr:
+        case ConstExpr():
+            if expr.value != 0:
+                yield ConstExpr(0)
+        case LocalExpr():
+            yield ConstExpr(0)
+        case BinExpr():
+            yield ConstExpr(0)
+            yield expr.lhs
+            if expr.op not in [StackInstructionKind.Mul, StackInstructionKind.Div]:
+                yield expr.rhs
+            for lhs in shrink_expr(expr.lhs):
+                yield BinExpr(expr.op, lhs, expr.rhs)
+            if expr.op not in [StackInstructionKind.Mul, StackInstructionKind.Div]:
+                for rhs in shrink_expr(expr.rhs):
+                    yield BinExpr(expr.op, expr.lhs, rhs)
+        case CallExpr():
+            yield ConstExpr(0)
+            yield from expr.args
+            for i, arg in enumerate(expr.args):
+                for shrunk in shrink_expr(arg):
+                    yield CallExpr(expr.callee, expr.args[:i] + [shrunk] + expr.args[i + 1:])
+
+def shrink_body(body: list[Stmt]) -> Iterable[list[Stmt]]:
+    # Drop whole statements first
+    for i in range(len(body)):
+        yield body[:i] + body[i + 1:]
+
+    # Inline or simplify nested statements
+    for i, stmt in enumerate(body):
+        match stmt:
+            case IfStmt():
+                yield body[:i] + stmt.then_body + body[i + 1:]
+                yield body[:i] + stmt.else_body + body[i + 1:]
+                for cond in shrink_expr(stmt.cond):
+                    yield body[:i] + [IfStmt(cond, stmt.then_body, stmt.else_body)] + body[i + 1:]
+                for then_body in shrink_body(stmt.then_body):
+                    yield body[:i] + [IfStmt(stmt.cond, then_body, stmt.else_body)] + body[i + 1:]
+                for else_body in shrink_body(stmt.else_body):
+                    yield body[:i] + [IfStmt(stmt.cond, stmt.then_body, else_body)] + body[i + 1:]
+            case LoopStmt():
+                yield body[:i] + stmt.body + body[i + 1:]
+                if stmt.count > 1:
+                    yield body[:i] + [LoopStmt(stmt.counter, stmt.count - 1, stmt.body)] + body[i + 1:]
+                for loop_body in shrink_body(stmt.body):
+                    yield body[:i] + [LoopStmt(stmt.counter, stmt.count, loop_body)] + body[i + 1:]
+            case AssignStmt():
+                for expr in shrink_expr(stmt.expr):
+                    yield body[:i] + [AssignStmt(stmt.local, expr)] + body[i + 1:]
+            case DiscardStmt():
+                for expr in shrink_expr(stmt.expr):
+                    yield body[:i] + [DiscardStmt(expr)] + body[i + 1:]
+
+def shrink_program(program: FuzzProgram) -> Iterable[FuzzProgram]:
+    for body in shrink_body(program.body):
+        yield FuzzProgram(program.local_vars, body, program.ret, program.args)
+    for ret in shrink_expr(program.ret):
+        yield FuzzProgram(program.local_vars, program.body, ret, program.args)
+
+# Greedy shrinking : keep applying the first simplification that still fails the same way
+def shrink(program: FuzzProgram, failure: Failure, batch_lanes: int = 0, resolve: bool = False, spill_strategy: str = FurthestUse.name, calls: bool = False, reuse: bool = False, peephole: bool = False, superblocks: bool = False, max_attempts: int = 10_000) -> tuple[FuzzProgram, Failure]:
+    attempts = 0
+    progress = True
+    while progress and attempts < max_attempts:
+        progress = False
+        for candidate in shrink_program(program):
+            attempts += 1
+            candidate_failure = check_program(candidate, [failure.allocator], [failure.num_regs], batch_lanes, resolve, spill_strategy, calls, reuse, peephole, superblocks)
+            if candidate_failure is not None and candidate_failure.same_as(failure):
+                program = candidate
+                failure = candidate_failure
+                progress = True
+                break
+            if attempts >= max_attempts:
+                break
+
+    return program, failure
+
+@dataclasses.dataclass
+class FuzzConfig:
+    allocators: list[str]
+    num_regs_list: list[int]
+    shrink: bool
+    data_vars: int = 4
+    max_depth: int = 2
+    params: int = 2
+    batch_lanes: int = 0
+    resolve_edges: bool = False
+    spill_strategy: str = FurthestUse.name
+    # Generate calls, allocate and run with the default calling convention
+    calls: bool = False
+    # Allocate with the pool of the process, releasing every ir into it once checked
+    reuse: bool = False
+    # Run the peephole pass on the allocations (see peephole.py)
+    peephole: bool = False
+    # Also check Rlsra with superblocks (see check_superblocks)
+    superblocks: bool = False
+
+def fuzz_one(seed: int, config: FuzzConfig) -> FuzzResult:
+    program = ProgramGenerator(random.Random(seed), data_vars=config.data_vars, max_depth=config.max_depth, params=config.params, calls=config.calls).gen_program()
+    failure = check_program(program, config.allocators, config.num_regs_list, config.batch_lanes, config.resolve_edges, config.spill_strategy, config.calls, config.reuse, config.peephole, config.superblocks)
+    if failure is None:
+        return FuzzResult(seed=seed, failure=None, program=None, instructions=None)
+
+    if config.shrink:
+        program, failure = shrink(program, failure, config.batch_lanes, config.resolve_edges, config.spill_strategy, config.calls, config.reuse, config.peephole, config.superblocks)
+
+    return FuzzResult(seed=seed, failure=failure, program=program, instructions=compile_program(program).instructions)
+
+def _fuzz_one_star(args: tuple[int, FuzzConfig]) -> FuzzResult:
+    return fuzz_one(*args)
+
+def fuzz(seeds: Iterable[int], config: FuzzConfig, jobs: int | None = None) -> Iterable[FuzzResult]:
+    work = ((seed, config) for seed in seeds)
+    if jobs == 1:
+        yield from map(_fuzz_one_star, work)
+        return
+
+    with multiprocessing.Pool(processes=jobs) as pool:
+        yield from pool.imap_unordered(_fuzz_one_star, work, chunksize=8)
+
+# Formats instructions the same way they're written in main.py so that failures can be pasted as reproducers
+def format_instructions(instructions: list[StackInstruction]) -> str:
+    lines = []
+    for i, ins in enumerate(instructions):
+        lines.append(f"    StackInstruction(StackInstructionKind.{ins.kind.name}, {ins.operands}), # {i}")
+    return "[\n" + "\n".join(lines) + "\n]"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Differential fuzzing of the register allocators against a stack-based reference evaluator")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0, help="first seed, programs use consecutive seeds")
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes (defaults to the number of cores)")
+    parser.add_argument("--allocator", choices=ALLOCATORS, action="append", help="can be repeated, defaults to all allocators")
+    parser.add_argument("--regs", type=int, nargs="+", default=DEFAULT_NUM_REGS)
+    parser.add_argument("--vars", type=int, default=4, help="number of locals written by the programs (excluding loop counters)")
+    parser.add_argument("--depth", type=int, default=2, help="maximum nesting of ifs and loops")
+    parser.add_argument("--params", type=int, default=2, help="number of locals passed as arguments")
+    parser.add_argument("--batch", type=int, default=0, metavar="LANES", help="also check the BatchInterpreter over this many random arguments (needs numpy)")
+    parser.add_argument("--resolve-edges", action="store_true", help="materialize the edge spills / restores / moves (splitting critical edges) before running")
+    parser.add_argument("--strategy", choices=SPILL_STRATEGIES.keys(), default=FurthestUse.name, help="spill heuristic used by the allocators")
+    parser.add_argument("--calls", action="store_true", help="generate calls, and allocate and run the programs with the default calling convention (divisions get fixed registers too)")
+    parser.add_argument("--reuse", action="store_true", help="allocate with a pool shared by all the programs of a process, releasing every ir into it once checked")
+    parser.add_argument("--peephole", action="store_true", help="remove the redundant spills / restores / moves of the allocations before running them")
+    parser.add_argument("--superblocks", action="store_true", help="also form superblocks from the traces of rlsra runs with the arguments of the programs, and run them with other arguments (and over the BatchInterpreter with --batch)")
+    parser.add_argument("--no-shrink", action="store_true")
+    args = parser.parse_args()
+
+    config = FuzzConfig(
+        allocators=args.allocator or ALLOCATORS,
+        num_regs_list=args.regs,
+        shrink=not args.no_shrink,
+        data_vars=args.vars,
+        max_depth=args.depth,
+        params=args.params,
+        batch_lanes=args.batch,
+        resolve_edges=args.resolve_edges,
+        spill_strategy=args.strategy,
+        calls=args.calls,
+        reuse=args.reuse,
+        peephole=args.peephole,
+        superblocks=args.superblocks,
+    )
+
+    failures = 0
+    for result in fuzz(range(args.seed, args.seed + args.iterations), config, jobs=args.jobs):
+        if result.failure is None:
+            continue
+
+        failures += 1
+        f = result.failure
+        print(f"seed {result.seed} : {f.kind} with {f.allocator} ({f.num_regs} regs) : {f.message}")
+        print(f"local_vars = {result.program.local_vars}, args = {result.program.args}")
+        print("ins: list[StackInstruction] = " + format_instructions(result.instructions))
+        print()
+
+    print(f"{args.iterations} programs, {failures} failures")
+    exit(1 if failures != 0 else 0)
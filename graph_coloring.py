@@ -0,0 +1,362 @@
+from __future__ import annotations
+import dataclasses
+import enum
+from ir import *
+from rlsra import Value, RegSpill, RegRestore, RegMove, ActiveInOut
+from spill_strategy import block_frequency
+
+# Chaitin-Briggs graph coloring allocator : slower than the linear scans, but allocates the whole function at once.
+# - Live ranges : every local (for the whole function), every tree temp, and short reload ranges for operands that are
+#   in memory
+# - Interference graph with bitset adjacency (python ints)
+# - Conservative (Briggs) coalescing of the local stores, optimistic coloring, and spilling of the uncolored live ranges
+#   (spill everywhere) until everything gets a register
+# A local gets a single register for the whole function, or lives in memory for the whole function. Since registers are
+# the same everywhere, all the blocks have the same active sets and nothing happens on the edges.
+#
+# Program points : every tree uses its operands, then defines its value. Operands can be reused for the result
+# A value read from memory is restored right before the tree using it, so its reload range only covers that use
+
+class LiveRangeKind(enum.Enum):
+    Local = enum.auto()
+    Temp = enum.auto()
+    # Operand restored from memory right before its use
+    Reload = enum.auto()
+
+@dataclasses.dataclass(eq=False)
+class LiveRange:
+    kind: LiveRangeKind
+    # Local, or tree (the temp, or the operand that gets reloaded)
+    of: int | Tree
+    # Frequency weighted number of definitions and uses, infinite for ranges that can't get shorter by spilling them
+    cost: float
+
+    def spillable(self) -> bool:
+        return self.cost != float("inf")
+
+def bits(bitset: int) -> Iterable[int]:
+    while bitset != 0:
+        low = bitset & -bitset
+        yield low.bit_length() - 1
+        bitset ^= low
+
+class GraphColoring:
+    num_regs: int
+    var_vals: list[Value]
+    tree_vals: dict[int, Value]
+
+    # Rebuilt every round
+    ranges: list[LiveRange]
+    adjacency: list[int]
+    # Local stores (dst, src) : candidates for coalescing
+    moves: list[tuple[int, int]]
+    local_ranges: dict[int, int]
+    # By tree id
+    temp_ranges: dict[int, int]
+    reload_ranges: dict[int, int]
+    dead_stores: set[int]
+
+    # What got spilled in the previous rounds
+    spilled_locals: set[int]
+    spilled_temps: set[int]
+
+    # Coalesced live range -> live range it was merged into
+    alias: list[int]
+    colors: dict[int, int]
+
+    # Statistics
+    rounds: int
+    coalesced: int
+
+    def __init__(self, num_regs: int) -> None:
+        assert num_regs >= 2, "binary operations need two registers"
+        self.num_regs = num_regs
+        self.var_vals = []
+        self.tree_vals = dict()
+        self.spilled_locals = set()
+        self.spilled_temps = set()
+        self.rounds = 0
+        self.coalesced = 0
+
+    def new_range(self, kind: LiveRangeKind, of: int | Tree, cost: float) -> int:
+        self.ranges.append(LiveRange(kind=kind, of=of, cost=cost))
+        self.adjacency.append(0)
+        return len(self.ranges) - 1
+
+    def interfere(self, a: int, live: Iterable[int]) -> None:
+        for b in live:
+            if a != b:
+                self.adjacency[a] |= 1 << b
+                self.adjacency[b] |= 1 << a
+
+    def local_range(self, local: int) -> int:
+        if local not in self.local_ranges:
+            self.local_ranges[local] = self.new_range(LiveRangeKind.Local, local, 0.0)
+        return self.local_ranges[local]
+
+    # Live range the parent reads the operand from, creating it if needed
+    def operand_range(self, subtree: Tree, frequency: int) -> int:
+        if subtree.kind == TreeKind.LdLocal:
+            local = subtree.operands[0]
+            if local in self.spilled_locals:
+                self.reload_ranges[id(subtree)] = self.new_range(LiveRangeKind.Reload, subtree, float("inf"))
+                return self.reload_ranges[id(subtree)]
+
+            r = self.local_range(local)
+            self.ranges[r].cost += frequency
+            return r
+
+        if id(subtree) in self.spilled_temps:
+            self.reload_ranges[id(subtree)] = self.new_range(LiveRangeKind.Reload, subtree, float("inf"))
+            return self.reload_ranges[id(subtree)]
+
+        # The temp range is created when reaching its use : we're going backwards
+        cost = 2 * frequency
+        self.temp_ranges[id(subtree)] = self.new_range(LiveRangeKind.Temp, subtree, cost)
+        return self.temp_ranges[id(subtree)]
+
+    def build(self, ir: Ir) -> None:
+        self.ranges = []
+        self.adjacency = []
+        self.moves = []
+        self.local_ranges = dict()
+        self.temp_ranges = dict()
+        self.reload_ranges = dict()
+        self.dead_stores = set()
+
+        for block in ir.block_execution_order():
+            frequency = block_frequency(block)
+
+            live = set()
+            for local in block.alive_out_set:
+                if local not in self.spilled_locals:
+                    live.add(self.local_range(local))
+
+            for tree in block.tree_reverse_execution_order():
+                if tree.kind == TreeKind.LdLocal:
+                    # Used by the parent
+                    continue
+
+                # Definition
+                src = None
+                if tree.kind == TreeKind.StLocal:
+                    local = tree.operands[0]
+                    if local not in self.spilled_locals:
+                        dst = self.local_range(local)
+                        if dst not in live:
+                            self.dead_stores.add(id(tree))
+                        else:
+                            src = self.operand_range(tree.subtrees[0], frequency)
+                            # The source and the local hold the same value : no interference (a copy between locals
+                            # can let both stay alive)
+                            self.interfere(dst, live - {src})
+                            live.discard(dst)
+                            self.ranges[dst].cost += frequency
+                            self.moves.append((dst, src))
+                elif tree.parent != None:
+                    if id(tree) in self.spilled_temps:
+                        # Only alive between its definition and the spill right after
+                        r = self.new_range(LiveRangeKind.Temp, tree, float("inf"))
+                        self.temp_ranges[id(tree)] = r
+                    else:
+                        r = self.temp_ranges[id(tree)]
+                    self.interfere(r, live)
+                    live.discard(r)
+
+                # Uses
+                reloads = []
+                for subtree in tree.subtrees:
+                    r = src if src != None else self.operand_range(subtree, frequency)
+                    live.add(r)
+                    if self.ranges[r].kind == LiveRangeKind.Reload:
+                        reloads.append(r)
+
+                for r in reloads:
+                    self.interfere(r, live)
+                for r in reloads:
+                    live.discard(r)
+
+            if block is ir.blocks.first:
+                # Interferences are added at definitions, but the arguments (and uninitialized locals) are never defined
+                for r in live:
+                    self.interfere(r, live)
+
+    def find(self, r: int) -> int:
+        while self.alias[r] != r:
+            self.alias[r] = self.alias[self.alias[r]]
+            r = self.alias[r]
+        return r
+
+    def degree(self, r: int) -> int:
+        return self.adjacency[r].bit_count()
+
+    # Briggs : merging is safe if the merged range has less than num_regs neighbors with a significant degree
+    def can_coalesce(self, a: int, b: int) -> bool:
+        if (self.adjacency[a] >> b) & 1:
+            return False
+        if not self.ranges[a].spillable() or not self.ranges[b].spillable():
+            # Would make a long range unspillable, biased coloring handles these instead
+            return False
+
+        significant = 0
+        for neighbor in bits(self.adjacency[a] | self.adjacency[b]):
+            if self.degree(neighbor) >= self.num_regs:
+                significant += 1
+        return significant < self.num_regs
+
+    def merge(self, a: int, b: int) -> None:
+        self.alias[b] = a
+        self.ranges[a].cost += self.ranges[b].cost
+        for neighbor in bits(self.adjacency[b]):
+            self.adjacency[neighbor] = (self.adjacency[neighbor] & ~(1 << b)) | (1 << a)
+        self.adjacency[a] |= self.adjacency[b]
+        self.adjacency[b] = 0
+
+    def coalesce(self) -> None:
+        self.alias = list(range(len(self.ranges)))
+
+        change_occured = True
+        while change_occured:
+            change_occured = False
+            for a, b in self.moves:
+                a = self.find(a)
+                b = self.find(b)
+                if a != b and self.can_coalesce(a, b):
+                    self.merge(min(a, b), max(a, b))
+                    self.coalesced += 1
+                    change_occured = True
+
+    # Simplify / select with optimistic coloring. Returns the live ranges that didn't get a color
+    def color(self) -> list[int]:
+        remaining = 0
+        for r in range(len(self.ranges)):
+            if self.find(r) == r:
+                remaining |= 1 << r
+
+        stack = []
+        while remaining != 0:
+            pick = None
+            for r in bits(remaining):
+                if (self.adjacency[r] & remaining).bit_count() < self.num_regs:
+                    pick = r
+                    break
+
+            if pick == None:
+                # Blocked : push the cheapest spill candidate, it may still get a color (optimistic)
+                candidates = [r for r in bits(remaining) if self.ranges[r].spillable()] or list(bits(remaining))
+                pick = min(candidates, key=lambda r: self.ranges[r].cost / max(1, (self.adjacency[r] & remaining).bit_count()))
+
+            stack.append(pick)
+            remaining &= ~(1 << pick)
+
+        # Preferred colors : the colors of the ranges a store moves to or from
+        partners: dict[int, list[int]] = {}
+        for a, b in self.moves:
+            a = self.find(a)
+            b = self.find(b)
+            if a != b:
+                partners.setdefault(a, []).append(b)
+                partners.setdefault(b, []).append(a)
+
+        self.colors = dict()
+        uncolored = []
+        while len(stack) != 0:
+            r = stack.pop()
+            used = set(self.colors[neighbor] for neighbor in bits(self.adjacency[r]) if neighbor in self.colors)
+
+            preferred = [self.colors[p] for p in partners.get(r, []) if p in self.colors and self.colors[p] not in used]
+            if len(preferred) != 0:
+                self.colors[r] = preferred[0]
+                continue
+
+            free = [reg for reg in range(self.num_regs) if reg not in used]
+            if len(free) == 0:
+                uncolored.append(r)
+            else:
+                self.colors[r] = free[0]
+
+        return uncolored
+
+    def color_of(self, r: int) -> int:
+        return self.colors[self.find(r)]
+
+    def tree_val(self, tree: Tree) -> Value:
+        if id(tree) not in self.tree_vals:
+            self.tree_vals[id(tree)] = Value(of=tree, active_in=None, last_use=None)
+        return self.tree_vals[id(tree)]
+
+    # Turns the coloring into register annotations
+    def annotate(self, ir: Ir) -> None:
+        for tree in ir.tree_execution_order():
+            if tree.kind == TreeKind.LdLocal:
+                local = tree.operands[0]
+                if local in self.spilled_locals:
+                    tree.reg = self.color_of(self.reload_ranges[id(tree)])
+                    tree.parent.pre_restores.append(RegRestore(val=self.var_vals[local], reg=tree.reg))
+                else:
+                    tree.reg = self.color_of(self.local_ranges[local])
+                tree.use_reg = tree.reg
+            elif tree.kind == TreeKind.StLocal:
+                if id(tree) in self.dead_stores:
+                    continue
+
+                local = tree.operands[0]
+                subtree = tree.subtrees[0]
+                if local in self.spilled_locals:
+                    tree.post_spills.append(RegSpill(val=self.var_vals[local], reg=subtree.use_reg))
+                else:
+                    reg = self.color_of(self.local_ranges[local])
+                    if reg != subtree.use_reg:
+                        src_val = self.var_vals[subtree.operands[0]] if subtree.kind == TreeKind.LdLocal else self.tree_val(subtree)
+                        tree.post_moves.append(RegMove(val_from=src_val, reg_from=subtree.use_reg, val_to=self.var_vals[local], reg_to=reg))
+            elif tree.parent != None:
+                tree.reg = self.color_of(self.temp_ranges[id(tree)])
+                tree.use_reg = tree.reg
+                if id(tree) in self.spilled_temps:
+                    tree.post_spills.append(RegSpill(val=self.tree_val(tree), reg=tree.reg))
+                    tree.use_reg = self.color_of(self.reload_ranges[id(tree)])
+                    tree.parent.pre_restores.append(RegRestore(val=self.tree_val(tree), reg=tree.use_reg))
+
+        # Every local keeps its register everywhere
+        colored = [local for local in self.local_ranges if local not in self.spilled_locals]
+        for block in ir.block_execution_order():
+            block.active_out_set = [ActiveInOut(val=self.var_vals[local], reg=self.color_of(self.local_ranges[local])) for local in colored]
+            if block is ir.blocks.first:
+                # Only the locals that are alive hold something (the arguments)
+                block.active_in_set = [active for active in block.active_out_set if active.val.of in block.alive_in_set]
+            else:
+                block.active_in_set = block.active_out_set[:]
+
+    # Preconditions : recompute_predecessors, recompute_alive_sets, reindex all executed
+    def do_graph_coloring(self, ir: Ir) -> None:
+        if len(ir.blocks.first.predecessors) != 0:
+            # The first block needs its own active in set for the arguments, no edge can go there
+            ir.insert_entry_block()
+            ir.recompute_predecessors()
+            ir.recompute_alive_sets()
+            ir.reindex()
+
+        for i in range(ir.local_vars):
+            self.var_vals.append(Value(of=i, active_in=None, last_use=None))
+
+        while True:
+            self.rounds += 1
+            self.build(ir)
+            self.coalesce()
+            uncolored = self.color()
+            if len(uncolored) == 0:
+                break
+
+            # Spill everywhere, the next round gets short reload ranges instead
+            for r in uncolored:
+                for member in range(len(self.ranges)):
+                    if self.find(member) != r:
+                        continue
+                    live_range = self.ranges[member]
+                    assert live_range.spillable(), "unspillable live range couldn't be colored"
+                    if live_range.kind == LiveRangeKind.Local:
+                        self.spilled_locals.add(live_range.of)
+                    else:
+                        self.spilled_temps.add(id(live_range.of))
+
+        self.annotate(ir)
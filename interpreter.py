@@ -1,5 +1,49 @@
+import dataclasses
 from ir import *
 
+# Traces longer than this are given up (ex : an outer loop whose inner loop runs many times)
+MAX_TRACE_EDGES = 32
+
+# Latencies of a simulated target, in cycles. LdLocals, StLocals and Discards cost nothing, their work is done by the
+# spills, restores and moves the allocator puts around them
+@dataclasses.dataclass
+class CycleCosts:
+    binops: dict[Operator, int] = dataclasses.field(default_factory=lambda: {
+        Operator.Add: 1,
+        Operator.Sub: 1,
+        Operator.Mul: 3,
+        Operator.Div: 20,
+        Operator.Eq: 1,
+    })
+    const: int = 1
+    call: int = 10
+    # Branches and guards, taken or not
+    branch: int = 1
+    ret: int = 1
+    move: int = 1
+    # Stores to the stack frame, and loads from it
+    spill: int = 3
+    restore: int = 4
+    # Jumps that don't fall through to the next block : Jmps to another block, taken Branches and side exits. Going on
+    # with the next block costs nothing
+    taken_jump: int = 2
+
+# Cycles spent in a block, over all its executions
+@dataclasses.dataclass
+class BlockCycles:
+    entries: int = 0
+    # BinOps, Consts, calls, branches and returns
+    ops: int = 0
+    spills: int = 0
+    restores: int = 0
+    moves: int = 0
+    jumps: int = 0
+    # Spills, restores and moves resolving the edges leaving the block (see Interpreter.jump)
+    edges: int = 0
+
+    def total(self) -> int:
+        return self.ops + self.spills + self.restores + self.moves + self.jumps + self.edges
+
 class Interpreter:
     ir: Ir
     registers: list[int]
@@ -9,25 +53,150 @@ class Interpreter:
     spill_count: int
     restore_count: int
     move_count: int
+    max_steps: int | None
+    step_count: int
+    # Profiling (see tiering.py) : entries of every block by block id, and jumps going backwards in the block order (loop
+    # iterations). None when not profiling
+    block_entries: dict[int, int] | None
+    back_edge_count: int
+    # Trace recording (see superblock.py) : jumps going backwards count the entries of their target (a loop header). Once
+    # a header reaches the threshold, the edges taken from it until coming back to it are recorded as a trace. None when
+    # not recording
+    trace_threshold: int | None
+    header_counts: dict[int, int]
+    # Headers that already have a trace (or a recording that was given up), by block id
+    traced_headers: set[int]
+    recording: list[BlockEdge] | None
+    traces: list[list[BlockEdge]]
+    jump_count: int
+    # Register constraints of calls and divisions, checked at every constrained tree. None when the ir was allocated without
+    # a convention
+    convention: CallingConvention | None
+    # Two-address BinOps : the result must be written to the register the left operand is read from (the allocator copies
+    # the operand there when it's needed afterwards)
+    two_address: bool
+    # BinOps whose result register isn't the one of their left operand : a two-address target needs a copy before each of
+    # them
+    tied_copy_count: int
+    # Cycle model : the cycles of every block by block id. None when not counting cycles
+    costs: CycleCosts | None
+    block_cycles: dict[int, BlockCycles]
 
-    def __init__(self, num_regs: int, ir: Ir) -> None:
+    def __init__(self, num_regs: int, ir: Ir, max_steps: int | None = None, profile: bool = False, trace_threshold: int | None = None, convention: CallingConvention | None = None, two_address: bool = False, costs: CycleCosts | None = None) -> None:
         self.ir = ir
         self.registers = [None for _ in range(num_regs)]
-        self.spilled_local_vals = dict()
+        # Locals that were never written hold garbage : restoring them is fine as long as the garbage isn't used
+        self.spilled_local_vals = {i: None for i in range(ir.local_vars)}
         self.spilled_tree_vals = dict()
         self.current_block = ir.blocks.first
 
         self.spill_count = 0
         self.restore_count = 0
         self.move_count = 0
+
+        self.max_steps = max_steps
+        self.step_count = 0
+
+        self.block_entries = dict() if profile else None
+        self.back_edge_count = 0
+
+        self.trace_threshold = trace_threshold
+        self.header_counts = dict()
+        self.traced_headers = set()
+        self.recording = None
+        self.traces = []
+        self.jump_count = 0
+
+        self.convention = convention
+        self.two_address = two_address
+        self.tied_copy_count = 0
+
+        self.costs = costs
+        self.block_cycles = dict()
+
+    def cycles_of(self, block: BasicBlock) -> BlockCycles:
+        cycles = self.block_cycles.get(id(block))
+        if cycles is None:
+            cycles = BlockCycles()
+            self.block_cycles[id(block)] = cycles
+        return cycles
+
+    # Cycles of the whole function, over all the runs
+    def cycles(self) -> int:
+        return sum(cycles.total() for cycles in self.block_cycles.values())
+
+    # Cycles of the spills, restores and moves of an annotation list
+    def annotation_cycles(self, cycles: BlockCycles, spills: list, restores: list, moves: list) -> None:
+        cycles.spills += len(spills) * self.costs.spill
+        cycles.restores += len(restores) * self.costs.restore
+        cycles.moves += len(moves) * self.costs.move
+
+    def tree_cycles(self, tree: Tree) -> int:
+        match tree.kind:
+            case TreeKind.BinOp:
+                return self.costs.binops[tree.operands[0]]
+            case TreeKind.Const:
+                return self.costs.const
+            case TreeKind.Call:
+                return self.costs.call
+            case TreeKind.Branch | TreeKind.Guard:
+                return self.costs.branch
+            case TreeKind.Ret:
+                return self.costs.ret
+        return 0
     
+    def record_trace(self, edge: BlockEdge) -> None:
+        if self.recording is not None:
+            self.recording.append(edge)
+            if edge.target is self.recording[0].source:
+                self.traces.append(self.recording)
+                self.recording = None
+            elif len(self.recording) >= MAX_TRACE_EDGES:
+                self.recording = None
+            return
+
+        backwards = edge.target.il_idx < edge.source.il_idx or edge.target is edge.source
+        if not backwards or id(edge.target) in self.traced_headers:
+            return
+
+        count = self.header_counts.get(id(edge.target), 0) + 1
+        self.header_counts[id(edge.target)] = count
+        if count >= self.trace_threshold:
+            self.traced_headers.add(id(edge.target))
+            self.recording = []
+
+    # The operands must have been read from and the result written to the registers of the convention. The other clobbered
+    # registers lose their values
+    def check_constraints(self, tree: Tree) -> None:
+        for subtree, reg in zip(tree.subtrees, self.convention.operand_regs(tree)):
+            if reg is not None and subtree.use_reg != reg:
+                raise Exception(f"operand of tree {tree.ir_idx} read from r{subtree.use_reg} instead of r{reg}")
+        if tree.reg != self.convention.result_reg(tree):
+            raise Exception(f"result of tree {tree.ir_idx} written to r{tree.reg} instead of r{self.convention.result_reg(tree)}")
+
+        for reg in self.convention.clobbered_regs(tree):
+            if reg != tree.reg:
+                self.registers[reg] = None
+
     def jump(self, edge: BlockEdge) -> None:
         self.current_block = edge.target
+        self.jump_count += 1
+
+        if self.trace_threshold is not None:
+            self.record_trace(edge)
+
+        if self.block_entries is not None:
+            self.block_entries[id(edge.target)] = self.block_entries.get(id(edge.target), 0) + 1
+            # Blocks inserted by edge splitting share the index of their target, they don't go backwards
+            if edge.target.il_idx < edge.source.il_idx or edge.target is edge.source:
+                self.back_edge_count += 1
 
-        active_out_set = edge.source.active_out_set
+        # Side exits leave from the middle of the block
+        active_out_set = edge.active_out_set if edge.active_out_set is not None else edge.source.active_out_set
         active_in_set = edge.target.active_in_set
 
         new_registers = self.registers[:]
+        counts = (self.spill_count, self.restore_count, self.move_count)
 
         for active_out in active_out_set:
             if not any (active_out.val.of == active_in.val.of for active_in in active_in_set):
@@ -41,15 +210,51 @@ class Interpreter:
         
         for active_out in active_out_set:
             for active_in in active_in_set:
-                if active_out.val.of == active_in.val.of:
+                # A value staying in the same register doesn't need a move
+                if active_out.val.of == active_in.val.of and active_out.reg != active_in.reg:
                     new_registers[active_in.reg] = self.registers[active_out.reg]
                     self.move_count += 1
             
         self.registers = new_registers
 
-    def run(self) -> int:
+        if self.costs is not None:
+            source = self.cycles_of(edge.source)
+            source.edges += (self.spill_count - counts[0]) * self.costs.spill + (self.restore_count - counts[1]) * self.costs.restore + (self.move_count - counts[2]) * self.costs.move
+            # Side exits leave from the middle of the block, they never fall through
+            if edge.target is not edge.source.next_block or any(edge is side_exit for side_exit in edge.source.side_exits):
+                source.jumps += self.costs.taken_jump
+            self.cycles_of(edge.target).entries += 1
+
+    # Seeds the first locals with the arguments, where the entry block expects them (in memory or in a register)
+    def enter(self, args: list[int]) -> None:
+        assert len(args) <= self.ir.local_vars, "too many arguments"
+
+        for i, arg in enumerate(args):
+            self.spilled_local_vals[i] = arg
+
+        if self.block_entries is not None:
+            first = self.ir.blocks.first
+            self.block_entries[id(first)] = self.block_entries.get(id(first), 0) + 1
+
+        for active_in in self.ir.blocks.first.active_in_set:
+            if active_in.val.of < len(args):
+                self.registers[active_in.reg] = args[active_in.val.of]
+
+        if self.costs is not None:
+            self.cycles_of(self.ir.blocks.first).entries += 1
+
+    def run(self, args: list[int] = []) -> int:
+        self.enter(args)
+
         while True:
+            cycles = self.cycles_of(self.current_block) if self.costs is not None else None
             for tree in self.current_block.tree_execution_order():
+                self.step_count += 1
+                if self.max_steps is not None and self.step_count > self.max_steps:
+                    raise Exception("Step limit exceeded")
+
+                taken_edge = None
+
                 # Pre spills, restores, moves
                 new_registers = self.registers[:]
 
@@ -73,6 +278,10 @@ class Interpreter:
                 
                 self.registers = new_registers
 
+                if cycles is not None:
+                    self.annotation_cycles(cycles, tree.pre_spills, tree.pre_restores, tree.pre_moves)
+                    cycles.ops += self.tree_cycles(tree)
+
                 match tree.kind:
                     case TreeKind.LdLocal:
                         # Handled by the reg allocator
@@ -86,8 +295,12 @@ class Interpreter:
                         # Do nothing
                         pass
                     case TreeKind.BinOp:
-                        lhs = self.registers[tree.subtrees[0].reg]
-                        rhs = self.registers[tree.subtrees[1].reg]
+                        lhs = self.registers[tree.left_operand().use_reg]
+                        rhs = self.registers[tree.right_operand().use_reg]
+                        if tree.reg != tree.left_operand().use_reg:
+                            if self.two_address:
+                                raise Exception(f"tree {tree.ir_idx} writes r{tree.reg} instead of its left operand r{tree.left_operand().use_reg}")
+                            self.tied_copy_count += 1
 
                         match tree.operands[0]:
                             case Operator.Add:
@@ -102,15 +315,24 @@ class Interpreter:
                                 res = 1 if lhs == rhs else 0
                         
                         self.registers[tree.reg] = res
+                    case TreeKind.Call:
+                        callee = CALLEES[tree.operands[0]][1]
+                        self.registers[tree.reg] = callee(*[self.registers[subtree.use_reg] for subtree in tree.subtrees])
                     case TreeKind.Ret:
-                        return self.registers[tree.subtrees[0].reg]
+                        return self.registers[tree.subtrees[0].use_reg]
                     case TreeKind.Branch:
-                        if self.registers[tree.subtrees[0].reg] == 1:
-                            self.jump(tree.operands[0])
+                        if self.registers[tree.subtrees[0].use_reg] == 1:
+                            taken_edge = tree.operands[0]
                         else:
-                            self.jump(tree.operands[1])
+                            taken_edge = tree.operands[1]
                     case TreeKind.Jmp:
-                        self.jump(tree.operands[0])
+                        taken_edge = tree.operands[0]
+                    case TreeKind.Guard:
+                        if (self.registers[tree.subtrees[0].use_reg] == 1) != (tree.operands[1] == 1):
+                            taken_edge = tree.operands[0]
+
+                if self.convention is not None and self.convention.constrained(tree):
+                    self.check_constraints(tree)
 
                 # Post spills, restores, moves
                 new_registers = self.registers[:]
@@ -133,4 +355,13 @@ class Interpreter:
                     new_registers[move.reg_to] = self.registers[move.reg_from]
                     self.move_count += 1
                 
-                self.registers = new_registers
\ No newline at end of file
+                self.registers = new_registers
+
+                if cycles is not None:
+                    self.annotation_cycles(cycles, tree.post_spills, tree.post_restores, tree.post_moves)
+
+                # Jump once the terminator's post spills, restores and moves are done : they still belong to this block. The
+                # rest of the block is skipped when a guard takes its side exit
+                if taken_edge is not None:
+                    self.jump(taken_edge)
+                    break
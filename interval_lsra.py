@@ -0,0 +1,286 @@
+from __future__ import annotations
+import bisect
+import dataclasses
+import enum
+import heapq
+import operator
+from ir import *
+from rlsra import Value, RegSpill, RegRestore, RegMove, ActiveInOut
+
+# Interval based linear scan (Poletto & Sarkar) : the cheapest allocator, for huge functions where allocation time
+# matters more than the quality of the spills.
+# - Every value gets a single live interval over the global numbering of the trees (Ir.reindex), from its first to its
+#   last reference, holes included. Locals also cover the blocks where they are alive
+# - Intervals are sorted once by start point and allocated in a single pass, with the active intervals sorted by end point
+# - When no register is free, the interval ending last is spilled : from that point to its end it lives in memory, every
+#   later use is restored into a short reload interval that goes through the same scan
+# Locations only depend on the position in the function, the active sets of every block are the locations at its start
+# and end, and the jumps resolve the differences between blocks.
+#
+# Positions (4 per tree) :
+# - 4 * idx     : start of the block, if the tree is its first one
+# - 4 * idx + 1 : the tree reads its operands (and the restores of the operands happen right before)
+# - 4 * idx + 2 : the tree defines its value. Operands can be reused for the result
+# - 4 * idx + 3 : end of the block, if the tree is its last one
+
+def use_position(tree: Tree) -> int:
+    return 4 * tree.ir_idx + 1
+
+def def_position(tree: Tree) -> int:
+    return 4 * tree.ir_idx + 2
+
+class IntervalKind(enum.Enum):
+    Local = enum.auto()
+    Temp = enum.auto()
+    # Operand restored from memory right before its use
+    Reload = enum.auto()
+    # Temp that lives in memory : only needs a register where it's defined, it's spilled right after
+    Def = enum.auto()
+
+@dataclasses.dataclass(eq=False, slots=True)
+class Interval:
+    kind: IntervalKind
+    # Local, or tree (the temp, or the tree using the reloaded operand)
+    of: int | Tree
+    start: int
+    end: int
+    # Positions where the value is read
+    uses: set[int] = dataclasses.field(default_factory=set)
+    reg: int | None = None
+    # Position from which the value lives in memory
+    spilled_at: int | None = None
+
+    def spillable(self) -> bool:
+        return self.kind == IntervalKind.Local or self.kind == IntervalKind.Temp
+
+    def in_register(self, position: int) -> bool:
+        return self.reg != None and (self.spilled_at == None or position < self.spilled_at)
+
+interval_end = operator.attrgetter("end")
+
+class IntervalLsra:
+    num_regs: int
+    var_vals: list[Value]
+    tree_vals: dict[int, Value]
+
+    intervals: list[Interval]
+    local_intervals: dict[int, Interval]
+    # By tree id
+    temp_intervals: dict[int, Interval]
+    def_intervals: dict[int, Interval]
+    # By (id of the spilled interval, use position)
+    reload_intervals: dict[tuple[int, int], Interval]
+    # Start and end positions, by block id
+    block_positions: dict[int, tuple[int, int]]
+    # All the trees, by ir_idx
+    trees: list[Tree]
+
+    # Intervals created during the scan (reloads and definitions), as a heap by start position
+    pending: list[tuple[int, int, Interval]]
+    pending_count: int
+    active: list[Interval]
+    free_regs: list[int]
+    # Intervals moved to memory : (interval, position)
+    evictions: list[tuple[Interval, int]]
+
+    def __init__(self, num_regs: int) -> None:
+        assert num_regs >= 2, "binary operations need two registers"
+        self.num_regs = num_regs
+        self.var_vals = []
+        self.tree_vals = dict()
+        self.intervals = []
+        self.local_intervals = dict()
+        self.temp_intervals = dict()
+        self.def_intervals = dict()
+        self.reload_intervals = dict()
+        self.block_positions = dict()
+        self.trees = []
+        self.pending = []
+        self.pending_count = 0
+        self.active = []
+        self.free_regs = list(range(num_regs))
+        self.evictions = []
+
+    def extend_local(self, local: int, position: int) -> Interval:
+        interval = self.local_intervals.get(local)
+        if interval == None:
+            interval = Interval(kind=IntervalKind.Local, of=local, start=position, end=position)
+            self.local_intervals[local] = interval
+            self.intervals.append(interval)
+        elif position < interval.start:
+            interval.start = position
+        elif position > interval.end:
+            interval.end = position
+        return interval
+
+    def build_intervals(self, ir: Ir) -> None:
+        for block in ir.block_execution_order():
+            trees = list(block.tree_execution_order())
+            if len(trees) == 0:
+                continue
+            self.trees.extend(trees)
+
+            start = 4 * trees[0].ir_idx
+            end = 4 * trees[-1].ir_idx + 3
+            self.block_positions[id(block)] = (start, end)
+
+            if block.alive_in_set != None:
+                for local in block.alive_in_set:
+                    self.extend_local(local, start)
+                for local in block.alive_out_set:
+                    self.extend_local(local, end)
+
+            for tree in trees:
+                if tree.kind == TreeKind.LdLocal:
+                    # The value is read by the parent, the local must stay where it is until then
+                    position = use_position(tree.parent)
+                    self.extend_local(tree.operands[0], position).uses.add(position)
+                elif tree.kind == TreeKind.StLocal:
+                    self.extend_local(tree.operands[0], def_position(tree))
+                elif tree.parent != None:
+                    position = use_position(tree.parent)
+                    interval = Interval(kind=IntervalKind.Temp, of=tree, start=def_position(tree), end=position, uses={position})
+                    self.temp_intervals[id(tree)] = interval
+                    self.intervals.append(interval)
+
+        self.intervals.sort(key=lambda interval: interval.start)
+
+    def add_pending(self, interval: Interval) -> None:
+        # The counter keeps the creation order between intervals starting at the same position
+        heapq.heappush(self.pending, (interval.start, self.pending_count, interval))
+        self.pending_count += 1
+
+    # The interval lives in memory from the position on, its later uses get reload intervals
+    def spill(self, interval: Interval, position: int) -> None:
+        interval.spilled_at = position
+        self.evictions.append((interval, position))
+
+        if interval.kind == IntervalKind.Temp and interval.reg == None:
+            # Still has to be written somewhere when it's computed
+            def_interval = Interval(kind=IntervalKind.Def, of=interval.of, start=interval.start, end=interval.start)
+            self.def_intervals[id(interval.of)] = def_interval
+            self.add_pending(def_interval)
+
+        for use in sorted(interval.uses):
+            if use > position:
+                reload = Interval(kind=IntervalKind.Reload, of=interval.of, start=use, end=use, uses={use})
+                self.reload_intervals[(id(interval), use)] = reload
+                self.add_pending(reload)
+
+    def expire(self, position: int) -> None:
+        expired = 0
+        while expired < len(self.active) and self.active[expired].end < position:
+            heapq.heappush(self.free_regs, self.active[expired].reg)
+            expired += 1
+        del self.active[:expired]
+
+    def allocate(self, interval: Interval) -> None:
+        self.expire(interval.start)
+
+        if len(self.free_regs) != 0:
+            interval.reg = heapq.heappop(self.free_regs)
+            bisect.insort(self.active, interval, key=interval_end)
+            return
+
+        # The active interval ending last, that isn't read right here
+        victim = None
+        for active in reversed(self.active):
+            if active.spillable() and interval.start not in active.uses:
+                victim = active
+                break
+
+        if interval.spillable() and (victim == None or victim.end <= interval.end):
+            self.spill(interval, interval.start)
+            return
+
+        assert victim != None, "no register can be freed for an operand"
+        self.active.remove(victim)
+        interval.reg = victim.reg
+        self.spill(victim, interval.start)
+        bisect.insort(self.active, interval, key=interval_end)
+
+    def scan(self) -> None:
+        i = 0
+        while i < len(self.intervals) or len(self.pending) != 0:
+            if len(self.pending) != 0 and (i == len(self.intervals) or self.pending[0][0] <= self.intervals[i].start):
+                self.allocate(heapq.heappop(self.pending)[2])
+            else:
+                self.allocate(self.intervals[i])
+                i += 1
+
+    def tree_val(self, tree: Tree) -> Value:
+        if id(tree) not in self.tree_vals:
+            self.tree_vals[id(tree)] = Value(of=tree, active_in=None, last_use=None)
+        return self.tree_vals[id(tree)]
+
+    def restore(self, tree: Tree, val: Value, reg: int) -> None:
+        # Both operands can read the same local
+        if not any(restore.val is val and restore.reg == reg for restore in tree.pre_restores):
+            tree.pre_restores.append(RegRestore(val=val, reg=reg))
+
+    # Turns the intervals into register annotations
+    def annotate(self, ir: Ir) -> None:
+        for tree in self.trees:
+            if tree.kind == TreeKind.LdLocal:
+                interval = self.local_intervals[tree.operands[0]]
+                position = use_position(tree.parent)
+                if interval.in_register(position):
+                    tree.reg = interval.reg
+                else:
+                    tree.reg = self.reload_intervals[(id(interval), position)].reg
+                    self.restore(tree.parent, self.var_vals[tree.operands[0]], tree.reg)
+                tree.use_reg = tree.reg
+            elif tree.kind == TreeKind.StLocal:
+                local = tree.operands[0]
+                interval = self.local_intervals[local]
+                subtree = tree.subtrees[0]
+                if interval.in_register(def_position(tree)):
+                    if interval.reg != subtree.use_reg:
+                        src_val = self.var_vals[subtree.operands[0]] if subtree.kind == TreeKind.LdLocal else self.tree_val(subtree)
+                        tree.post_moves.append(RegMove(val_from=src_val, reg_from=subtree.use_reg, val_to=self.var_vals[local], reg_to=interval.reg))
+                else:
+                    tree.post_spills.append(RegSpill(val=self.var_vals[local], reg=subtree.use_reg))
+            elif tree.parent != None:
+                interval = self.temp_intervals[id(tree)]
+                if id(tree) in self.def_intervals:
+                    tree.reg = self.def_intervals[id(tree)].reg
+                    tree.post_spills.append(RegSpill(val=self.tree_val(tree), reg=tree.reg))
+                else:
+                    tree.reg = interval.reg
+                tree.use_reg = tree.reg
+                if not interval.in_register(interval.end):
+                    tree.use_reg = self.reload_intervals[(id(interval), interval.end)].reg
+                    self.restore(tree.parent, self.tree_val(tree), tree.use_reg)
+
+        # Values moved to memory while in a register are spilled before the tree at that position. At the start of a
+        # block, the jumps do it
+        for interval, position in self.evictions:
+            if position == interval.start or position % 4 == 0:
+                continue
+            val = self.var_vals[interval.of] if interval.kind == IntervalKind.Local else self.tree_val(interval.of)
+            self.trees[position // 4].pre_spills.append(RegSpill(val=val, reg=interval.reg))
+
+        for block in ir.block_execution_order():
+            if id(block) not in self.block_positions or block.alive_in_set == None:
+                block.active_in_set = []
+                block.active_out_set = []
+                continue
+
+            start, end = self.block_positions[id(block)]
+            block.active_in_set = [
+                ActiveInOut(val=self.var_vals[local], reg=self.local_intervals[local].reg)
+                for local in sorted(block.alive_in_set) if self.local_intervals[local].in_register(start)
+            ]
+            block.active_out_set = [
+                ActiveInOut(val=self.var_vals[local], reg=self.local_intervals[local].reg)
+                for local in sorted(block.alive_out_set) if self.local_intervals[local].in_register(end)
+            ]
+
+    # Preconditions : recompute_predecessors, recompute_alive_sets, reindex all executed
+    def do_interval_scan(self, ir: Ir) -> None:
+        for i in range(ir.local_vars):
+            self.var_vals.append(Value(of=i, active_in=None, last_use=None))
+
+        self.build_intervals(ir)
+        self.scan()
+        self.annotate(ir)
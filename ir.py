@@ -1,6 +1,8 @@
 from __future__ import annotations
 import dataclasses
 import enum
+import itertools
+import sys
 from typing import *
 from rlsra import RegRestore, RegSpill, RegMove, ActiveInOut, Value
 
@@ -12,12 +14,32 @@ class Operator(enum.Enum):
 
     Eq = enum.auto()
 
+COMMUTATIVE_OPERATORS = [Operator.Add, Operator.Mul, Operator.Eq]
+
+# Functions Call trees can call : name -> (number of arguments, implementation). They stand for other compiled functions,
+# the allocators only care about the calling convention. The implementations also work element-wise on numpy arrays (see
+# batch_interpreter.py) and keep values small in loops
+CALLEES: dict[str, tuple[int, Callable]] = {
+    "abs": (1, abs),
+    "hash": (1, lambda x: (x * 31 + 7) % 101),
+    "min": (2, lambda a, b: (a + b - abs(a - b)) // 2),
+    "max": (2, lambda a, b: (a + b + abs(a - b)) // 2),
+}
+
 class TreeKind(enum.Enum):
     LdLocal = enum.auto()
     StLocal = enum.auto()
     Const = enum.auto()
     Discard = enum.auto()
+    # Operands : the Operator, then optionally True when the subtrees are swapped : subtrees[1] is the left operand (see
+    # sethi_ullman.py)
     BinOp = enum.auto()
+    # Only found in superblocks (see superblock.py), in the middle of blocks. Leaves the block through a side exit when
+    # the condition (the subtree) isn't the expected one. Operands : the exit BlockEdge, then the expected value (1 or 0)
+    Guard = enum.auto()
+    # Operands : the name of the callee (see CALLEES), the subtrees are the arguments. Follows the CallingConvention when
+    # one is given to the allocator and the Interpreter
+    Call = enum.auto()
 
     # Reserved for terminals
     Ret = enum.auto()
@@ -36,6 +58,9 @@ class Tree:
     ir_idx: int = 0
     # Assigned during Rlsra.do_reverse_linear_scan or Lsra.do_linear_scan
     reg: int = -1
+    # Register the parent reads the value from. Usually the same as reg, but the value can be restored into another
+    # register between the tree and its parent
+    use_reg: int = -1
     pre_spills: list[RegSpill] = dataclasses.field(default_factory=list)
     pre_restores: list[RegRestore] = dataclasses.field(default_factory=list)
     pre_moves: list[RegMove] = dataclasses.field(default_factory=list)
@@ -55,38 +80,102 @@ class Tree:
         for subtree in reversed(self.subtrees):
             yield from subtree.tree_reverse_execution_order()
 
-    def dump(self, indent_level: int = 0):
-        for tree in self.subtrees:
-            tree.dump(indent_level + 4)
+    # Number of registers needed to evaluate the tree without spilling, when evaluating subtrees left to right
+    def register_need(self) -> int:
+        if self.subtrees == []:
+            return 1 if self.parent != None else 0
 
-        indent = " " * indent_level
-        
-        for pre_spill in self.pre_spills:
-            print(indent + str(pre_spill))
-
-        for pre_restore in self.pre_restores:
-            print(indent + str(pre_restore))
-
-        for pre_move in self.pre_moves:
-            print(indent + str(pre_move))
-
-        reg = "" if self.parent == None else "(r" + str(self.reg) + ") "
-        print(
-            indent +
-            "[" + str(self.ir_idx) + "] " +
-            reg +
-            self.kind.name +
-            "(" + ", ".join(map(str, self.operands)) + ")"
-        )
-        
-        for post_spill in self.post_spills:
-            print(indent + str(post_spill))
+        # The results of the subtrees evaluated before subtree i are held while it's evaluated
+        return max(subtree.register_need() + i for i, subtree in enumerate(self.subtrees))
+
+    def swapped_operands(self) -> bool:
+        return len(self.operands) > 1 and self.operands[1]
+
+    # Subtrees of a BinOp computing its left and right operands. Two-address instructions overwrite the left operand with
+    # the result
+    def left_operand(self) -> Tree:
+        return self.subtrees[1] if self.swapped_operands() else self.subtrees[0]
+
+    def right_operand(self) -> Tree:
+        return self.subtrees[0] if self.swapped_operands() else self.subtrees[1]
+
+    # Exchanges the left and right operands of a commutative BinOp, without changing the evaluation order of the subtrees
+    def swap_commutative_operands(self) -> None:
+        assert self.operands[0] in COMMUTATIVE_OPERATORS
+        self.operands[1:] = [not self.swapped_operands()]
+
+    # Lines of Tree.dump : the subtrees come first, indented, then the annotations around the tree. Iterative, deep
+    # trees don't hit the recursion limit
+    def dump_lines(self, indent_level: int = 0) -> Iterator[str]:
+        stack: list[tuple[Tree, int, bool]] = [(self, indent_level, False)]
+        while len(stack) != 0:
+            tree, level, expanded = stack.pop()
+            if not expanded:
+                stack.append((tree, level, True))
+                for subtree in reversed(tree.subtrees):
+                    stack.append((subtree, level + 4, False))
+                continue
+
+            indent = " " * level
+            for annotation in itertools.chain(tree.pre_spills, tree.pre_restores, tree.pre_moves):
+                yield indent + str(annotation)
+
+            reg = "" if tree.parent == None else "(r" + str(tree.reg) + ") "
+            yield indent + "[" + str(tree.ir_idx) + "] " + reg + tree.kind.name + "(" + ", ".join(map(str, tree.operands)) + ")"
 
-        for post_restore in self.post_restores:
-            print(indent + str(post_restore))
+            for annotation in itertools.chain(tree.post_spills, tree.post_restores, tree.post_moves):
+                yield indent + str(annotation)
 
-        for post_move in self.post_moves:
-            print(indent + str(post_move))
+    def dump(self, indent_level: int = 0):
+        sys.stdout.write("".join(line + "\n" for line in self.dump_lines(indent_level)))
+
+# Registers trees are tied to, like a real target : calls take their arguments and return their result in fixed registers
+# and destroy the caller saved registers, divisions (like x86) need their dividend and result in division_regs[0] and
+# destroy division_regs[1]. Values alive across such a tree can't be in the registers it clobbers.
+# Rlsra and Lsra follow the convention they're given, the Interpreter checks the operand / result registers and puts
+# garbage into the clobbered registers
+@dataclasses.dataclass
+class CallingConvention:
+    argument_regs: list[int]
+    return_reg: int
+    # The other registers are callee saved. The argument and return registers must be caller saved
+    caller_saved: list[int]
+    # None when divisions can use any register
+    division_regs: list[int] | None = None
+
+    # Half of the registers (rounded up) are caller saved, with the arguments and the result in the first ones
+    @staticmethod
+    def default(num_regs: int) -> CallingConvention:
+        assert num_regs >= 2, "calls take up to two arguments"
+        caller_saved = list(range(max(2, (num_regs + 1) // 2)))
+        return CallingConvention(argument_regs=[0, 1], return_reg=0, caller_saved=caller_saved, division_regs=[0, 1])
+
+    def constrained(self, tree: Tree) -> bool:
+        return tree.kind == TreeKind.Call or (self.division_regs != None and tree.kind == TreeKind.BinOp and tree.operands[0] == Operator.Div)
+
+    # Register every subtree has to be read from, None if it can be anywhere
+    def operand_regs(self, tree: Tree) -> list[int | None]:
+        if tree.kind == TreeKind.Call:
+            return self.argument_regs[:len(tree.subtrees)]
+        if self.constrained(tree):
+            # The dividend is the left operand
+            return [None, self.division_regs[0]] if tree.swapped_operands() else [self.division_regs[0], None]
+        return [None] * len(tree.subtrees)
+
+    def result_reg(self, tree: Tree) -> int | None:
+        if tree.kind == TreeKind.Call:
+            return self.return_reg
+        if self.constrained(tree):
+            return self.division_regs[0]
+        return None
+
+    # Registers the tree writes, the result register included. Its operands can be in them, since they're read first
+    def clobbered_regs(self, tree: Tree) -> list[int]:
+        if tree.kind == TreeKind.Call:
+            return self.caller_saved
+        if self.constrained(tree):
+            return self.division_regs
+        return []
 
 @dataclasses.dataclass
 class Statement:
@@ -99,6 +188,9 @@ class Statement:
 class BlockEdge:
     source: BasicBlock
     target: BasicBlock
+    # Assigned by Rlsra for the side exits of guards : where the locals are when leaving, which isn't the active out set
+    # of the end of the block
+    active_out_set: list[ActiveInOut] | None = None
 
     def __str__(self) -> str:
         return f"src {self.source} trgt {self.target}"
@@ -122,7 +214,26 @@ class BasicBlock:
     alive_in_set: set[int] | None = None
     alive_out_set: set[int] | None = None
 
+    # Assigned during Ir.recompute_dominators (None for the first block and unreachable blocks)
+    immediate_dominator: BasicBlock | None = None
+
+    # Assigned during Ir.recompute_loops : innermost loop containing the block
+    loop: Loop | None = None
+
+    # Assigned by tiering.apply_profile : number of times the block was entered while profiling, used instead of the loop
+    # depth estimate by spill_strategy.block_frequency
+    profile_count: int | None = None
+
+    # Exit edges of the guards of the block, in execution order (see superblock.py)
+    side_exits: list[BlockEdge] = dataclasses.field(default_factory=list)
+
+    # Successors, side exits included
     def outgoing_edges(self) -> Iterable[BlockEdge]:
+        yield from self.terminator_edges()
+        yield from self.side_exits
+
+    # Successors reached from the end of the block
+    def terminator_edges(self) -> Iterable[BlockEdge]:
         # The assumption is that the operands of terminator nodes are block edges
         for operand in self.last_statement.tree.operands:
             assert isinstance(operand, BlockEdge), "operand isn't block edge"
@@ -154,10 +265,100 @@ class BasicBlock:
             return
         self.last_statement.next_statement = new_statement
         self.last_statement = new_statement
-    
+
+    def insert_tree_before(self, statement: Statement, tree: Tree) -> None:
+        new_statement = Statement(il_idx=statement.il_idx, tree=tree, next_statement=statement, prev_statement=statement.prev_statement)
+        if statement.prev_statement != None:
+            statement.prev_statement.next_statement = new_statement
+        else:
+            self.first_statemenent = new_statement
+        statement.prev_statement = new_statement
+
+    def remove_statement(self, statement: Statement) -> None:
+        if statement.prev_statement != None:
+            statement.prev_statement.next_statement = statement.next_statement
+        else:
+            self.first_statemenent = statement.next_statement
+        if statement.next_statement != None:
+            statement.next_statement.prev_statement = statement.prev_statement
+        else:
+            self.last_statement = statement.prev_statement
+
+    # Lines of the block in Ir.dump
+    def dump_lines(self) -> Iterator[str]:
+        yield ""
+        yield f"blk 0x{hex(self.il_idx)[2:].zfill(4)} - predecessors: [" + ", ".join(str(pred) for pred in self.predecessors) + "]"
+        if self.alive_in_set == None:
+            yield f"alive var in: {self.alive_in_set}"
+        if self.active_in_set != None:
+            yield "active var in:"
+            for active_in in self.active_in_set:
+                yield str(active_in)
+
+        statement = self.first_statemenent
+        while statement != None:
+            yield f"stmt 0x{hex(statement.il_idx)[2:].zfill(4)}"
+            yield from statement.tree.dump_lines()
+            statement = statement.next_statement
+
+        if self.alive_out_set != None:
+            yield f"alive var out: {self.alive_out_set}"
+        if self.active_out_set != None:
+            yield "active var out:"
+            for active_out in self.active_out_set:
+                yield str(active_out)
+
     def __str__(self) -> str:
         return f"blk 0x{hex(self.il_idx)[2:].zfill(4)}"
 
+@dataclasses.dataclass(eq=False)
+class Loop:
+    header: BasicBlock
+    # Includes the header and the blocks of nested loops
+    blocks: list[BasicBlock]
+    back_edges: list[BlockEdge]
+    parent: Loop | None = None
+
+    def depth(self) -> int:
+        depth = 1
+        loop = self.parent
+        while loop != None:
+            depth += 1
+            loop = loop.parent
+        return depth
+
+    def contains(self, block: BasicBlock) -> bool:
+        loop = block.loop
+        while loop != None:
+            if loop is self:
+                return True
+            loop = loop.parent
+        return False
+
+    # Edges entering the loop from outside (the edges coming from the preheader(s))
+    def entry_edges(self) -> Iterable[BlockEdge]:
+        for edge in self.header.incoming_edges():
+            if not self.contains(edge.source):
+                yield edge
+
+    def exit_edges(self) -> Iterable[BlockEdge]:
+        for block in self.blocks:
+            for edge in block.outgoing_edges():
+                if not self.contains(edge.target):
+                    yield edge
+
+    # Locals read or written anywhere in the loop
+    def referenced_locals(self) -> set[int]:
+        referenced = set()
+        for block in self.blocks:
+            for tree in block.tree_execution_order():
+                if tree.kind == TreeKind.LdLocal or tree.kind == TreeKind.StLocal:
+                    referenced.add(tree.operands[0])
+        return referenced
+
+    def __str__(self) -> str:
+        return f"loop {self.header} (" + ", ".join(str(block) for block in self.blocks) + ")"
+
 class BasicBlockList:
     first: BasicBlock
     
@@ -175,12 +376,12 @@ class BasicBlockList:
             return block
         
         statement = block.first_statemenent
-        while statement.il_idx < il_idx:
-            if statement.next_statement == None:
-                # il_idx lands past the block
+        while statement == None or statement.il_idx < il_idx:
+            if statement == None or statement.next_statement == None:
+                # il_idx lands past the block (or the block doesn't have any statements yet)
 
                 # insert a new block into the doubly linked list
-                new_block = BasicBlock(il_idx=il_idx, next_block=block.next_block, prev_block=block.prev_block, first_statemenent=None, last_statement=None)
+                new_block = BasicBlock(il_idx=il_idx, next_block=block.next_block, prev_block=block, first_statemenent=None, last_statement=None)
                 block.next_block = new_block
                 if (new_block.next_block != None):
                     new_block.next_block.prev_block = new_block
@@ -194,7 +395,7 @@ class BasicBlockList:
             exit(1)
         
         # insert a new block into the doubly linked list
-        new_block = BasicBlock(il_idx=il_idx, next_block=block.next_block, prev_block=block.prev_block, first_statemenent=None, last_statement=None)
+        new_block = BasicBlock(il_idx=il_idx, next_block=block.next_block, prev_block=block, first_statemenent=None, last_statement=None)
         block.next_block = new_block
         if (new_block.next_block != None):
             new_block.next_block.prev_block = new_block
@@ -221,6 +422,9 @@ class BasicBlockList:
 
         return new_block
 
+# Lines written at once by Ir.dump
+DUMP_CHUNK_LINES = 4096
+
 @dataclasses.dataclass
 class Ir:
     blocks: BasicBlockList
@@ -228,6 +432,9 @@ class Ir:
 
     ir_idx_count: int = 0
 
+    # Assigned during Ir.recompute_loops, outer loops come before the loops they contain
+    loops: list[Loop] = dataclasses.field(default_factory=list)
+
     def no_successors(self) -> Iterable[BasicBlock]:
         for block in self.block_execution_order():
             # We assume blocks with no successors end with return trees
@@ -235,6 +442,9 @@ class Ir:
                 yield block
 
     def recompute_predecessors(self) -> None:
+        for block in self.block_execution_order():
+            block.predecessors = []
+
         block = self.blocks.first
         while block != None:
             for edge in block.outgoing_edges():
@@ -243,6 +453,11 @@ class Ir:
             block = block.next_block
     
     def recompute_alive_sets(self) -> None:
+        # Sets left over from before a transformation could keep themselves alive around loops
+        for block in self.block_execution_order():
+            block.alive_in_set = None
+            block.alive_out_set = None
+
         # TODO : optimize this because it can be computed in a single O(n) pass if we start from "end" blocks (no successors / in infinite loops)
         while True:
             change_occured = False
@@ -250,7 +465,7 @@ class Ir:
                 prev_alive = block.alive_in_set
 
                 alive = set()
-                for edge in block.outgoing_edges():
+                for edge in block.terminator_edges():
                     if edge.target.alive_in_set != None:
                         alive |= edge.target.alive_in_set
 
@@ -260,6 +475,9 @@ class Ir:
                     elif tree.kind == TreeKind.StLocal:
                         if tree.operands[0] in alive:
                             alive.remove(tree.operands[0])
+                    elif tree.kind == TreeKind.Guard and tree.operands[0].target.alive_in_set != None:
+                        # Side exits read the locals alive in their target where the guard is
+                        alive |= tree.operands[0].target.alive_in_set
             
                 block.alive_in_set = alive
 
@@ -269,13 +487,213 @@ class Ir:
             if not change_occured:
                 break
         
+        # Alive at the end of the block : the side exits are taken before
         for block in self.block_execution_order():
             alive_out_set = set()
-            for out_edge in block.outgoing_edges():
+            for out_edge in block.terminator_edges():
                 alive_out_set |= out_edge.target.alive_in_set
             
             block.alive_out_set = alive_out_set
 
+    # An edge is critical if its source has several successors and its target several predecessors : code specific to
+    # the edge can't be placed at the end of the source or at the start of the target
+    # Precondition : recompute_predecessors has been called
+    def is_critical_edge(self, edge: BlockEdge) -> bool:
+        return len(list(edge.source.outgoing_edges())) > 1 and len(edge.target.predecessors) > 1
+
+    # Inserts a new block containing only a Jmp between the source and the target of the edge. The block is placed right
+    # before the target in the block list so that it can fall through into it
+    # The caller is responsible for calling recompute_predecessors afterwards
+    def split_edge(self, edge: BlockEdge) -> BasicBlock:
+        target = edge.target
+
+        new_block = BasicBlock(il_idx=target.il_idx, next_block=target, prev_block=target.prev_block, first_statemenent=None, last_statement=None)
+        if target.prev_block != None:
+            target.prev_block.next_block = new_block
+        else:
+            self.blocks.first = new_block
+        target.prev_block = new_block
+
+        new_block.append_tree(target.il_idx, Tree(
+            kind=TreeKind.Jmp,
+            subtrees=[],
+            operands=[BlockEdge(source=new_block, target=target)],
+            parent=None,
+            block=new_block
+        ))
+        edge.target = new_block
+
+        # Nothing happens in the new block, it has the liveness of the target
+        if target.alive_in_set != None:
+            new_block.alive_in_set = set(target.alive_in_set)
+            new_block.alive_out_set = set(target.alive_in_set)
+
+        return new_block
+
+    # Splits every critical edge (or only the ones selected by the filter). Returns the number of edges that were split
+    # Precondition : recompute_predecessors has been called. Predecessors and ir indices are recomputed if anything changed
+    def split_critical_edges(self, filter: Callable[[BlockEdge], bool] | None = None) -> int:
+        critical_edges = []
+        for block in self.block_execution_order():
+            for edge in block.outgoing_edges():
+                if self.is_critical_edge(edge) and (filter == None or filter(edge)):
+                    critical_edges.append(edge)
+
+        for edge in critical_edges:
+            self.split_edge(edge)
+
+        if len(critical_edges) != 0:
+            self.recompute_predecessors()
+            self.reindex()
+
+        return len(critical_edges)
+
+    # Blocks reachable from the first block, in reverse postorder
+    def reverse_postorder(self) -> list[BasicBlock]:
+        postorder = []
+        visited = set()
+        # Iterative DFS to avoid hitting the recursion limit on large functions
+        stack = [(self.blocks.first, self.blocks.first.outgoing_edges())]
+        visited.add(id(self.blocks.first))
+        while len(stack) != 0:
+            block, edges = stack[-1]
+            for edge in edges:
+                if id(edge.target) not in visited:
+                    visited.add(id(edge.target))
+                    stack.append((edge.target, edge.target.outgoing_edges()))
+                    break
+            else:
+                stack.pop()
+                postorder.append(block)
+
+        postorder.reverse()
+        return postorder
+
+    # Cooper, Harvey, Kennedy : "A Simple, Fast Dominance Algorithm"
+    # Precondition : recompute_predecessors has been called
+    def recompute_dominators(self) -> None:
+        order = self.reverse_postorder()
+        rpo_idx = {id(block): i for i, block in enumerate(order)}
+
+        for block in self.block_execution_order():
+            block.immediate_dominator = None
+
+        def intersect(a: BasicBlock, b: BasicBlock) -> BasicBlock:
+            while a is not b:
+                while rpo_idx[id(a)] > rpo_idx[id(b)]:
+                    a = a.immediate_dominator
+                while rpo_idx[id(b)] > rpo_idx[id(a)]:
+                    b = b.immediate_dominator
+            return a
+
+        first = self.blocks.first
+        # Temporarily make the first block its own dominator so that intersect terminates
+        first.immediate_dominator = first
+        while True:
+            change_occured = False
+            for block in order[1:]:
+                new_idom = None
+                for edge in block.incoming_edges():
+                    pred = edge.source
+                    if id(pred) not in rpo_idx or pred.immediate_dominator is None:
+                        continue
+                    new_idom = pred if new_idom is None else intersect(pred, new_idom)
+
+                if new_idom is not block.immediate_dominator:
+                    block.immediate_dominator = new_idom
+                    change_occured = True
+
+            if not change_occured:
+                break
+        first.immediate_dominator = None
+
+    # Inserts a new first block that jumps to the old one. Some passes need a first block without predecessors
+    # The caller is responsible for calling recompute_predecessors afterwards
+    def insert_entry_block(self) -> BasicBlock:
+        old_first = self.blocks.first
+
+        new_block = BasicBlock(il_idx=old_first.il_idx, next_block=old_first, prev_block=None, first_statemenent=None, last_statement=None)
+        new_block.append_tree(old_first.il_idx, Tree(
+            kind=TreeKind.Jmp,
+            subtrees=[],
+            operands=[BlockEdge(source=new_block, target=old_first)],
+            parent=None,
+            block=new_block
+        ))
+        old_first.prev_block = new_block
+        self.blocks.first = new_block
+
+        if old_first.alive_in_set != None:
+            new_block.alive_in_set = set(old_first.alive_in_set)
+            new_block.alive_out_set = set(old_first.alive_in_set)
+
+        return new_block
+
+    # Unlinks the blocks the first block can't reach. Returns the number of blocks removed
+    # The caller is responsible for calling recompute_predecessors afterwards
+    def remove_unreachable_blocks(self) -> int:
+        reachable = set(id(block) for block in self.reverse_postorder())
+        removed = 0
+        for block in list(self.block_execution_order()):
+            if id(block) in reachable:
+                continue
+            if block.prev_block != None:
+                block.prev_block.next_block = block.next_block
+            if block.next_block != None:
+                block.next_block.prev_block = block.prev_block
+            removed += 1
+        return removed
+
+    # Precondition : recompute_dominators has been called
+    def dominates(self, a: BasicBlock, b: BasicBlock) -> bool:
+        while b is not None:
+            if a is b:
+                return True
+            b = b.immediate_dominator
+        return False
+
+    # Finds natural loops from back edges (edges whose target dominates their source). Loops sharing a header are merged
+    # Precondition : recompute_dominators has been called
+    def recompute_loops(self) -> None:
+        for block in self.block_execution_order():
+            block.loop = None
+
+        back_edges_by_header: dict[int, list[BlockEdge]] = {}
+        headers: list[BasicBlock] = []
+        for block in self.reverse_postorder():
+            for edge in block.outgoing_edges():
+                if self.dominates(edge.target, block):
+                    if id(edge.target) not in back_edges_by_header:
+                        back_edges_by_header[id(edge.target)] = []
+                        headers.append(edge.target)
+                    back_edges_by_header[id(edge.target)].append(edge)
+
+        loops = []
+        for header in headers:
+            back_edges = back_edges_by_header[id(header)]
+
+            # Walk backwards from the sources of the back edges until reaching the header
+            body = {id(header): header}
+            worklist = [edge.source for edge in back_edges]
+            while len(worklist) != 0:
+                block = worklist.pop()
+                if id(block) in body:
+                    continue
+                body[id(block)] = block
+                for edge in block.incoming_edges():
+                    worklist.append(edge.source)
+
+            loops.append(Loop(header=header, blocks=list(body.values()), back_edges=back_edges))
+
+        # Process outer loops first so that inner loops overwrite block.loop. An outer loop strictly contains its inner loops
+        loops.sort(key=lambda loop: len(loop.blocks), reverse=True)
+        for loop in loops:
+            loop.parent = loop.header.loop
+            for block in loop.blocks:
+                block.loop = loop
+
+        self.loops = loops
+
     def reindex(self) -> None:
         index = 0
 
@@ -284,7 +702,29 @@ class Ir:
             index += 1
         
         self.ir_idx_count = index
-    
+
+    # Forgets the allocation to allocate the ir again, keeping the analyses. Like Rlsra.reset_block for the whole ir, the
+    # annotations can be released into a RecordPool first. The BinOps swapped by the two-address allocators stay swapped
+    def clear_allocation(self) -> None:
+        for block in self.block_execution_order():
+            block.active_in_set = None
+            block.active_out_set = None
+            for edge in block.side_exits:
+                edge.active_out_set = None
+
+        for tree in self.tree_execution_order():
+            tree.reg = -1
+            tree.use_reg = -1
+            tree.pre_spills.clear()
+            tree.pre_restores.clear()
+            tree.pre_moves.clear()
+            tree.post_spills.clear()
+            tree.post_restores.clear()
+            tree.post_moves.clear()
+            if tree.kind == TreeKind.StLocal:
+                # Allocation results are appended to the operands
+                del tree.operands[1:]
+
     def block_execution_order(self) -> Iterable[BasicBlock]:
         block = self.blocks.first
         while block != None:
@@ -301,29 +741,16 @@ class Ir:
                 statement = statement.next_statement
             block = block.next_block
 
-    def dump(self) -> None:
-        block = self.blocks.first
-        while block != None:
-            print(f"\nblk 0x{hex(block.il_idx)[2:].zfill(4)} - predecessors: [" + ", ".join(str(pred) for pred in block.predecessors) + "]")
-            if block.alive_in_set == None:
-                print("alive var in:", block.alive_in_set)
-            if block.active_in_set != None:
-                print("active var in:")
-                for active_in in block.active_in_set:
-                    print(active_in)
-
-            statement = block.first_statemenent
-            while statement != None:
-                print(f"stmt 0x{hex(statement.il_idx)[2:].zfill(4)}")
-                statement.tree.dump()
-
-                statement = statement.next_statement
-
-            if block.alive_out_set != None:
-                print("alive var out:", block.alive_out_set)
-            if block.active_out_set != None:
-                print("active var out:")
-                for active_out in block.active_out_set:
-                    print(active_out)
-
-            block = block.next_block
\ No newline at end of file
+    # Written DUMP_CHUNK_LINES lines at a time : the output of large functions is never held in memory as a whole, and
+    # there are few writes
+    def dump(self, out: TextIO | None = None) -> None:
+        out = out if out != None else sys.stdout
+        lines = []
+        for block in self.block_execution_order():
+            for line in block.dump_lines():
+                lines.append(line)
+                if len(lines) == DUMP_CHUNK_LINES:
+                    out.write("\n".join(lines) + "\n")
+                    lines.clear()
+        if len(lines) != 0:
+            out.write("\n".join(lines) + "\n")
\ No newline at end of file
@@ -0,0 +1,149 @@
+from __future__ import annotations
+import dataclasses
+from ir import *
+from spill_strategy import block_frequency
+
+# Block layout, run on the ir before allocation. The import splits blocks at every jump target and ends the first half
+# with a synthetic Jmp (see BasicBlockList.get_or_insert_block_at), and keeps the blocks in il_idx order : hot paths go
+# through blocks that only jump somewhere else, and take jumps where they could fall through.
+# - Jump threading : edges to a block whose only statement is a Jmp go to the target of that Jmp instead. The forwarding
+#   blocks nobody jumps to anymore are removed
+# - Chain merging : a block ending with a Jmp to a block only it jumps to gets the statements of that block (and its side
+#   exits), the Jmp goes away
+# - Reordering : the blocks are placed greedily from the first one, every block being followed by its hottest successor
+#   that isn't placed yet, so that the hot edges fall through (Interpreter.jump charges taken_jump to the others). The
+#   frequencies are the profiled block entries when there are some, otherwise the loop depth estimate (see
+#   spill_strategy.block_frequency) : a loop header falls through into its body rather than into its exit. Ties keep the
+#   il_idx order
+# The edges of the removed blocks don't need any resolution after allocation anymore, and the allocators have fewer
+# blocks to go through. The blocks keep their il_idx (tiering.Profile relies on it), the first block stays first.
+# Without profile counts it doesn't pay for itself on the benchmark corpus : removing blocks changes the order Rlsra / Lsra
+# visit the blocks in (and so which successor decides the active out set of a block), the spills / restores end up
+# slightly worse. rlsra-layout and lsra-layout are in fuzz.EXPERIMENTAL_ALLOCATORS for that reason.
+
+@dataclasses.dataclass
+class LayoutStats:
+    # Edges going to the target of a forwarding block instead of the block
+    threaded: int = 0
+    # Blocks appended to their only predecessor
+    merged: int = 0
+    # Forwarding blocks no edge goes to anymore
+    removed_blocks: int = 0
+    # Terminator edges whose target is the next block, before and after the pass
+    fall_throughs_before: int = 0
+    fall_throughs_after: int = 0
+
+def fall_throughs(ir: Ir) -> int:
+    return sum(1 for block in ir.block_execution_order() for edge in block.terminator_edges() if edge.target is block.next_block)
+
+# Target of the Jmp if the block does nothing else. The first block is kept : it's where the function starts
+def forwarding_target(ir: Ir, block: BasicBlock) -> BasicBlock | None:
+    if block is ir.blocks.first or block.first_statemenent is not block.last_statement:
+        return None
+    tree = block.last_statement.tree
+    if tree.kind != TreeKind.Jmp:
+        return None
+    return tree.operands[0].target
+
+def thread_jumps(ir: Ir, stats: LayoutStats) -> None:
+    for block in ir.block_execution_order():
+        for edge in block.outgoing_edges():
+            # Chains of forwarding blocks can loop on themselves, the edge keeps the first block of the cycle
+            seen = set()
+            target = forwarding_target(ir, edge.target)
+            while target is not None and target is not edge.target and id(edge.target) not in seen:
+                seen.add(id(edge.target))
+                edge.target = target
+                stats.threaded += 1
+                target = forwarding_target(ir, edge.target)
+
+# Appends the statements of the block its Jmp goes to, as long as the Jmp is the only edge going there
+# Precondition : recompute_predecessors has been called
+def merge_successor(ir: Ir, block: BasicBlock) -> bool:
+    jmp = block.last_statement.tree
+    if jmp.kind != TreeKind.Jmp:
+        return False
+    successor = jmp.operands[0].target
+    if successor is block or successor is ir.blocks.first or len(successor.predecessors) != 1:
+        return False
+
+    block.remove_statement(block.last_statement)
+    statement = successor.first_statemenent
+    while statement is not None:
+        for tree in statement.tree.tree_execution_order():
+            tree.block = block
+        block.append_tree(statement.il_idx, statement.tree)
+        statement = statement.next_statement
+
+    for edge in successor.outgoing_edges():
+        edge.source = block
+    block.side_exits += successor.side_exits
+    if block.profile_count is not None and successor.profile_count is not None:
+        block.profile_count = max(block.profile_count, successor.profile_count)
+
+    successor.prev_block.next_block = successor.next_block
+    if successor.next_block is not None:
+        successor.next_block.prev_block = successor.prev_block
+    return True
+
+def merge_chains(ir: Ir, stats: LayoutStats) -> None:
+    block = ir.blocks.first
+    while block is not None:
+        while merge_successor(ir, block):
+            stats.merged += 1
+        block = block.next_block
+
+# A block is ready once the blocks jumping to it are placed, back edges aside : placing a join right after one of its
+# predecessors would make the others jump around it
+# Precondition : recompute_dominators has been called
+def is_ready(ir: Ir, block: BasicBlock, placed: set[int]) -> bool:
+    return all(id(edge.source) in placed or ir.dominates(block, edge.source) for edge in block.incoming_edges())
+
+# Precondition : recompute_predecessors and recompute_dominators have been called, and recompute_loops unless every
+# block has a profile_count
+def reorder_blocks(ir: Ir) -> None:
+    original = list(ir.block_execution_order())
+    position = {id(block): i for i, block in enumerate(original)}
+    placed = set()
+    order = []
+
+    block = ir.blocks.first
+    while block is not None:
+        order.append(block)
+        placed.add(id(block))
+
+        successors = [edge.target for edge in block.terminator_edges() if id(edge.target) not in placed and is_ready(ir, edge.target, placed)]
+        if len(successors) != 0:
+            block = max(successors, key=lambda successor: (block_frequency(successor), -position[id(successor)]))
+            continue
+
+        # Nothing to fall through into, the next chain starts with the first ready block left in the il_idx order (any
+        # block left if none is ready, which only happens in irreducible loops)
+        unplaced = [block for block in original if id(block) not in placed]
+        block = next((block for block in unplaced if is_ready(ir, block, placed)), unplaced[0] if len(unplaced) != 0 else None)
+
+    for i, block in enumerate(order):
+        block.prev_block = order[i - 1] if i != 0 else None
+        block.next_block = order[i + 1] if i + 1 < len(order) else None
+
+# Runs all the passes. Predecessors, alive sets, loops and tree indices are recomputed
+def layout(ir: Ir, stats: LayoutStats | None = None) -> LayoutStats:
+    stats = stats if stats != None else LayoutStats()
+    stats.fall_throughs_before += fall_throughs(ir)
+
+    thread_jumps(ir, stats)
+    ir.recompute_predecessors()
+    stats.removed_blocks += ir.remove_unreachable_blocks()
+    ir.recompute_predecessors()
+
+    merge_chains(ir, stats)
+    ir.recompute_predecessors()
+
+    ir.recompute_dominators()
+    ir.recompute_loops()
+    reorder_blocks(ir)
+    stats.fall_throughs_after += fall_throughs(ir)
+
+    ir.recompute_alive_sets()
+    ir.reindex()
+    return stats
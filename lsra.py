@@ -1,25 +1,81 @@
+import bisect
 from rlsra import *
 from ir import *
+from spill_strategy import *
+import splitting
+import pressure
 
 class Lsra:
     # We reuse most data structures defined in rlsra because they can work both ways
     registers: list[Register]
     var_vals: list[Value]
-    var_first_writes: dict[int, Tree | BasicBlock | None]
     tree_vals: list[Value]
     active_vals: list[Value]
     blocks_to_process: deque[BasicBlock]
+    spill_strategy: SpillStrategy
+    # Active values whose register holds the same value as memory (restored and not written since) : evicting them
+    # doesn't need a spill
+    clean_vals: list[Value]
+    # Locals that are kept in memory for the whole block, by block id (see splitting.py)
+    split_live_ranges: bool
+    split_locals: dict[int, set[int]]
+    # Register constraints of calls and divisions (see CallingConvention). None to allocate without constraints
+    convention: CallingConvention | None
+    # ir_idx of the constrained trees of the current block
+    constrained_trees: list[int]
+    # Two-address BinOps : the result is written to the register of the left operand (see activate_two_address_result)
+    two_address: bool
+    # Tree values and annotations (see RecordPool), can be shared between allocators
+    pool: RecordPool
+    # Blocks whose pressure fits in the registers are allocated without looking for spills (see Rlsra.fast_path)
+    fast_path: bool
+    spill_free: bool
+    spill_free_blocks: int
+    # Held by the registers of the temps in spill free blocks (see Rlsra.temp_placeholder)
+    temp_placeholder: Value
 
     current_tree: Tree
 
-    def __init__(self, num_regs: int) -> None:
+    def __init__(self, num_regs: int, spill_strategy: SpillStrategy | None = None, split_live_ranges: bool = False, convention: CallingConvention | None = None, two_address: bool = False, pool: RecordPool | None = None, fast_path: bool = True) -> None:
         self.registers = [Register(active_val=None) for _ in range(num_regs)]
         self.var_vals = []
-        self.var_first_writes = dict()
         self.tree_vals = []
         self.active_vals = []
         self.blocks_to_process = deque()
+        self.spill_strategy = spill_strategy if spill_strategy is not None else FurthestUse()
+        self.clean_vals = []
+        self.split_live_ranges = split_live_ranges
+        self.split_locals = dict()
+        self.convention = convention
+        self.constrained_trees = []
+        self.two_address = two_address
+        self.pool = pool if pool is not None else RecordPool()
+        self.fast_path = fast_path
+        self.spill_free = False
+        self.spill_free_blocks = 0
+        self.temp_placeholder = Value(of=-1, active_in=None, last_use=None)
         self.current_tree = None
+
+    # Gets the allocator ready for another function, done by do_linear_scan (see Rlsra.reset)
+    def reset(self, local_vars: int) -> None:
+        for reg in self.registers:
+            reg.active_val = None
+        del self.var_vals[local_vars:]
+        for val in self.var_vals:
+            val.active_in = None
+            val.last_use = None
+        for i in range(len(self.var_vals), local_vars):
+            self.var_vals.append(Value(of=i, active_in=None, last_use=None))
+
+        self.tree_vals.clear()
+        self.active_vals.clear()
+        self.blocks_to_process.clear()
+        self.clean_vals = []
+        self.split_locals = dict()
+        self.constrained_trees = []
+        self.spill_free = False
+        self.current_tree = None
+        self.pool.start_function()
     
     def free_active_vals(self) -> None:
         new_active_vals = []
@@ -31,6 +87,7 @@ class Lsra:
             if val.last_use is None or val.last_use.ir_idx <= self.current_tree.ir_idx:
                 self.registers[val.active_in].active_val = None
                 val.active_in = None
+                self.mark_dirty(val)
             else:
                 new_active_vals.append(val)
         
@@ -39,81 +96,133 @@ class Lsra:
     def free_tree_vals(self) -> None:
         new_tree_vals = []
         for val in self.tree_vals:
-            if val.of.ir_idx >= self.current_tree.ir_idx:
+            # Tree vals are only used by their parent
+            if val.last_use.ir_idx > self.current_tree.ir_idx:
                 new_tree_vals.append(val)
+            else:
+                self.pool.free_value(val)
         
         self.tree_vals = new_tree_vals
+
+    def mark_dirty(self, val: Value) -> None:
+        if val in self.clean_vals:
+            self.clean_vals.remove(val)
+
+    # SpillContext
+    def use_distance(self, val: Value) -> int:
+        if isinstance(val.last_use, BasicBlock):
+            return BLOCK_USE_DISTANCE
+        return val.last_use.ir_idx - self.current_tree.ir_idx
+
+    def use_frequency(self, val: Value) -> int:
+        if isinstance(val.last_use, BasicBlock):
+            return block_frequency(val.last_use)
+        return block_frequency(val.last_use.block)
+
+    def is_clean(self, val: Value) -> bool:
+        return val in self.clean_vals
     
+    def used_after(self, val: Value, tree: Tree) -> bool:
+        return isinstance(val.last_use, BasicBlock) or val.last_use.ir_idx > tree.ir_idx
+
+    # With a convention : the register the constrained tree using the value reads it from first (no move needed), then
+    # the registers that survive calls for the values alive across a constrained tree, and the clobbered ones for the
+    # other values so that the callee saved registers stay free for the values that need them
+    def register_order(self, val: Value) -> list[int]:
+        order = list(range(len(self.registers)))
+        if self.convention is None:
+            return order
+
+        # From the current tree to the last use
+        i = bisect.bisect_right(self.constrained_trees, self.current_tree.ir_idx)
+        crosses = i < len(self.constrained_trees) and (isinstance(val.last_use, BasicBlock) or self.constrained_trees[i] < val.last_use.ir_idx)
+
+        caller_saved = self.convention.caller_saved
+        order.sort(key=lambda reg: (reg in caller_saved) == crosses)
+
+        user = val.last_use
+        if isinstance(user, Tree) and self.convention.constrained(user):
+            for subtree, reg in zip(user.subtrees, self.convention.operand_regs(user)):
+                is_operand = subtree is val.of or (subtree.kind == TreeKind.LdLocal and subtree.operands[0] == val.of)
+                if reg is not None and is_operand:
+                    order.remove(reg)
+                    order.insert(0, reg)
+        return order
+
     # Make a value active (active_in will have the index of a register)
-    def activate(self, val: Value, restore: bool = True, forbid_restores: list[int] = []) -> None:
+    # exclude : registers the value can't be given (clobbered while it's still alive)
+    def activate(self, val: Value, restore: bool = True, forbid_spills: list[Value] = [], exclude: list[int] = []) -> None:
         assert val.last_use is not None
         assert val.active_in is None
 
         # TODO : register preference sets. Variables should prefer being stored in a register they were previously in in priority.
         # If they can't have it, or if the value is a tree temp, it should prioritize reusing an operand register.
 
-        for reg_i, reg in enumerate(self.registers):
-            if restore and reg_i in forbid_restores:
-                continue
+        if self.spill_free:
+            # Nothing gets evicted in the block, the clean values aren't needed
+            val.active_in = self.free_register()
+            self.registers[val.active_in].active_val = val
+            self.active_vals.append(val)
+            if restore:
+                self.current_tree.pre_restores.append(self.pool.restore(val, val.active_in))
+            return
 
-            if reg.active_val == None:
+        for reg_i in self.register_order(val):
+            reg = self.registers[reg_i]
+            if reg.active_val == None and reg_i not in exclude:
                 val.active_in = reg_i
                 reg.active_val = val
                 self.active_vals.append(val)
 
                 if restore:
-                    self.current_tree.pre_restores.append(RegRestore(val, reg_i))
+                    self.current_tree.pre_restores.append(self.pool.restore(val, reg_i))
+                    self.clean_vals.append(val)
 
                 return
         
-        # No free registers, spill a value
-        # Best candidate heuristic : furthest last use
-        best_val: Value | None = None
-        for active_val in self.active_vals:
-            assert active_val.last_use != None # Would've been freed
-
-            if restore and active_val.active_in in forbid_restores:
-                continue
-
-            """
-            # Check if the val is a candidate (it's not about to be used)
-            if isinstance(active_val.of, int):
-                if any(subtree.kind == TreeKind.LdLocal and subtree.operands[0] == active_val.of for subtree in self.current_tree.subtrees):
-                    # Local variable is an operand that needs to be in a register
-                    continue
-            else:
-                if active_val.last_use is self.current_tree:
-                    # Tree temp is an operand
-                    continue
-            """
-            
-            if best_val is None:
-                best_val = active_val
-            elif isinstance(active_val.last_use, BasicBlock):
-                continue
-            else:
-                if isinstance(best_val.last_use, BasicBlock):
-                    best_val = active_val
-                else:
-                    if active_val.last_use.ir_idx > best_val.last_use.ir_idx:
-                        best_val = active_val
-
-        assert best_val is not None, "no spill candidates"
+        # No free registers, spill a value. The spill strategy picks it
+        # Operands of the current tree that are already in registers can't be spilled
+        candidates = [active_val for active_val in self.active_vals if active_val not in forbid_spills and active_val.active_in not in exclude]
+        assert len(candidates) != 0, "no spill candidates"
+        best_val = self.spill_strategy.choose(candidates, self)
 
         assert best_val.active_in is not None
 
-        self.current_tree.pre_spills.append(RegSpill(val=best_val, reg=best_val.active_in))
+        # A value moved out of a clobbered register for this same tree (see allocate_constrained_tree) is still in its
+        # old register when spilling, and doesn't need the move anymore
+        spill_reg = best_val.active_in
+        move = next((move for move in self.current_tree.pre_moves if move.val_to is best_val and move.reg_to == best_val.active_in), None)
+        if move is not None:
+            self.current_tree.pre_moves.remove(move)
+            self.pool.moves.append(move)
+            spill_reg = move.reg_from
+
+        # Memory is already up to date for clean values. This also covers values restored for this same tree : spills
+        # happen before restores, the register doesn't hold them yet when spilling
+        if not self.is_clean(best_val):
+            self.current_tree.pre_spills.append(self.pool.spill(best_val, spill_reg))
 
         val.active_in = best_val.active_in
         self.registers[val.active_in].active_val = val
         self.active_vals.append(val)
 
         if restore:
-            self.current_tree.pre_restores.append(RegRestore(val=val, reg=val.active_in))
+            self.current_tree.pre_restores.append(self.pool.restore(val, val.active_in))
+            self.clean_vals.append(val)
 
         best_val.active_in = None
         self.active_vals.remove(best_val)
+        self.mark_dirty(best_val)
     
+    # First free register, in spill free blocks (a register is always free, and the order is the same for all the values
+    # without a convention)
+    def free_register(self) -> int:
+        for reg_i, reg in enumerate(self.registers):
+            if reg.active_val is None:
+                return reg_i
+
+        assert False, "no free register in a spill free block"
+
     def reset_var_vals_and_regs(self) -> None:
         assert self.tree_vals == []
 
@@ -125,8 +234,6 @@ class Lsra:
             
             val.last_use = None
         
-        self.var_first_writes = dict()
-        
         assert self.active_vals == []
         assert not any(reg.active_val != None for reg in self.registers), str(self.registers)
     
@@ -140,20 +247,196 @@ class Lsra:
         
         assert False, "unreachable"
     
+    # Calls and divisions (see CallingConvention) : the values alive across the tree leave the clobbered registers (moved
+    # to a register that survives the tree, or spilled), the operands are copied into the registers the tree reads them
+    # from (unless they're already there), and the result is written to the result register
+    def allocate_constrained_tree(self, tree: Tree) -> None:
+        operand_vals = [self.get_tree_val(subtree) for subtree in tree.subtrees]
+        operand_regs = self.convention.operand_regs(tree)
+        clobbered = self.convention.clobbered_regs(tree)
+
+        # Register the values moved away from were in, before the moves : the registers other moves of this tree read
+        moved_from: dict[int, int] = dict()
+        for reg_i in clobbered:
+            val = self.registers[reg_i].active_val
+            if val is None:
+                continue
+            # Operands that are where the tree reads them and die there can stay
+            if not self.used_after(val, tree) and any(operand is val and reg == reg_i for operand, reg in zip(operand_vals, operand_regs)):
+                continue
+
+            free_reg = next((free for free in self.register_order(val) if free not in clobbered and self.registers[free].active_val is None), None)
+            self.registers[reg_i].active_val = None
+            if free_reg is not None:
+                tree.pre_moves.append(self.pool.move(val, reg_i, val, free_reg))
+                self.registers[free_reg].active_val = val
+                val.active_in = free_reg
+                moved_from[id(val)] = reg_i
+            else:
+                if not self.is_clean(val):
+                    tree.pre_spills.append(self.pool.spill(val, reg_i))
+                val.active_in = None
+                self.active_vals.remove(val)
+                self.mark_dirty(val)
+
+        # Operands with a register. The copies keep their register reserved until the tree is done, the values stay
+        # where they are
+        reserved = []
+        for subtree, val, reg_i in zip(tree.subtrees, operand_vals, operand_regs):
+            if reg_i is None:
+                continue
+
+            if val.active_in != reg_i:
+                assert self.registers[reg_i].active_val is None
+                if val.active_in is None:
+                    tree.pre_restores.append(self.pool.restore(val, reg_i))
+                elif moved_from.get(id(val), val.active_in) != reg_i:
+                    tree.pre_moves.append(self.pool.move(val, moved_from.get(id(val), val.active_in), val, reg_i))
+                self.registers[reg_i].active_val = self.pool.value(subtree, reg_i, tree)
+                reserved.append(reg_i)
+            subtree.use_reg = reg_i
+
+        for subtree, val, reg_i in zip(tree.subtrees, operand_vals, operand_regs):
+            if reg_i is not None:
+                continue
+
+            if val.active_in is None:
+                self.activate(val, forbid_spills=operand_vals, exclude=clobbered if self.used_after(val, tree) else [])
+            subtree.use_reg = val.active_in
+
+        self.free_active_vals()
+        for reg_i in reserved:
+            self.pool.free_value(self.registers[reg_i].active_val)
+            self.registers[reg_i].active_val = None
+
+        tree.reg = self.convention.result_reg(tree)
+        if tree.parent is not None:
+            assert self.registers[tree.reg].active_val is None
+            tree_val = self.pool.value(tree, tree.reg, tree.parent)
+            self.registers[tree.reg].active_val = tree_val
+            self.active_vals.append(tree_val)
+            self.tree_vals.append(tree_val)
+
+    # Whether the result of the tree can be written over the operand : it died (its register was freed), or it's a local
+    # the parent overwrites
+    def overwritable(self, tree: Tree, operand: Tree) -> bool:
+        if self.registers[operand.use_reg].active_val is None:
+            return True
+        return operand.kind == TreeKind.LdLocal and tree.parent.kind == TreeKind.StLocal and tree.parent.operands[0] == operand.operands[0]
+
+    # Two-address BinOps, once the operands dying at the tree are freed : the result reuses the register of the left operand
+    # if it died, or if it's a local the parent writes the result to (the StLocal then finds the result where the local
+    # is). Otherwise the operand is still needed afterwards, the result gets another register (not the one of the right
+    # operand, read at the same time) and the operand is copied there right before the tree. An operand restored for this
+    # tree isn't in its register yet when the copy happens, it's restored a second time instead
+    # The operands of commutative BinOps are exchanged when the right one can be written over and the left one can't
+    def activate_two_address_result(self, tree: Tree, tree_val: Value) -> None:
+        if tree.operands[0] in COMMUTATIVE_OPERATORS and not self.overwritable(tree, tree.left_operand()) and self.overwritable(tree, tree.right_operand()):
+            tree.swap_commutative_operands()
+        left = tree.left_operand()
+        right = tree.right_operand()
+
+        if self.registers[left.use_reg].active_val is None:
+            tree_val.active_in = left.use_reg
+            self.registers[left.use_reg].active_val = tree_val
+            self.active_vals.append(tree_val)
+            return
+
+        if self.overwritable(tree, left):
+            # The register stays the local's : nothing runs between the tree and the StLocal
+            tree_val.active_in = left.use_reg
+            return
+
+        self.activate(tree_val, restore=False, exclude=[right.use_reg])
+        if tree_val.active_in != left.use_reg:
+            left_val = self.get_tree_val(left)
+            if any(restore.val is left_val and restore.reg == left.use_reg for restore in tree.pre_restores):
+                tree.pre_restores.append(self.pool.restore(left_val, tree_val.active_in))
+            else:
+                tree.pre_moves.append(self.pool.move(left_val, left.use_reg, left_val, tree_val.active_in))
+            left.use_reg = tree_val.active_in
+
+    # Values in registers at the same time in the block (see pressure.py). The locals are in a register from their first
+    # reference (or the start of the block if they enter it in one) to their last use
+    # Precondition : the last uses are set up, the active in set is selected
+    def block_pressure(self, block: BasicBlock, first: int, first_references: dict[int, int], temp_ranges: list[tuple[int, int]]) -> int:
+        last = block.last_statement.tree.ir_idx
+        starts = dict(first_references)
+        for active_in in block.active_in_set:
+            starts[active_in.val.of] = first - 1
+
+        ranges = temp_ranges
+        for local, start in starts.items():
+            last_use = self.var_vals[local].last_use
+            # Locals that are never read are dead stores, they don't get a register
+            if isinstance(last_use, BasicBlock):
+                ranges.append((start, last + 1))
+            elif last_use is not None:
+                ranges.append((start, last_use.ir_idx))
+
+        return pressure.forward_scan_pressure(ranges, first, last)
+
+    # Trees of spill free blocks : the operands are still where they were put, and the temps don't need values (they're
+    # only needed to spill and restore them), their register is held until their parent reads them
+    def allocate_spill_free_tree(self, tree: Tree) -> None:
+        for subtree in tree.subtrees:
+            if subtree.kind == TreeKind.LdLocal:
+                subtree.use_reg = self.var_vals[subtree.operands[0]].active_in
+            else:
+                subtree.use_reg = subtree.reg
+
+        self.free_active_vals()
+        for subtree in tree.subtrees:
+            if subtree.kind != TreeKind.LdLocal:
+                self.registers[subtree.reg].active_val = None
+
+        if tree.kind == TreeKind.StLocal:
+            subtree = tree.subtrees[0]
+            dst_val = self.var_vals[tree.operands[0]]
+            src_reg = subtree.use_reg
+            if dst_val.last_use is None or (isinstance(dst_val.last_use, Tree) and dst_val.last_use.ir_idx <= tree.ir_idx):
+                tree.operands.append(src_reg)
+            else:
+                if dst_val.active_in is None:
+                    self.activate(dst_val, restore=False)
+                dst_reg = dst_val.active_in
+                tree.operands.append(dst_reg)
+
+                if src_reg != dst_reg:
+                    src_val = self.var_vals[subtree.operands[0]] if subtree.kind == TreeKind.LdLocal else self.pool.value(subtree, None, tree)
+                    tree.post_moves.append(self.pool.move(src_val, src_reg, dst_val, dst_reg))
+        elif tree.kind == TreeKind.LdLocal:
+            var_val = self.var_vals[tree.operands[0]]
+            if var_val.active_in is None:
+                self.activate(var_val)
+            tree.reg = var_val.active_in
+        elif tree.parent is not None:
+            tree.reg = self.free_register()
+            self.registers[tree.reg].active_val = self.temp_placeholder
+
     # Do LSRA
     # Preconditions : recompute_predecessors, recompute_alive_in_sets, reindex all executed
     def do_linear_scan(self, ir: Ir) -> None:
-        # Set up all the values corresponding to local variables
-        for i in range(ir.local_vars):
-            self.var_vals.append(Value(of=i, active_in=None, last_use=None))
+        self.reset(ir.local_vars)
+
+        if self.split_live_ranges or self.spill_strategy.needs_loops:
+            ir.recompute_dominators()
+            ir.recompute_loops()
+        if self.split_live_ranges:
+            self.split_locals = splitting.find_split_locals(ir, len(self.registers), loops=True, blocks=True)
         
         # Queue up the first block to be processed
         self.blocks_to_process.append(ir.blocks.first)
 
         while len(self.blocks_to_process) != 0:
             block = self.blocks_to_process.popleft()
+            if block.active_in_set is not None:
+                # Already processed (blocks can be queued up by several predecessors)
+                continue
             
             self.reset_var_vals_and_regs()
+            # The predecessors may have written the values of the active in set without spilling them
+            self.clean_vals = []
 
             # Select predecessor
             selected_predecessor = None
@@ -162,25 +445,36 @@ class Lsra:
                     selected_predecessor = predecessor
                     break
             
-            # Setup first writes for local variables
-            for in_edge in block.predecessors:
-                for alive in in_edge.source.alive_in_set:
-                    self.var_first_writes[alive] = in_edge.source
-
             # Setup last uses for local variables
             for out_edge in block.outgoing_edges():
                 for alive in out_edge.target.alive_in_set:
                     self.var_vals[alive].last_use = out_edge.target
             
+            # Along with the first references of the locals and the ranges of the temps, for the pressure
+            first_references: dict[int, int] = dict()
+            temp_ranges = []
             for tree in block.tree_reverse_execution_order():
                 if tree.kind == TreeKind.LdLocal:
+                    # The use happens at the parent, which can execute after the LdLocals that come later in the tree
                     val = self.var_vals[tree.operands[0]]
-                    if val.last_use == None:
+                    if val.last_use == None or (isinstance(val.last_use, Tree) and tree.parent.ir_idx > val.last_use.ir_idx):
                         val.last_use = tree.parent
+                    first_references[val.of] = tree.ir_idx
+                elif tree.kind == TreeKind.StLocal:
+                    first_references[tree.operands[0]] = tree.ir_idx
+                elif tree.parent != None:
+                    temp_ranges.append((tree.ir_idx, tree.parent.ir_idx))
+            first = tree.ir_idx
             
             # Activate values that should be active from the predecessors
             if selected_predecessor is not None:
                 block.active_in_set = selected_predecessor.source.active_out_set
+
+                split = self.split_locals.get(id(block))
+                if split is not None:
+                    # Split locals aren't used in the block, leaving them out of the active in set is enough to keep them
+                    # in memory. They get spilled on the edges entering the block
+                    block.active_in_set = [active_in for active_in in block.active_in_set if active_in.val.of not in split]
                 for active_in in block.active_in_set:
                     val = active_in.val
                     reg = active_in.reg
@@ -190,15 +484,35 @@ class Lsra:
             else:
                 block.active_in_set = []
 
+            if self.convention is not None:
+                self.constrained_trees = [tree.ir_idx for tree in block.tree_execution_order() if self.convention.constrained(tree)]
+
+            # Calls and two-address BinOps need registers the pressure doesn't count
+            self.spill_free = self.fast_path and self.convention is None and not self.two_address and self.block_pressure(block, first, first_references, temp_ranges) <= len(self.registers)
+            if self.spill_free:
+                self.spill_free_blocks += 1
+
             # Linear scan
             for tree in block.tree_execution_order():
                 self.current_tree = tree
 
+                if self.spill_free:
+                    self.allocate_spill_free_tree(tree)
+                    continue
+
+                if self.convention is not None and self.convention.constrained(tree):
+                    self.allocate_constrained_tree(tree)
+                    self.free_tree_vals()
+                    continue
+
                 # Make sure all the operands are in a register
-                for subtree in tree.subtrees:
-                    tree_val = self.get_tree_val(subtree)
+                operand_vals = [self.get_tree_val(subtree) for subtree in tree.subtrees]
+                for tree_val in operand_vals:
                     if tree_val.active_in is None:
-                        self.activate(tree_val)
+                        self.activate(tree_val, forbid_spills=operand_vals)
+
+                for subtree, tree_val in zip(tree.subtrees, operand_vals):
+                    subtree.use_reg = tree_val.active_in
 
                 self.free_active_vals()
 
@@ -207,17 +521,20 @@ class Lsra:
                     src_val = self.get_tree_val(tree.subtrees[0])                    
                     dst_val = self.var_vals[tree.operands[0]]
 
-                    if dst_val.of not in self.var_first_writes:
-                        self.var_first_writes[dst_val.of] = tree
-
-                    src_reg = tree.subtrees[0].reg
-                    if dst_val.active_in is None:
-                        self.activate(dst_val, restore=self.var_first_writes[dst_val.of] is not tree, forbid_restores=[src_reg])
-                    dst_reg = dst_val.active_in
-                    tree.operands.append(dst_reg)
+                    src_reg = tree.subtrees[0].use_reg
+                    if dst_val.last_use is None or (isinstance(dst_val.last_use, Tree) and dst_val.last_use.ir_idx <= tree.ir_idx):
+                        # Dead store : the local isn't read afterwards (it was freed by free_active_vals), nothing to do
+                        tree.operands.append(src_reg)
+                    else:
+                        if dst_val.active_in is None:
+                            # The old value of the local is overwritten, no need to restore it
+                            self.activate(dst_val, restore=False)
+                        self.mark_dirty(dst_val)
+                        dst_reg = dst_val.active_in
+                        tree.operands.append(dst_reg)
 
-                    if src_reg != dst_reg:
-                        tree.post_moves.append(RegMove(val_from=src_val, reg_from=src_reg, val_to=dst_val, reg_to=dst_reg))                        
+                        if src_reg != dst_reg:
+                            tree.post_moves.append(self.pool.move(src_val, src_reg, dst_val, dst_reg))
                 elif tree.kind == TreeKind.LdLocal:
                     # Special case : loading locals
                     var_val = self.var_vals[tree.operands[0]]
@@ -227,8 +544,11 @@ class Lsra:
                     tree.reg = var_val.active_in
                 else:
                     if tree.parent != None:
-                        tree_val = Value(of=tree, active_in=None, last_use=tree.parent)
-                        self.activate(tree_val, restore=False)
+                        tree_val = self.pool.value(tree, None, tree.parent)
+                        if self.two_address and tree.kind == TreeKind.BinOp:
+                            self.activate_two_address_result(tree, tree_val)
+                        else:
+                            self.activate(tree_val, restore=False)
                         tree.reg = tree_val.active_in
 
                         self.tree_vals.append(tree_val)
@@ -0,0 +1,177 @@
+from __future__ import annotations
+import dataclasses
+from ir import *
+
+# Cleanup passes run on the ir before allocation, so that the allocators don't spend registers on values that are known
+# at compile time or never read :
+# - Constant folding : BinOps of two Consts become a Const, and Branches on a Const become a Jmp (the blocks only
+#   reachable through the other edge are removed)
+# - Copy / constant propagation, inside blocks : after StLocal a (LdLocal b) or StLocal a (Const c), the reads of a are
+#   replaced by b or c until a or b is written again
+# - Dead store elimination : StLocals of locals that aren't alive after them (or copying a local to itself) are removed,
+#   as well as Discards. The trees have no side effects, except dividing by zero, which isn't kept for values that are
+#   never used, and Calls : the callees stand for functions the ir can't see into, statements with calls are kept
+# Propagation exposes more folding (within the same walk) and more dead stores (copies nothing reads anymore), dead
+# stores are removed until there are none left since removing one can make the stores feeding it (in other blocks) dead.
+
+@dataclasses.dataclass
+class OptimizationStats:
+    # BinOps replaced by a Const
+    folded: int = 0
+    # Branches replaced by a Jmp, and the blocks removed because of them
+    folded_branches: int = 0
+    removed_blocks: int = 0
+    # LdLocals replaced by the source of a copy or a Const
+    propagated: int = 0
+    # StLocal and Discard statements removed
+    dead_stores: int = 0
+    # Trees removed by all the passes
+    removed_trees: int = 0
+
+def tree_size(tree: Tree) -> int:
+    return sum(1 for _ in tree.tree_execution_order())
+
+def evaluate(operator: Operator, lhs: int, rhs: int) -> int | None:
+    match operator:
+        case Operator.Add:
+            return lhs + rhs
+        case Operator.Sub:
+            return lhs - rhs
+        case Operator.Mul:
+            return lhs * rhs
+        case Operator.Div:
+            # Left for the run time to fail
+            return lhs // rhs if rhs != 0 else None
+        case Operator.Eq:
+            return 1 if lhs == rhs else 0
+
+def make_const(tree: Tree, value: int) -> None:
+    tree.kind = TreeKind.Const
+    tree.subtrees = []
+    tree.operands = [value]
+
+# Folds the tree bottom up
+def fold_tree(tree: Tree, stats: OptimizationStats) -> None:
+    for subtree in tree.subtrees:
+        fold_tree(subtree, stats)
+
+    if tree.kind == TreeKind.BinOp and all(subtree.kind == TreeKind.Const for subtree in tree.subtrees):
+        lhs, rhs = tree.subtrees[0].operands[0], tree.subtrees[1].operands[0]
+        if tree.swapped_operands():
+            lhs, rhs = rhs, lhs
+        value = evaluate(tree.operands[0], lhs, rhs)
+        if value != None:
+            make_const(tree, value)
+            stats.folded += 1
+            stats.removed_trees += 2
+
+# Copy propagation and folding, one block at a time
+def propagate_block(block: BasicBlock, stats: OptimizationStats) -> None:
+    # Local -> the Const or LdLocal tree it's a copy of
+    copies: dict[int, Tree] = dict()
+
+    statement = block.first_statemenent
+    while statement != None:
+        for tree in statement.tree.tree_execution_order():
+            if tree.kind == TreeKind.LdLocal and tree.operands[0] in copies:
+                source = copies[tree.operands[0]]
+                tree.kind = source.kind
+                tree.operands = list(source.operands)
+                stats.propagated += 1
+
+        fold_tree(statement.tree, stats)
+
+        tree = statement.tree
+        if tree.kind == TreeKind.StLocal:
+            local = tree.operands[0]
+            copies = {
+                copy: source for copy, source in copies.items()
+                if copy != local and not (source.kind == TreeKind.LdLocal and source.operands[0] == local)
+            }
+            source = tree.subtrees[0]
+            if source.kind == TreeKind.Const or (source.kind == TreeKind.LdLocal and source.operands[0] != local):
+                copies[local] = source
+
+        statement = statement.next_statement
+
+# Returns True if a Branch was folded
+def fold_branch(block: BasicBlock, stats: OptimizationStats) -> bool:
+    terminator = block.last_statement.tree
+    if terminator.kind != TreeKind.Branch or terminator.subtrees[0].kind != TreeKind.Const:
+        return False
+
+    taken = terminator.operands[0] if terminator.subtrees[0].operands[0] == 1 else terminator.operands[1]
+    terminator.kind = TreeKind.Jmp
+    terminator.subtrees = []
+    terminator.operands = [taken]
+    stats.folded_branches += 1
+    stats.removed_trees += 1
+    return True
+
+def has_call(tree: Tree) -> bool:
+    return any(t.kind == TreeKind.Call for t in tree.tree_execution_order())
+
+# StLocal a (LdLocal a), left by the propagation of a copy going the other way
+def is_self_copy(tree: Tree) -> bool:
+    return tree.subtrees[0].kind == TreeKind.LdLocal and tree.subtrees[0].operands[0] == tree.operands[0]
+
+# Returns the number of statements removed, and whether some of them were reading locals : the stores of these locals in
+# the predecessors may be dead now
+# Precondition : recompute_alive_sets executed
+def remove_dead_stores(ir: Ir, stats: OptimizationStats) -> tuple[int, bool]:
+    removed = 0
+    removed_reads = False
+    for block in ir.block_execution_order():
+        alive = set(block.alive_out_set)
+
+        statement = block.last_statement
+        while statement != None:
+            prev_statement = statement.prev_statement
+            tree = statement.tree
+            removable = tree.kind == TreeKind.Discard or (tree.kind == TreeKind.StLocal and (tree.operands[0] not in alive or is_self_copy(tree)))
+            if removable and not has_call(tree):
+                block.remove_statement(statement)
+                stats.removed_trees += tree_size(tree)
+                removed += 1
+                removed_reads = removed_reads or any(t.kind == TreeKind.LdLocal for t in tree.tree_execution_order())
+            else:
+                for t in tree.tree_reverse_execution_order():
+                    if t.kind == TreeKind.LdLocal:
+                        alive.add(t.operands[0])
+                    elif t.kind == TreeKind.StLocal:
+                        alive.discard(t.operands[0])
+                    elif t.kind == TreeKind.Guard:
+                        alive |= t.operands[0].target.alive_in_set
+            statement = prev_statement
+
+    stats.dead_stores += removed
+    return removed, removed_reads
+
+# Runs all the passes. The predecessors are only recomputed when a branch was folded, the alive sets and the tree indices
+# are always recomputed
+def optimize(ir: Ir, stats: OptimizationStats | None = None) -> OptimizationStats:
+    stats = stats if stats != None else OptimizationStats()
+
+    branches_folded = False
+    for block in ir.block_execution_order():
+        propagate_block(block, stats)
+        if fold_branch(block, stats):
+            branches_folded = True
+
+    if branches_folded:
+        ir.recompute_predecessors()
+        reachable = set(id(block) for block in ir.reverse_postorder())
+        stats.removed_trees += sum(1 for block in ir.block_execution_order() if id(block) not in reachable for _ in block.tree_execution_order())
+        stats.removed_blocks += ir.remove_unreachable_blocks()
+        ir.recompute_predecessors()
+
+    ir.recompute_alive_sets()
+    while True:
+        removed, removed_reads = remove_dead_stores(ir, stats)
+        if removed != 0:
+            ir.recompute_alive_sets()
+        if not removed_reads:
+            break
+
+    ir.reindex()
+    return stats
@@ -0,0 +1,279 @@
+from __future__ import annotations
+import dataclasses
+import itertools
+from ir import *
+from rlsra import RegSpill, RegRestore, RegMove
+
+# Peephole pass over the spills, restores and moves of an allocated ir. The allocators leave some avoidable traffic :
+# restores into a register that already holds the value, spills of values memory already has, moves whose source and
+# destination are the same, copies of copies... Every block is walked with the value of every register and memory slot
+# (as a symbol : two locations holding the same symbol are known to hold the same value), following the semantics of the
+# Interpreter : at every tree the pre annotations run, then the tree, then the post annotations. In an annotation list,
+# the spills are done first, then the restores read the memory and the moves read the registers as they were before the
+# list.
+# - Going forward, annotations that don't change the location they write are removed, restores of a value a register
+#   already holds become moves from that register, and the moves / spills reading a copy read the register the copy was
+#   made from instead
+# - Going backward, annotations writing a register or memory slot that nothing reads afterwards are removed. The
+#   registers of the active out sets are read when leaving the block, and the memory of the locals too (edges restore
+#   from it). The memory of the tree temps never leaves the block
+# Both walks are repeated until nothing changes : reading from the source of a copy leaves moves nobody reads, turning
+# restores into moves leaves spills nobody reads.
+# Only the annotations change, the registers of the trees and the active sets stay the same.
+
+@dataclasses.dataclass
+class PeepholeStats:
+    removed_spills: int = 0
+    removed_restores: int = 0
+    removed_moves: int = 0
+    # Restores replaced by a move from a register holding the value
+    restores_to_moves: int = 0
+    # Moves and spills reading the source of a copy instead of the copy
+    forwarded: int = 0
+
+    def removed(self) -> int:
+        return self.removed_spills + self.removed_restores + self.removed_moves
+
+# Memory slot of a value : the Interpreter stores the locals and the tree temps apart
+def slot(val) -> int:
+    return val.of if isinstance(val.of, int) else -1 - val.of.ir_idx
+
+AnnotationList = tuple[list[RegSpill], list[RegRestore], list[RegMove]]
+
+def annotation_lists(tree: Tree) -> list[AnnotationList]:
+    # The post annotations of a Ret never run
+    if tree.kind == TreeKind.Ret:
+        return [(tree.pre_spills, tree.pre_restores, tree.pre_moves)]
+    return [(tree.pre_spills, tree.pre_restores, tree.pre_moves), (tree.post_spills, tree.post_restores, tree.post_moves)]
+
+# Registers the tree itself reads and writes when the Interpreter runs it
+def tree_reads(tree: Tree) -> list[int]:
+    match tree.kind:
+        case TreeKind.BinOp | TreeKind.Call:
+            return [subtree.use_reg for subtree in tree.subtrees]
+        case TreeKind.Ret | TreeKind.Branch | TreeKind.Guard:
+            return [tree.subtrees[0].use_reg]
+    return []
+
+def tree_writes(tree: Tree, convention: CallingConvention | None) -> list[int]:
+    writes = [tree.reg] if tree.kind in (TreeKind.Const, TreeKind.BinOp, TreeKind.Call) else []
+    if convention != None and convention.constrained(tree):
+        writes += convention.clobbered_regs(tree)
+    return writes
+
+def active_out_regs(edge: BlockEdge) -> set[int]:
+    active_out_set = edge.active_out_set if edge.active_out_set != None else edge.source.active_out_set
+    return set(active.reg for active in active_out_set)
+
+# Registers written by more than one restore / move of the list : only the last write counts, the backward walk removes
+# the others
+def written_twice(restores: list[RegRestore], moves: list[RegMove]) -> set[int]:
+    seen = set()
+    twice = set()
+    for reg in itertools.chain((restore.reg for restore in restores), (move.reg_to for move in moves)):
+        if reg in seen:
+            twice.add(reg)
+        seen.add(reg)
+    return twice
+
+class BlockPeephole:
+    block: BasicBlock
+    convention: CallingConvention | None
+    local_vars: int
+    stats: PeepholeStats
+    # Trees of the block in execution order, with their annotation lists and the registers they read and write
+    steps: list[tuple[Tree, list[AnnotationList], list[int], list[int]]]
+
+    # Forward walk. Locations that weren't written yet in the block get a new symbol when first read
+    symbols: Iterator[int]
+    registers: dict[int, int]
+    memory: dict[int, int]
+    # Register a symbol was first written to, by the tree computing it or by a restore
+    origins: dict[int, int]
+
+    def __init__(self, block: BasicBlock, local_vars: int, convention: CallingConvention | None, stats: PeepholeStats) -> None:
+        self.block = block
+        self.convention = convention
+        self.local_vars = local_vars
+        self.stats = stats
+
+    def register(self, reg: int) -> int:
+        if reg not in self.registers:
+            self.write_register(reg, next(self.symbols))
+        return self.registers[reg]
+
+    def write_register(self, reg: int, symbol: int) -> None:
+        self.registers[reg] = symbol
+        origin = self.origins.get(symbol)
+        if origin == None or self.registers.get(origin) != symbol:
+            self.origins[symbol] = reg
+
+    def memory_slot(self, key: int) -> int:
+        if key not in self.memory:
+            self.memory[key] = next(self.symbols)
+        return self.memory[key]
+
+    # Register the value of reg was copied from, if it still holds it
+    def copy_source(self, reg: int) -> int:
+        symbol = self.register(reg)
+        origin = self.origins[symbol]
+        return origin if self.registers.get(origin) == symbol else reg
+
+    # Returns True if an annotation was changed
+    def forward_list(self, spills: list[RegSpill], restores: list[RegRestore], moves: list[RegMove]) -> bool:
+        if not (spills or restores or moves):
+            return False
+        changed = False
+
+        for spill in spills[:]:
+            source = self.copy_source(spill.reg)
+            if source != spill.reg:
+                spill.reg = source
+                self.stats.forwarded += 1
+                changed = True
+            symbol = self.register(spill.reg)
+            if self.memory_slot(slot(spill.val)) == symbol:
+                spills.remove(spill)
+                self.stats.removed_spills += 1
+                changed = True
+            else:
+                self.memory[slot(spill.val)] = symbol
+
+        # The restores and moves read the registers as they were before the list
+        twice = written_twice(restores, moves)
+        writes = []
+
+        for restore in restores[:]:
+            symbol = self.memory_slot(slot(restore.val))
+            if restore.reg not in twice:
+                if self.register(restore.reg) == symbol:
+                    restores.remove(restore)
+                    self.stats.removed_restores += 1
+                    changed = True
+                    continue
+                holder = next((reg for reg, held in self.registers.items() if held == symbol), None)
+                if holder != None:
+                    restores.remove(restore)
+                    moves.append(RegMove(val_from=restore.val, reg_from=self.copy_source(holder), val_to=restore.val, reg_to=restore.reg))
+                    self.stats.restores_to_moves += 1
+                    changed = True
+                    continue
+            writes.append((restore.reg, symbol))
+
+        for move in moves[:]:
+            source = self.copy_source(move.reg_from)
+            if source != move.reg_from:
+                move.reg_from = source
+                self.stats.forwarded += 1
+                changed = True
+            symbol = self.register(move.reg_from)
+            if move.reg_to not in twice and self.register(move.reg_to) == symbol:
+                moves.remove(move)
+                self.stats.removed_moves += 1
+                changed = True
+                continue
+            writes.append((move.reg_to, symbol))
+
+        for reg, symbol in writes:
+            self.write_register(reg, symbol)
+
+        return changed
+
+    def forward(self) -> bool:
+        self.symbols = itertools.count()
+        self.registers = dict()
+        self.memory = dict()
+        self.origins = dict()
+
+        changed = False
+        for _, lists, _, writes in self.steps:
+            changed = self.forward_list(*lists[0]) or changed
+            for reg in writes:
+                self.write_register(reg, next(self.symbols))
+            for annotations in lists[1:]:
+                changed = self.forward_list(*annotations) or changed
+
+        return changed
+
+    # live_registers and live_slots : read after the list, updated to the ones read before it
+    def backward_list(self, annotations: AnnotationList, live_registers: set[int], live_slots: set[int]) -> bool:
+        spills, restores, moves = annotations
+        count = len(spills) + len(restores) + len(moves)
+        if count == 0:
+            return False
+
+        # The moves come after the restores, the last write of a register wins
+        written = set()
+        for move in reversed(moves[:]):
+            if move.reg_to not in live_registers or move.reg_to in written:
+                moves.remove(move)
+                self.stats.removed_moves += 1
+            else:
+                written.add(move.reg_to)
+        for restore in reversed(restores[:]):
+            if restore.reg not in live_registers or restore.reg in written:
+                restores.remove(restore)
+                self.stats.removed_restores += 1
+            else:
+                written.add(restore.reg)
+
+        # The restores read the memory after the spills
+        live_slots |= set(slot(restore.val) for restore in restores)
+        stored = set()
+        for spill in reversed(spills[:]):
+            if slot(spill.val) not in live_slots or slot(spill.val) in stored:
+                spills.remove(spill)
+                self.stats.removed_spills += 1
+            else:
+                stored.add(slot(spill.val))
+        live_slots -= stored
+
+        live_registers -= written
+        live_registers |= set(move.reg_from for move in moves)
+        live_registers |= set(spill.reg for spill in spills)
+
+        return len(spills) + len(restores) + len(moves) != count
+
+    def backward(self) -> bool:
+        terminator = self.block.last_statement.tree
+        live_registers = set()
+        live_slots = set()
+        if terminator.kind != TreeKind.Ret:
+            for edge in self.block.terminator_edges():
+                live_registers |= active_out_regs(edge)
+            live_slots = set(range(self.local_vars))
+
+        changed = False
+        for tree, lists, reads, writes in reversed(self.steps):
+            for annotations in reversed(lists[1:]):
+                if tree.kind == TreeKind.Guard:
+                    # The side exit is taken after the post annotations
+                    live_registers |= active_out_regs(tree.operands[0])
+                    live_slots |= set(range(self.local_vars))
+                changed = self.backward_list(annotations, live_registers, live_slots) or changed
+            live_registers.difference_update(writes)
+            live_registers.update(reads)
+            changed = self.backward_list(lists[0], live_registers, live_slots) or changed
+
+        return changed
+
+    def run(self) -> None:
+        self.steps = [(tree, annotation_lists(tree), tree_reads(tree), tree_writes(tree, self.convention)) for tree in self.block.tree_execution_order()]
+        if not any(spills or restores or moves for _, lists, _, _ in self.steps for spills, restores, moves in lists):
+            return
+        while True:
+            changed = self.forward()
+            changed = self.backward() or changed
+            if not changed:
+                break
+
+# convention : the one the ir was allocated with, the trees constrained by it clobber registers
+# Precondition : the ir was allocated
+def peephole(ir: Ir, convention: CallingConvention | None = None, stats: PeepholeStats | None = None) -> PeepholeStats:
+    stats = stats if stats != None else PeepholeStats()
+    for block in ir.block_execution_order():
+        if block.active_in_set is None:
+            # Never reached by the allocator
+            continue
+        BlockPeephole(block, ir.local_vars, convention, stats).run()
+    return stats
@@ -0,0 +1,250 @@
+from __future__ import annotations
+import argparse
+import collections
+import dataclasses
+import itertools
+import multiprocessing
+import resource
+import time
+from stack_instruction import *
+from stack_interpreter import StackInterpreter
+from interpreter import Interpreter
+from fuzz import ALLOCATORS, UNCONSTRAINED_ALLOCATORS, TWO_ADDRESS_ALLOCATORS, allocate
+from rlsra import RecordPool
+from sweep import count_annotations
+from corpus import *
+from spill_strategy import SPILL_STRATEGIES, FurthestUse
+
+# Streaming compile pipeline, for corpora too large to be held in memory : the functions are read lazily and go through
+# the stages one at a time, and nothing is kept from a function once its result is emitted.
+# Stages : read -> import (import_to_ir, liveness included) -> allocate -> verify (optional) -> emit
+# In a single process, every stage is a generator pulling its input from the previous one : there is at most one function
+# between two stages, and a stage only runs when the next one asks for a function (backpressure). With worker processes,
+# the parent reads and emits and the workers do the rest : at most queue_size functions are sent ahead of the one being
+# emitted, the reading stage waits for the results to come back.
+# Once emitted, the annotations of the ir are released into the RecordPool of the process (Rlsra and Lsra) and the ir is
+# dropped, so the memory stays the same however many functions go through.
+
+STAGES = ["read", "import", "allocate", "verify", "emit"]
+
+@dataclasses.dataclass
+class StageCounters:
+    functions: int = 0
+    seconds: float = 0.0
+
+    def throughput(self) -> float:
+        return self.functions / self.seconds if self.seconds != 0 else 0.0
+
+@dataclasses.dataclass
+class PipelineConfig:
+    allocator: str = "rlsra"
+    num_regs: int = 4
+    spill_strategy: str = FurthestUse.name
+    # Allocate and run with the default calling convention
+    calls: bool = False
+    # Run every allocated function with the Interpreter and compare with the StackInterpreter
+    verify: bool = False
+    # Steps the StackInterpreter may take when verifying, None for no limit. The allocated function gets twice what the
+    # reference needed, verifying a function that doesn't terminate raises instead of running forever
+    max_steps: int | None = None
+    # Worker processes, 1 to run every stage in this process
+    jobs: int = 1
+    # Functions sent to the workers ahead of the one being emitted
+    queue_size: int = 64
+
+@dataclasses.dataclass
+class CompileResult:
+    name: str
+    instructions: int
+    blocks: int
+    # Static counts (see sweep.count_annotations)
+    spills: int
+    restores: int
+    moves: int
+    # None when not verified
+    verified: bool | None = None
+
+    def __str__(self) -> str:
+        verified = "" if self.verified == None else (" ok" if self.verified else " MISMATCH")
+        return f"{self.name} instructions {self.instructions} blocks {self.blocks} spills {self.spills} restores {self.restores} moves {self.moves}{verified}"
+
+class Pipeline:
+    config: PipelineConfig
+    counters: dict[str, StageCounters]
+    # Records of the released irs, reused by the next allocations of the process
+    pool: RecordPool | None
+
+    def __init__(self, config: PipelineConfig) -> None:
+        self.config = config
+        self.counters = {stage: StageCounters() for stage in STAGES}
+        self.pool = RecordPool() if config.allocator not in UNCONSTRAINED_ALLOCATORS else None
+
+    def count(self, stage: str, start: float) -> None:
+        counters = self.counters[stage]
+        counters.functions += 1
+        counters.seconds += time.perf_counter() - start
+
+    def convention(self) -> CallingConvention | None:
+        if self.config.calls and self.config.allocator not in UNCONSTRAINED_ALLOCATORS:
+            return CallingConvention.default(self.config.num_regs)
+        return None
+
+    def read(self, programs: Iterable[BenchmarkProgram]) -> Iterator[BenchmarkProgram]:
+        programs = iter(programs)
+        while True:
+            start = time.perf_counter()
+            program = next(programs, None)
+            if program == None:
+                return
+            self.count("read", start)
+            yield program
+
+    def import_functions(self, programs: Iterator[BenchmarkProgram]) -> Iterator[tuple[BenchmarkProgram, Ir]]:
+        for program in programs:
+            start = time.perf_counter()
+            ir = import_to_ir(program.fn)
+            self.count("import", start)
+            yield program, ir
+
+    def allocate(self, irs: Iterator[tuple[BenchmarkProgram, Ir]]) -> Iterator[tuple[BenchmarkProgram, Ir]]:
+        for program, ir in irs:
+            start = time.perf_counter()
+            allocate(ir, self.config.allocator, self.config.num_regs, self.config.spill_strategy, self.convention(), self.pool)
+            self.count("allocate", start)
+            yield program, ir
+
+    def verify(self, irs: Iterator[tuple[BenchmarkProgram, Ir]]) -> Iterator[tuple[BenchmarkProgram, Ir, bool | None]]:
+        for program, ir in irs:
+            if not self.config.verify:
+                yield program, ir, None
+                continue
+
+            start = time.perf_counter()
+            reference = StackInterpreter(program.fn, max_steps=self.config.max_steps)
+            expected = reference.run(program.args)
+            max_steps = 2 * reference.step_count + 100 if self.config.max_steps != None else None
+            interpreter = Interpreter(num_regs=self.config.num_regs, ir=ir, max_steps=max_steps, convention=self.convention(), two_address=self.config.allocator in TWO_ADDRESS_ALLOCATORS)
+            verified = interpreter.run(program.args) == expected
+            self.count("verify", start)
+            yield program, ir, verified
+
+    # Counts the annotations and releases the ir
+    def summarize(self, program: BenchmarkProgram, ir: Ir, verified: bool | None) -> CompileResult:
+        counts = count_annotations(ir, self.config.num_regs)
+        result = CompileResult(
+            name=program.name,
+            instructions=len(program.fn.instructions),
+            blocks=sum(1 for _ in ir.block_execution_order()),
+            spills=counts.spills,
+            restores=counts.restores,
+            moves=counts.moves,
+            verified=verified
+        )
+        if self.pool != None:
+            self.pool.release(ir)
+        return result
+
+    # The stages after reading, for a single function : what the workers run
+    def compile(self, program: BenchmarkProgram) -> CompileResult:
+        for program, ir, verified in self.verify(self.allocate(self.import_functions(iter([program])))):
+            return self.summarize(program, ir, verified)
+
+    # sink : called with every result, in the order of the programs
+    def run(self, programs: Iterable[BenchmarkProgram], sink: Callable[[CompileResult], None] | None = None) -> Iterator[CompileResult]:
+        if self.config.jobs == 1:
+            results = (self.summarize(*item) for item in self.verify(self.allocate(self.import_functions(self.read(programs)))))
+            for result in results:
+                start = time.perf_counter()
+                if sink != None:
+                    sink(result)
+                self.count("emit", start)
+                yield result
+            return
+
+        with multiprocessing.Pool(processes=self.config.jobs, initializer=_init_worker, initargs=(self.config,)) as pool:
+            pending: collections.deque = collections.deque()
+            for program in itertools.chain(self.read(programs), [None]):
+                if program != None:
+                    pending.append(pool.apply_async(_compile_in_worker, (program,)))
+                # Waits for the oldest function once the queue is full, and for all of them after the last one
+                while len(pending) != 0 and (len(pending) >= self.config.queue_size or program == None):
+                    result, counters = pending.popleft().get()
+                    for stage, (functions, seconds) in counters.items():
+                        self.counters[stage].functions += functions
+                        self.counters[stage].seconds += seconds
+                    start = time.perf_counter()
+                    if sink != None:
+                        sink(result)
+                    self.count("emit", start)
+                    yield result
+
+# Pipeline of a worker process, the counters of every function are sent back with its result
+worker_pipeline: Pipeline | None = None
+
+def _init_worker(config: PipelineConfig) -> None:
+    global worker_pipeline
+    worker_pipeline = Pipeline(dataclasses.replace(config, jobs=1))
+
+def _compile_in_worker(program: BenchmarkProgram) -> tuple[CompileResult, dict[str, tuple[int, float]]]:
+    for counters in worker_pipeline.counters.values():
+        counters.functions = 0
+        counters.seconds = 0.0
+    result = worker_pipeline.compile(program)
+    return result, {stage: (counters.functions, counters.seconds) for stage, counters in worker_pipeline.counters.items() if counters.functions != 0}
+
+# Peak resident memory in MB, of this process and of the largest worker
+def peak_memory() -> tuple[float, float]:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Streams generated functions through import, allocation and verification without keeping them in memory")
+    parser.add_argument("--count", type=int, default=10_000, help="number of generated functions")
+    parser.add_argument("--seed", type=int, default=0, help="first seed, functions use consecutive seeds")
+    parser.add_argument("--allocator", choices=ALLOCATORS, default="rlsra")
+    parser.add_argument("--strategy", choices=SPILL_STRATEGIES.keys(), default=FurthestUse.name, help="spill heuristic used by the allocator")
+    parser.add_argument("--regs", type=int, default=4)
+    parser.add_argument("--calls", action="store_true", help="generate calls, allocated and run with the default calling convention")
+    parser.add_argument("--verify", action="store_true", help="run every function with the Interpreter and compare with the reference")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes")
+    parser.add_argument("--queue", type=int, default=64, help="functions sent to the workers ahead of the one being emitted")
+    parser.add_argument("--output", help="write the result of every function to this file")
+    parser.add_argument("--report", type=int, default=1000, metavar="COUNT", help="show the counters every COUNT functions")
+    args = parser.parse_args()
+
+    config = PipelineConfig(
+        allocator=args.allocator,
+        num_regs=args.regs,
+        spill_strategy=args.strategy,
+        calls=args.calls,
+        verify=args.verify,
+        jobs=args.jobs,
+        queue_size=args.queue,
+    )
+    pipeline = Pipeline(config)
+    programs = itertools.islice(iter_generated_programs(args.seed, args.calls), args.count)
+
+    def report(done: int) -> None:
+        own, workers = peak_memory()
+        print(f"{done} functions, peak memory {own:.1f} MB" + (f" (workers {workers:.1f} MB)" if args.jobs != 1 else ""))
+        for stage, counters in pipeline.counters.items():
+            if counters.functions != 0:
+                print(f"  {stage:<10} {counters.functions:>8} functions {counters.seconds:>8.2f} s {counters.throughput():>10.0f} functions/s")
+
+    output = open(args.output, "w") if args.output != None else None
+    mismatches = 0
+    done = 0
+    try:
+        for result in pipeline.run(programs, (lambda result: output.write(f"{result}\n")) if output != None else None):
+            done += 1
+            if result.verified == False:
+                mismatches += 1
+                print(f"{result.name} : the allocated function doesn't return the same result as the reference")
+            if done % args.report == 0:
+                report(done)
+    finally:
+        if output != None:
+            output.close()
+
+    if done % args.report != 0 or done == 0:
+        report(done)
+    exit(1 if mismatches != 0 else 0)
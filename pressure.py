@@ -0,0 +1,90 @@
+from __future__ import annotations
+import itertools
+import ir as irepr
+
+# Register pressure : the largest number of values an allocator can have in registers at the same time in a block, from
+# the liveness of the locals and the shape of the trees. When it's at most the number of registers, a register is always
+# free when a value needs one : the allocators take a fast path in the block (see Rlsra.spill_free and Lsra.spill_free),
+# without register orders, spill candidates or clean value tracking.
+# Both scans keep some values longer than liveness says, each of them gets its own bound :
+# - Rlsra (reverse) : the locals are active from their last use (going in reverse) to the store that defines them, as
+#   liveness says, except for copies where the source is activated while the destination is still active
+# - Lsra (forward) : the locals are active from their first reference (or the start of the block, for the ones in a
+#   register there) to their last use, holes included
+# The temps are active from the tree defining them to their parent in both scans.
+# Only the unconstrained allocation is covered : calls and two-address BinOps need registers of their own.
+
+# limit : stops as soon as the pressure is over it (the allocators only need to know if it fits)
+# Precondition : recompute_alive_sets executed
+def reverse_scan_pressure(block: irepr.BasicBlock, limit: int | None = None) -> int:
+    live = set(block.alive_out_set)
+    # Temps defined earlier in the block and read by a tree that was already scanned
+    temps = 0
+    pressure = len(live)
+    if limit != None and pressure > limit:
+        return pressure
+
+    # Same order as BasicBlock.tree_reverse_execution_order without the generators, this runs before every allocation.
+    # LdLocals are handled with their parent and never visited
+    statement = block.last_statement
+    while statement != None:
+        trees = [statement.tree]
+        while len(trees) != 0:
+            tree = trees.pop()
+
+            if tree.kind == irepr.TreeKind.StLocal:
+                local = tree.operands[0]
+                subtree = tree.subtrees[0]
+                if subtree.kind == irepr.TreeKind.LdLocal:
+                    # The source is activated before the destination is freed
+                    live.add(subtree.operands[0])
+                    demand = len(live) + temps
+                    if subtree.operands[0] != local:
+                        live.discard(local)
+                else:
+                    # The subtree takes the register of the destination
+                    live.discard(local)
+                    temps += 1
+                    demand = len(live) + temps
+                    trees.append(subtree)
+            else:
+                if tree.kind == irepr.TreeKind.Guard:
+                    live |= tree.operands[0].target.alive_in_set
+
+                # The value of the tree is freed before its operands are activated
+                if tree.parent != None:
+                    temps -= 1
+                # The last subtree comes out first
+                for subtree in tree.subtrees:
+                    if subtree.kind == irepr.TreeKind.LdLocal:
+                        live.add(subtree.operands[0])
+                    else:
+                        temps += 1
+                        trees.append(subtree)
+                demand = len(live) + temps
+
+            if demand > pressure:
+                pressure = demand
+                if limit != None and pressure > limit:
+                    return pressure
+
+        statement = statement.prev_statement
+
+    return pressure
+
+# ranges : ranges of the values, in ir_idx (start, end), collected by Lsra with the last uses. A value holds a register
+# when the trees after start up to end read their operands, and when the trees from start to before end define their
+# values. first - 1 is the start of the block, last + 1 its end
+def forward_scan_pressure(ranges: list[tuple[int, int]], first: int, last: int) -> int:
+    # Values in registers when the trees read their operands, and when they define their values. The counts before the
+    # first tree and after the last one are never higher than the ones of the first and last trees
+    offset = first - 1
+    reading = [0] * (last - first + 4)
+    defining = [0] * (last - first + 4)
+    for start, end in ranges:
+        reading[start + 1 - offset] += 1
+        reading[end + 1 - offset] -= 1
+        defining[start - offset] += 1
+        defining[end - offset] -= 1
+
+    return max(max(itertools.accumulate(reading)), max(itertools.accumulate(defining)))
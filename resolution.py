@@ -0,0 +1,112 @@
+from __future__ import annotations
+import dataclasses
+from ir import *
+from rlsra import RegSpill, RegRestore, RegMove, ActiveInOut
+
+# Edge resolution : after allocation, the active out set of a block and the active in set of a successor can disagree.
+# The Interpreter reconciles them at runtime in Interpreter.jump, but a real code generator needs the spills, restores
+# and moves to be placed on the edge. This pass materializes them as annotations :
+# - at the end of the source if it only has that successor (on its Jmp)
+# - at the start of the target if it only has that predecessor
+# - otherwise the edge is critical, and a new block is inserted on the edge to hold them
+# Once resolved, the active sets agree on both sides of every edge, so Interpreter.jump has nothing left to do.
+
+@dataclasses.dataclass
+class ResolutionStats:
+    # Edges where the active sets disagreed
+    resolved_edges: int = 0
+    # Of those, the ones that needed a new block
+    split_edges: int = 0
+    spills: int = 0
+    restores: int = 0
+    moves: int = 0
+
+# Same semantics as Interpreter.jump
+def edge_resolution(active_out_set: list[ActiveInOut], active_in_set: list[ActiveInOut]) -> tuple[list[RegSpill], list[RegRestore], list[RegMove]]:
+    spills = []
+    restores = []
+    moves = []
+
+    for active_out in active_out_set:
+        if not any(active_out.val.of == active_in.val.of for active_in in active_in_set):
+            spills.append(RegSpill(val=active_out.val, reg=active_out.reg))
+
+    for active_in in active_in_set:
+        if not any(active_out.val.of == active_in.val.of for active_out in active_out_set):
+            restores.append(RegRestore(val=active_in.val, reg=active_in.reg))
+
+    for active_out in active_out_set:
+        for active_in in active_in_set:
+            if active_out.val.of == active_in.val.of and active_out.reg != active_in.reg:
+                moves.append(RegMove(val_from=active_out.val, reg_from=active_out.reg, val_to=active_in.val, reg_to=active_in.reg))
+
+    return spills, restores, moves
+
+def has_annotations(spills: list, restores: list, moves: list) -> bool:
+    return len(spills) != 0 or len(restores) != 0 or len(moves) != 0
+
+# Precondition : the ir was allocated with Rlsra or Lsra
+def resolve_edges(ir: Ir) -> ResolutionStats:
+    stats = ResolutionStats()
+
+    edges = []
+    for block in ir.block_execution_order():
+        if block.active_in_set is None:
+            # Never reached by the allocator
+            continue
+        for edge in block.outgoing_edges():
+            edges.append(edge)
+
+    # Edges to split are collected first, the block list can't be modified while walking it
+    to_split = []
+    for edge in edges:
+        spills, restores, moves = edge_resolution(edge.source.active_out_set, edge.target.active_in_set)
+        if not has_annotations(spills, restores, moves):
+            continue
+
+        stats.resolved_edges += 1
+        stats.spills += len(spills)
+        stats.restores += len(restores)
+        stats.moves += len(moves)
+
+        terminator = edge.source.last_statement.tree
+        first_tree = next(edge.target.tree_execution_order())
+
+        if terminator.kind == TreeKind.Jmp and not has_annotations(terminator.post_spills, terminator.post_restores, terminator.post_moves):
+            # The terminator's post spills, restores and moves happen right before jumping
+            terminator.post_spills.extend(spills)
+            terminator.post_restores.extend(restores)
+            terminator.post_moves.extend(moves)
+            edge.source.active_out_set = edge.target.active_in_set
+        elif (
+            len(edge.target.predecessors) == 1 and
+            edge.target is not ir.blocks.first and
+            not has_annotations(first_tree.pre_spills, first_tree.pre_restores, first_tree.pre_moves)
+        ):
+            first_tree.pre_spills.extend(spills)
+            first_tree.pre_restores.extend(restores)
+            first_tree.pre_moves.extend(moves)
+            edge.target.active_in_set = edge.source.active_out_set
+        else:
+            to_split.append((edge, spills, restores, moves))
+
+    for edge, spills, restores, moves in to_split:
+        source = edge.source
+        target = edge.target
+        new_block = ir.split_edge(edge)
+
+        jmp = new_block.last_statement.tree
+        jmp.pre_spills.extend(spills)
+        jmp.pre_restores.extend(restores)
+        jmp.pre_moves.extend(moves)
+
+        new_block.active_in_set = source.active_out_set
+        new_block.active_out_set = target.active_in_set
+
+        stats.split_edges += 1
+
+    if len(to_split) != 0:
+        ir.recompute_predecessors()
+        ir.reindex()
+
+    return stats
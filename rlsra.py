@@ -3,6 +3,10 @@ import dataclasses
 from ir import *
 import ir as irepr
 from collections import deque
+import bisect
+from spill_strategy import *
+import splitting
+import pressure
 
 @dataclasses.dataclass
 class Register:
@@ -62,6 +66,116 @@ class ActiveInOut:
     def __str__(self) -> str:
         return f"{self.val} in r{self.reg}"
 
+# Free lists of tree values and annotation records, for processes allocating many functions with the same allocator
+# (see Rlsra.reset) : the objects are reinitialized instead of being allocated again, which keeps the garbage collector
+# quiet.
+# - Tree values go back to the pool when they die during the allocation, unless an annotation refers to them
+# - Annotations, and the values they refer to, go back to the pool with release, once the allocated ir isn't needed
+#   anymore (after emitting or running it)
+# Values of locals belong to the allocators, they're kept from one function to the next.
+class RecordPool:
+    values: list[Value]
+    spills: list[RegSpill]
+    restores: list[RegRestore]
+    moves: list[RegMove]
+    # Ids of the values the annotations of the current function refer to
+    recorded: set[int]
+    # Objects taken from the free lists, and objects that had to be created
+    reused: int
+    created: int
+
+    def __init__(self) -> None:
+        self.values = []
+        self.spills = []
+        self.restores = []
+        self.moves = []
+        self.recorded = set()
+        self.reused = 0
+        self.created = 0
+
+    # Called by the allocators before every function
+    def start_function(self) -> None:
+        self.recorded.clear()
+
+    def value(self, of: int | Tree, active_in: int | None, last_use: Tree | BasicBlock | None) -> Value:
+        if len(self.values) == 0:
+            self.created += 1
+            return Value(of=of, active_in=active_in, last_use=last_use)
+        self.reused += 1
+        val = self.values.pop()
+        val.of = of
+        val.active_in = active_in
+        val.last_use = last_use
+        return val
+
+    def free_value(self, val: Value) -> None:
+        if id(val) not in self.recorded:
+            self.values.append(val)
+
+    def spill(self, val: Value, reg: int) -> RegSpill:
+        self.recorded.add(id(val))
+        if len(self.spills) == 0:
+            self.created += 1
+            return RegSpill(val=val, reg=reg)
+        self.reused += 1
+        spill = self.spills.pop()
+        spill.val = val
+        spill.reg = reg
+        return spill
+
+    def restore(self, val: Value, reg: int) -> RegRestore:
+        self.recorded.add(id(val))
+        if len(self.restores) == 0:
+            self.created += 1
+            return RegRestore(val=val, reg=reg)
+        self.reused += 1
+        restore = self.restores.pop()
+        restore.val = val
+        restore.reg = reg
+        return restore
+
+    def move(self, val_from: Value, reg_from: int, val_to: Value, reg_to: int) -> RegMove:
+        self.recorded.add(id(val_from))
+        self.recorded.add(id(val_to))
+        if len(self.moves) == 0:
+            self.created += 1
+            return RegMove(val_from=val_from, reg_from=reg_from, val_to=val_to, reg_to=reg_to)
+        self.reused += 1
+        move = self.moves.pop()
+        move.val_from = val_from
+        move.reg_from = reg_from
+        move.val_to = val_to
+        move.reg_to = reg_to
+        return move
+
+    # Takes the annotations of the trees back, and the tree values they refer to (a value can be referred to by several
+    # annotations, of different trees)
+    def release_trees(self, trees: Iterable[Tree]) -> None:
+        values: dict[int, Value] = dict()
+        for tree in trees:
+            for spills in (tree.pre_spills, tree.post_spills):
+                for spill in spills:
+                    values[id(spill.val)] = spill.val
+                self.spills.extend(spills)
+                spills.clear()
+            for restores in (tree.pre_restores, tree.post_restores):
+                for restore in restores:
+                    values[id(restore.val)] = restore.val
+                self.restores.extend(restores)
+                restores.clear()
+            for moves in (tree.pre_moves, tree.post_moves):
+                for move in moves:
+                    values[id(move.val_from)] = move.val_from
+                    values[id(move.val_to)] = move.val_to
+                self.moves.extend(moves)
+                moves.clear()
+
+        self.values.extend(val for val in values.values() if not isinstance(val.of, int))
+
+    # The ir can't be run anymore afterwards
+    def release(self, ir: Ir) -> None:
+        self.release_trees(tree for block in ir.block_execution_order() for tree in block.tree_execution_order())
+
 # The main class that performs RLSRA
 class Rlsra:
     registers: list[Register]
@@ -69,33 +183,150 @@ class Rlsra:
     tree_vals: list[Value]
     active_vals: list[Value]
     blocks_to_process: deque[BasicBlock]
+    # Locals that are kept in memory for the whole block, by block id (see splitting.py)
+    # hoist_loop_spills splits live ranges around loops, split_live_ranges also around single blocks
+    hoist_loop_spills: bool
+    split_live_ranges: bool
+    hoisted_locals: dict[int, set[int]]
+    spill_strategy: SpillStrategy
+    # ir_idx of the first LdLocal / StLocal of every local in the current block (see is_clean)
+    first_references: dict[int, int]
+    # Register constraints of calls and divisions (see CallingConvention). None to allocate without constraints
+    convention: CallingConvention | None
+    # ir_idx of the constrained trees of the current block, and of the LdLocals / StLocals of every local, in order
+    constrained_trees: list[int]
+    references: dict[int, list[int]]
+    # Two-address BinOps : the result is written to the register of the left operand (see allocate_two_address_operands)
+    two_address: bool
+    # Tree values and annotations (see RecordPool), can be shared between allocators
+    pool: RecordPool
+    # Blocks whose pressure fits in the registers are allocated without looking for spills (see pressure.py). The
+    # allocation is the same either way. Calls and two-address BinOps need registers the pressure doesn't count, there's
+    # no fast path with a convention or two_address
+    fast_path: bool
+    # Whether the current block fits, and the number of blocks that did since the allocator was created
+    spill_free: bool
+    spill_free_blocks: int
+    # Register orders without a convention (see register_order)
+    temp_order: list[int]
+    local_order: list[int]
+    # Held by the registers of the temps in spill free blocks : values are only needed to spill and restore them, the
+    # register of a temp is just held from its parent to the tree computing it
+    temp_placeholder: Value
 
     current_tree: Tree
 
-    def __init__(self, num_regs) -> None:
+    def __init__(self, num_regs, hoist_loop_spills: bool = False, split_live_ranges: bool = False, spill_strategy: SpillStrategy | None = None, convention: CallingConvention | None = None, two_address: bool = False, pool: RecordPool | None = None, fast_path: bool = True) -> None:
         self.registers = [Register(active_val=None) for _ in range(num_regs)]
         self.var_vals = []
         self.tree_vals = []
         self.active_vals = []
         self.blocks_to_process = deque()
+        self.hoist_loop_spills = hoist_loop_spills
+        self.split_live_ranges = split_live_ranges
+        self.hoisted_locals = dict()
+        self.spill_strategy = spill_strategy if spill_strategy != None else FurthestUse()
+        self.first_references = dict()
+        self.convention = convention
+        self.constrained_trees = []
+        self.references = dict()
+        self.two_address = two_address
+        self.pool = pool if pool != None else RecordPool()
+        self.fast_path = fast_path
+        self.spill_free = False
+        self.spill_free_blocks = 0
+        self.temp_order = list(range(num_regs))
+        self.local_order = list(reversed(range(num_regs)))
+        self.temp_placeholder = Value(of=-1, active_in=None, last_use=None)
+        self.current_tree = None
+
+    # Gets the allocator ready for another function, done by do_reverse_linear_scan. The values of the locals are kept :
+    # once the allocation is done, the annotations only need the index of the local they hold
+    def reset(self, local_vars: int) -> None:
+        for reg in self.registers:
+            reg.active_val = None
+        del self.var_vals[local_vars:]
+        for val in self.var_vals:
+            val.active_in = None
+            val.last_use = None
+        for i in range(len(self.var_vals), local_vars):
+            self.var_vals.append(Value(of=i, active_in=None, last_use=None))
+
+        self.tree_vals.clear()
+        self.active_vals.clear()
+        self.blocks_to_process.clear()
+        self.hoisted_locals = dict()
+        self.first_references = dict()
+        self.constrained_trees = []
+        self.references = dict()
+        self.spill_free = False
         self.current_tree = None
+        self.pool.start_function()
 
     # Spills a value (actually inserts a restore, because we're processing the code in reverse order)
     def spill(self, val: Value) -> None:
-        self.current_tree.post_restores.append(RegRestore(val=val, reg=val.active_in))
+        # A value moved out of a register the current tree clobbers is restored straight into that register
+        move = next((move for move in self.current_tree.post_moves if move.val_from is val and move.reg_from == val.active_in), None)
+        if move != None:
+            self.current_tree.post_moves.remove(move)
+            self.pool.moves.append(move)
+            self.current_tree.post_restores.append(self.pool.restore(val, move.reg_to))
+        else:
+            self.current_tree.post_restores.append(self.pool.restore(val, val.active_in))
         self.registers[val.active_in].active_val = None
         val.active_in = None
         self.active_vals.remove(val)
 
+    # Whether a constrained tree runs between the two trees (excluded)
+    def crosses_constrained_tree(self, start: int, end: int) -> bool:
+        i = bisect.bisect_right(self.constrained_trees, start)
+        return i < len(self.constrained_trees) and self.constrained_trees[i] < end
+
+    # With a convention : the result register of the tree computing the value first (no move needed), then the registers
+    # that survive calls for the values alive across a constrained tree, and the clobbered ones for the other values so
+    # that the callee saved registers stay free for the values that need them
+    def register_order(self, val: Value) -> list[int]:
+        # Attempt to assign variables and tree temps different values in general
+        order = list(range(len(self.registers)))
+        if isinstance(val.of, int):
+            order.reverse()
+        if self.convention == None:
+            return order
+
+        if isinstance(val.of, int):
+            # From the previous reference of the local in the block to the current tree
+            references = self.references.get(val.of, [])
+            i = bisect.bisect_left(references, self.current_tree.ir_idx)
+            crosses = self.crosses_constrained_tree(references[i - 1] if i != 0 else -1, self.current_tree.ir_idx)
+        else:
+            crosses = self.crosses_constrained_tree(val.of.ir_idx, val.last_use.ir_idx)
+
+        caller_saved = self.convention.caller_saved
+        order.sort(key=lambda reg: (reg in caller_saved) == crosses)
+        if not isinstance(val.of, int) and self.convention.constrained(val.of):
+            order.remove(self.convention.result_reg(val.of))
+            order.insert(0, self.convention.result_reg(val.of))
+        return order
+
     # Activates a value by giving it a register. Can spill other values
-    def activate(self, val: Value) -> None:
+    # exclude : registers the value can't be given, preferred : register to try first
+    def activate(self, val: Value, exclude: list[int] = [], preferred: int | None = None) -> None:
+        if self.spill_free:
+            reg_i = self.free_register(self.local_order if isinstance(val.of, int) else self.temp_order)
+            val.active_in = reg_i
+            self.registers[reg_i].active_val = val
+            self.active_vals.append(val)
+            return
+
+        order = self.register_order(val)
+        if preferred != None:
+            order.remove(preferred)
+            order.insert(0, preferred)
+
         # Try to find a free register activate the value with
-        regs = enumerate(self.registers)
-        if isinstance(val.of, int):
-            # Attempt to assign variables and tree temps different values in general
-            regs = enumerate(reversed(self.registers))
-        for reg_i, reg in regs:
-            if reg.active_val == None:
+        for reg_i in order:
+            reg = self.registers[reg_i]
+            if reg.active_val == None and reg_i not in exclude:
                 val.active_in = reg_i
                 reg.active_val = val
 
@@ -103,25 +334,11 @@ class Rlsra:
 
                 return
         
-        # We couldn't find a free register, need to spill a value
-        # The heuristic used to find the best value to spill is to pick the one that was used last in the code
-        best_val = None
-        for active_val in self.active_vals:
-            if active_val.last_use is val.last_use:
-                # The value will be used before or at the same time as the current value, we cannot spill it
-                continue
-
-            if best_val == None:
-                best_val = active_val
-                if isinstance(best_val.last_use, irepr.BasicBlock):
-                    break
-            elif isinstance(active_val.last_use, irepr.BasicBlock):
-                best_val = active_val
-                break
-            elif active_val.last_use.ir_idx > best_val.last_use.ir_idx:
-                best_val = active_val
-        
-        assert best_val != None, "no spill candidate"
+        # We couldn't find a free register, need to spill a value. The spill strategy picks it
+        # Values used before or at the same time as the current value cannot be spilled
+        candidates = [active_val for active_val in self.active_vals if active_val.last_use is not val.last_use and active_val.active_in not in exclude]
+        assert len(candidates) != 0, "no spill candidate"
+        best_val = self.spill_strategy.choose(candidates, self)
 
         reg_i: int = best_val.active_in
         reg = self.registers[reg_i]
@@ -131,6 +348,35 @@ class Rlsra:
         reg.active_val = val
         self.active_vals.append(val)
 
+    # First free register in the order, in spill free blocks (a register is always free, and there are no exclusions or
+    # preferences without a convention)
+    def free_register(self, order: list[int]) -> int:
+        for reg_i in order:
+            if self.registers[reg_i].active_val == None:
+                return reg_i
+
+        assert False, "no free register in a spill free block"
+
+    # SpillContext
+    def use_distance(self, val: Value) -> int:
+        if isinstance(val.last_use, irepr.BasicBlock):
+            return BLOCK_USE_DISTANCE
+        return val.last_use.ir_idx - self.current_tree.ir_idx
+
+    def use_frequency(self, val: Value) -> int:
+        if isinstance(val.last_use, irepr.BasicBlock):
+            return block_frequency(val.last_use)
+        return block_frequency(val.last_use.block)
+
+    # Since we're going in reverse, evicting a value means it has to be in memory earlier in the block : it gets spilled
+    # when its register is assigned, before its first use. A local that isn't referenced earlier in the block doesn't
+    # need that spill, it will be in memory when entering the block
+    def is_clean(self, val: Value) -> bool:
+        if not isinstance(val.of, int):
+            return False
+        first_reference = self.first_references.get(val.of)
+        return first_reference == None or first_reference >= self.current_tree.ir_idx
+
     def get_current_tree_val(self) -> Value | None:
         for tree_val in self.tree_vals:
             if tree_val.of is self.current_tree:
@@ -151,7 +397,7 @@ class Rlsra:
         assert not any(reg.active_val != None for reg in self.registers), str(self.registers)
     
     # Setup a local variable and use its register as the output of the LdLocal subtree
-    def use_local(self, subtree: Tree):
+    def use_local(self, subtree: Tree, exclude: list[int] = [], preferred: int | None = None):
         assert subtree.kind == irepr.TreeKind.LdLocal
 
         val = self.var_vals[subtree.operands[0]]
@@ -162,20 +408,350 @@ class Rlsra:
 
         # Activate the variable if it wasn't already
         if not val_was_active:
-            self.activate(val)
+            self.activate(val, exclude, preferred)
 
         subtree.reg = val.active_in
+        subtree.use_reg = val.active_in
 
-        # If the variable is expected to be found in memory, generate a spill
+        # If the variable is expected to be found in memory, generate a spill. It goes right before the tree using the
+        # variable : the variable could be evicted (and restored) between the LdLocal and its use
         if val_was_used and not val_was_active:
-            subtree.post_spills.append(RegSpill(val=val, reg=val.active_in))
+            self.current_tree.pre_spills.append(self.pool.spill(val, val.active_in))
     
+    # Gives a register to an operand of the current tree
+    def use_operand(self, subtree: Tree, exclude: list[int] = [], preferred: int | None = None) -> None:
+        # Special case : loading a local variable
+        if subtree.kind == irepr.TreeKind.LdLocal:
+            self.use_local(subtree, exclude, preferred)
+        else:
+            subtree_val = self.pool.value(subtree, None, self.current_tree)
+            self.activate(subtree_val, exclude, preferred)
+            self.tree_vals.append(subtree_val)
+            subtree.use_reg = subtree_val.active_in
+
+    # Whether the operand of the current tree is a local that is still needed after it (in a register already)
+    def alive_after(self, subtree: Tree) -> bool:
+        return subtree.kind == irepr.TreeKind.LdLocal and self.var_vals[subtree.operands[0]].active_in != None
+
+    # Two-address BinOps : the left operand is given the result register (free since the result was just handled), the
+    # tree overwrites it. A local that is already active (alive after the tree) stays in its register and is copied into
+    # the result register right before the tree. The right operand is read at the same time, it's given another register
+    # first, unless it's the same local
+    # The operands of commutative BinOps are exchanged when only the left one would need the copy
+    def allocate_two_address_operands(self, tree: Tree) -> None:
+        if tree.operands[0] in irepr.COMMUTATIVE_OPERATORS and self.alive_after(tree.left_operand()) and not self.alive_after(tree.right_operand()):
+            tree.swap_commutative_operands()
+        left = tree.left_operand()
+        right = tree.right_operand()
+        same_local = left.kind == irepr.TreeKind.LdLocal and right.kind == irepr.TreeKind.LdLocal and left.operands[0] == right.operands[0]
+
+        if not same_local:
+            self.use_operand(right, exclude=[tree.reg])
+
+        self.use_operand(left, preferred=tree.reg)
+        if left.use_reg != tree.reg:
+            val = self.var_vals[left.operands[0]]
+            tree.pre_moves.append(self.pool.move(val, left.use_reg, val, tree.reg))
+            left.use_reg = tree.reg
+
+        if same_local:
+            self.use_operand(right)
+
+    # Side exit in the middle of the block (see superblock.py) : the locals alive in the exit are where the exit edge says
+    # once the guard is done, and have to be alive above the guard even if the rest of the block overwrites them
+    def leave_through_guard(self, tree: Tree) -> None:
+        edge = tree.operands[0]
+        alive = edge.target.alive_in_set
+        edge.active_out_set = [ActiveInOut(val=val, reg=val.active_in) for val in self.active_vals if isinstance(val.of, int) and val.of in alive]
+        for local in alive:
+            val = self.var_vals[local]
+            if val.last_use == None:
+                val.last_use = edge.target
+
+    # Calls and divisions (see CallingConvention). Going in reverse : the result is moved from the result register to where
+    # the parent reads it, the values alive across the tree leave the clobbered registers (moved from a register that
+    # survives the tree, or restored after it), then the operands are given the registers the tree reads them from
+    def allocate_constrained_tree(self, tree: Tree) -> None:
+        result_reg = self.convention.result_reg(tree)
+        tree.reg = result_reg
+
+        tree_val = self.get_current_tree_val()
+        if tree_val != None:
+            if tree_val.active_in == None:
+                tree.post_spills.append(self.pool.spill(tree_val, result_reg))
+            else:
+                if tree_val.active_in != result_reg:
+                    tree.post_moves.append(self.pool.move(tree_val, result_reg, tree_val, tree_val.active_in))
+                self.registers[tree_val.active_in].active_val = None
+                tree_val.active_in = None
+                self.active_vals.remove(tree_val)
+            self.tree_vals.remove(tree_val)
+            self.pool.free_value(tree_val)
+
+        clobbered = self.convention.clobbered_regs(tree)
+        for reg_i in clobbered:
+            val = self.registers[reg_i].active_val
+            if val == None:
+                continue
+
+            free_reg = next((free for free in self.register_order(val) if free not in clobbered and self.registers[free].active_val == None), None)
+            if free_reg != None:
+                tree.post_moves.append(self.pool.move(val, free_reg, val, reg_i))
+                self.registers[reg_i].active_val = None
+                self.registers[free_reg].active_val = val
+                val.active_in = free_reg
+            else:
+                self.spill(val)
+
+        # Operands with a register first. Locals that are already in another register (alive after the tree, or read by
+        # another operand) are copied right before the tree, their register stays reserved until the other operands are
+        # done
+        reserved = []
+        operand_regs = self.convention.operand_regs(tree)
+        for subtree, reg_i in zip(tree.subtrees, operand_regs):
+            if reg_i == None:
+                continue
+
+            if subtree.kind == irepr.TreeKind.LdLocal:
+                val = self.var_vals[subtree.operands[0]]
+                val_was_used = val.last_use != None
+                val.last_use = tree
+
+                if val.active_in == None:
+                    assert self.registers[reg_i].active_val == None
+                    val.active_in = reg_i
+                    self.registers[reg_i].active_val = val
+                    self.active_vals.append(val)
+                    # Expected in memory after the tree
+                    if val_was_used:
+                        tree.pre_spills.append(self.pool.spill(val, reg_i))
+                elif val.active_in != reg_i:
+                    tree.pre_moves.append(self.pool.move(val, val.active_in, val, reg_i))
+                    self.registers[reg_i].active_val = self.pool.value(subtree, reg_i, tree)
+                    reserved.append(reg_i)
+
+                subtree.reg = val.active_in
+                subtree.use_reg = reg_i
+            else:
+                assert self.registers[reg_i].active_val == None
+                subtree_val = self.pool.value(subtree, reg_i, tree)
+                self.registers[reg_i].active_val = subtree_val
+                self.active_vals.append(subtree_val)
+                self.tree_vals.append(subtree_val)
+                subtree.use_reg = reg_i
+
+        for subtree, reg_i in zip(tree.subtrees, operand_regs):
+            if reg_i != None:
+                continue
+
+            if subtree.kind == irepr.TreeKind.LdLocal:
+                self.use_local(subtree)
+            else:
+                subtree_val = self.pool.value(subtree, None, tree)
+                self.activate(subtree_val)
+                self.tree_vals.append(subtree_val)
+                subtree.use_reg = subtree_val.active_in
+
+        for reg_i in reserved:
+            self.pool.free_value(self.registers[reg_i].active_val)
+            self.registers[reg_i].active_val = None
+
+    # Forgets the allocation of a block to do it again
+    def reset_block(self, block: BasicBlock) -> None:
+        self.pool.release_trees(block.tree_execution_order())
+        for tree in block.tree_execution_order():
+            tree.reg = -1
+            tree.use_reg = -1
+            if tree.kind == irepr.TreeKind.StLocal:
+                # Allocation results are appended to the operands
+                del tree.operands[1:]
+        block.active_in_set = None
+
+    # Allocates the block, ending with the given active out set
+    def allocate_block(self, block: BasicBlock, active_out_set: list[ActiveInOut]) -> None:
+        block.active_out_set = active_out_set
+
+        hoisted = self.hoisted_locals.get(id(block))
+        if hoisted != None:
+            # Hoisted locals aren't used in the block, leaving them out of the active out set is enough to keep
+            # them in memory
+            block.active_out_set = [active_out for active_out in block.active_out_set if active_out.val.of not in hoisted]
+
+        self.reset_var_vals_and_regs()
+
+        num_regs = len(self.registers)
+        self.spill_free = self.fast_path and self.convention == None and not self.two_address and pressure.reverse_scan_pressure(block, num_regs) <= num_regs
+
+        # Only needed by the spill strategies
+        self.first_references = dict()
+        if self.spill_free:
+            self.spill_free_blocks += 1
+        else:
+            for tree in block.tree_reverse_execution_order():
+                if tree.kind == irepr.TreeKind.LdLocal or tree.kind == irepr.TreeKind.StLocal:
+                    self.first_references[tree.operands[0]] = tree.ir_idx
+
+        if self.convention != None:
+            self.constrained_trees = []
+            self.references = dict()
+            for tree in block.tree_execution_order():
+                if self.convention.constrained(tree):
+                    self.constrained_trees.append(tree.ir_idx)
+                elif tree.kind == irepr.TreeKind.LdLocal:
+                    # Read by the parent
+                    self.references.setdefault(tree.operands[0], []).append(tree.parent.ir_idx)
+                elif tree.kind == irepr.TreeKind.StLocal:
+                    self.references.setdefault(tree.operands[0], []).append(tree.ir_idx)
+
+        # Mark the values that will be used in successor blocks as alive (the ones used by side exits are marked at their
+        # guards)
+        for out_edge in block.terminator_edges():
+            for alive in out_edge.target.alive_in_set:
+                self.var_vals[alive].last_use = out_edge.target
+
+        # Activate the values in the active out set
+        for active_out in block.active_out_set:
+            assert isinstance(active_out.val.of, int)
+            
+            active_out.val.active_in = active_out.reg
+            self.registers[active_out.reg].active_val = active_out.val
+            self.active_vals.append(active_out.val)
+        
+        for tree in block.tree_reverse_execution_order():
+            self.current_tree = tree
+
+            if tree.kind == irepr.TreeKind.Guard:
+                self.leave_through_guard(tree)
+
+            # This is processed with the subtrees (simplifies the algorithm to avoid needless loads and spills)
+            if tree.kind == irepr.TreeKind.LdLocal:
+                pass
+            # Special case : storing into a local variable. This also removes the local variable from the active variables if it was active
+            elif tree.kind == irepr.TreeKind.StLocal:
+                val = self.var_vals[tree.operands[0]]
+                val_was_used = val.last_use != None
+                subtree = tree.subtrees[0]
+
+                if subtree.kind == irepr.TreeKind.LdLocal and subtree.operands[0] == val.of:
+                    # Special case : storing a local variable into itself doesn't end its lifetime
+                    self.use_local(subtree)
+                    tree.operands.append(val.active_in)
+                elif subtree.kind == irepr.TreeKind.LdLocal:
+                    # Special case : transfering a local variable to another
+                    val_from = self.var_vals[subtree.operands[0]]
+                    self.use_local(subtree)
+
+                    if val.active_in != None:
+                        # If it's already active, we emit a move
+                        subtree.post_moves.append(self.pool.move(val_from, val_from.active_in, val, val.active_in))
+                        tree.operands.append(val.active_in)
+
+                        self.registers[val.active_in].active_val = None
+                        val.active_in = None
+                        val.last_use = None
+                        self.active_vals.remove(val)
+                    else:
+                        # If it's not already active but will be used later, we emit a spill
+                        if val_was_used:
+                            subtree.post_spills.append(self.pool.spill(val, val_from.active_in))
+                        tree.operands.append(val)
+                elif self.spill_free:
+                    # Same as below, the subtree only holds the register
+                    if val.active_in != None:
+                        reg_i = val.active_in
+                        val.active_in = None
+                        self.active_vals.remove(val)
+                    else:
+                        reg_i = self.free_register(self.temp_order)
+                        tree.post_spills.append(self.pool.spill(val, reg_i))
+                    val.last_use = None
+                    self.registers[reg_i].active_val = self.temp_placeholder
+                    subtree.use_reg = reg_i
+                    tree.operands.append(reg_i)
+                else:
+                    if val.active_in != None:
+                        # If it's already active, we write the output to the regsiter it's active in
+                        subtree_val = self.pool.value(subtree, val.active_in, tree)
+                        self.registers[subtree_val.active_in].active_val = subtree_val
+                        subtree.use_reg = val.active_in
+                        tree.operands.append(val.active_in)
+                        self.active_vals.append(subtree_val)
+                        self.tree_vals.append(subtree_val)
+
+                        val.active_in = None
+                        val.last_use = None
+                        self.active_vals.remove(val)
+                    else:
+                        # If not, we first find a register to write it into (reusing the register of the subtree), then add a spill
+                        subtree_val = self.pool.value(subtree, None, tree)
+                        val.last_use = None
+                        self.activate(subtree_val)
+                        self.tree_vals.append(subtree_val)
+
+                        subtree.use_reg = subtree_val.active_in
+                        tree.operands.append(subtree_val.active_in)
+                        tree.post_spills.append(self.pool.spill(val, subtree_val.active_in))
+            elif self.convention != None and self.convention.constrained(tree):
+                self.allocate_constrained_tree(tree)
+            elif self.spill_free:
+                # The value is still in the register its parent gave it
+                if tree.parent != None:
+                    tree.reg = tree.use_reg
+                    self.registers[tree.reg].active_val = None
+
+                for subtree in tree.subtrees:
+                    if subtree.kind == irepr.TreeKind.LdLocal:
+                        self.use_local(subtree)
+                    else:
+                        subtree.use_reg = self.free_register(self.temp_order)
+                        self.registers[subtree.use_reg].active_val = self.temp_placeholder
+            else:
+                tree_val = self.get_current_tree_val()
+                two_address = self.two_address and tree.kind == irepr.TreeKind.BinOp and tree_val != None
+                if tree_val != None:
+                    # If the tree corresponds to a used tree value (later in execution order), we write the output where it's expected to be 
+                    if tree_val.active_in != None:
+                        # If it's already active, we write the output to the register it's active in
+                        tree.reg = tree_val.active_in
+                        self.registers[tree_val.active_in].active_val = None
+                        tree_val.active_in = None
+                    else:
+                        # If not, we first find a register to do that, then add a spill
+                        self.activate(tree_val)
+                        tree.reg = tree_val.active_in
+                        tree.post_spills.append(self.pool.spill(tree_val, tree_val.active_in))
+                        self.registers[tree_val.active_in].active_val = None
+                        tree_val.active_in = None
+
+                    self.active_vals.remove(tree_val)
+                    self.tree_vals.remove(tree_val)
+                    self.pool.free_value(tree_val)
+
+                # Generate a use for all the subtrees and activate them because by this point we must have all operands in registers
+                if two_address:
+                    self.allocate_two_address_operands(tree)
+                else:
+                    for subtree in tree.subtrees:
+                        self.use_operand(subtree)
+        
+        # Create an active in set
+        active_in_set = []
+        for val in self.active_vals:
+            active_in_set.append(ActiveInOut(val=val, reg=val.active_in))
+        
+        block.active_in_set = active_in_set
+
     # Do RLSRA
     # Preconditions : recompute_predecessors, recompute_alive_in_sets, reindex all executed
     def do_reverse_linear_scan(self, ir: Ir) -> None:
-        # Set up all the values corresponding to local variables
-        for i in range(ir.local_vars):
-            self.var_vals.append(Value(of=i, active_in=None, last_use=None))
+        self.reset(ir.local_vars)
+
+        split = self.hoist_loop_spills or self.split_live_ranges
+        if split or self.spill_strategy.needs_loops:
+            ir.recompute_dominators()
+            ir.recompute_loops()
+        if split:
+            self.hoisted_locals = splitting.find_split_locals(ir, len(self.registers), loops=True, blocks=self.split_live_ranges)
 
         # We start from the end : we queue up the blocks with no successors to be processed
         for no_successors in ir.no_successors():
@@ -183,127 +759,38 @@ class Rlsra:
         
         while len(self.blocks_to_process) != 0:
             block = self.blocks_to_process.popleft()
+            if block.active_in_set != None:
+                # Already processed (blocks can be queued up by several successors)
+                continue
 
             # Since we're processing blocks in reverse order we select active out sets
             # TODO : Add a heuristic for selection (edge weight?)
             selected_out_edge = None
-            for out_edge in block.outgoing_edges():
+            for out_edge in block.terminator_edges():
                 if out_edge.target.active_in_set != None:
                     selected_out_edge = out_edge
                     break
             
             # Select active out set
-            if selected_out_edge == None:
+            if selected_out_edge != None:
+                active_out_set = selected_out_edge.target.active_in_set
+            elif block.last_statement.tree.kind == irepr.TreeKind.Ret:
                 # For blocks that have no successors
-                assert block.last_statement.tree.kind == irepr.TreeKind.Ret
-                block.active_out_set = []
+                active_out_set = []
             else:
-                block.active_out_set = selected_out_edge.target.active_in_set
-
-            self.reset_var_vals_and_regs()
-
-            # Mark the values that will be used in successor blocks as alive
-            for out_edge in block.outgoing_edges():
-                for alive in out_edge.target.alive_in_set:
-                    self.var_vals[alive].last_use = out_edge.target
-
-            # Activate the values in the active out set
-            if selected_out_edge != None:
-                for active_out in block.active_out_set:
-                    assert isinstance(active_out.val.of, int)
-                    
-                    active_out.val.active_in = active_out.reg
-                    self.registers[active_out.reg].active_val = active_out.val
-                    self.active_vals.append(active_out.val)
-            
-            for tree in block.tree_reverse_execution_order():
-                self.current_tree = tree
-
-                # This is processed with the subtrees (simplifies the algorithm to avoid needless loads and spills)
-                if tree.kind == irepr.TreeKind.LdLocal:
-                    pass
-                # Special case : storing into a local variable. This also removes the local variable from the active variables if it was active
-                elif tree.kind == irepr.TreeKind.StLocal:
-                    val = self.var_vals[tree.operands[0]]
-                    val_was_used = val.last_use != None
-                    subtree = tree.subtrees[0]
-
-                    if subtree.kind == irepr.TreeKind.LdLocal:
-                        # Special case : transfering a local variable to another
-                        val_from = self.var_vals[subtree.operands[0]]
-                        self.use_local(subtree)
-
-                        if val.active_in != None:
-                            # If it's already active, we emit a move
-                            subtree.post_moves.append(RegMove(val_from=val_from, reg_from=val_from.active_in, val_to=val, reg_to=val.active_in))
-                            tree.operands.append(val.active_in)
-
-                            self.registers[val.active_in].active_val = None
-                            val.active_in = None
-                            val.last_use = None
-                            self.active_vals.remove(val)
-                        else:
-                            # If it's not already active but will be used later, we emit a spill
-                            if val_was_used:
-                                subtree.post_spills.append(RegSpill(val=val, reg=val_from.active_in))
-                            tree.operands.append(val)
-                    else:
-                        if val.active_in != None:
-                            # If it's already active, we write the output to the regsiter it's active in
-                            subtree_val = Value(of=subtree, active_in=val.active_in, last_use=tree)
-                            self.registers[subtree_val.active_in].active_val = subtree_val
-                            tree.operands.append(val.active_in)
-                            self.active_vals.append(subtree_val)
-                            self.tree_vals.append(subtree_val)
-
-                            val.active_in = None
-                            val.last_use = None
-                            self.active_vals.remove(val)
-                        else:
-                            # If not, we first find a register to write it into (reusing the register of the subtree), then add a spill
-                            subtree_val = Value(of=subtree, active_in=None, last_use=tree)
-                            val.last_use = None
-                            self.activate(subtree_val)
-                            self.tree_vals.append(subtree_val)
-
-                            tree.operands.append(subtree_val.active_in)
-                            tree.post_spills.append(RegSpill(val=val, reg=subtree_val.active_in))
-                else:
-                    tree_val = self.get_current_tree_val()
-                    if tree_val != None:
-                        # If the tree corresponds to a used tree value (later in execution order), we write the output where it's expected to be 
-                        if tree_val.active_in != None:
-                            # If it's already active, we write the output to the register it's active in
-                            tree.reg = tree_val.active_in
-                            self.registers[tree_val.active_in].active_val = None
-                            tree_val.active_in = None
-                        else:
-                            # If not, we first find a register to do that, then add a spill
-                            self.activate(tree_val)
-                            tree.reg = tree_val.active_in
-                            tree.post_spills.append(RegSpill(val=tree_val, reg=tree_val.active_in))
-                            self.registers[tree_val.active_in].active_val = None
-                            tree_val.active_in = None
-
-                        self.active_vals.remove(tree_val)
-                        self.tree_vals.remove(tree_val)
-
-                    # Generate a use for all the subtrees and activate them because by this point we must have all operands in registers
-                    for subtree in tree.subtrees:
-                        # Special case : loading a local variable
-                        if subtree.kind == irepr.TreeKind.LdLocal:
-                            self.use_local(subtree)
-                        else:
-                            subtree_val = Value(of=subtree, active_in=None, last_use=tree)
-                            self.activate(subtree_val)
-                            self.tree_vals.append(subtree_val)
-            
-            # Create an active in set
-            active_in_set = []
-            for val in self.active_vals:
-                active_in_set.append(ActiveInOut(val=val, reg=val.active_in))
-            
-            block.active_in_set = active_in_set
+                # Superblocks looping on themselves are queued up by their side exits : start from the locations one of
+                # them expects
+                side_exit = next(edge for edge in block.side_exits if edge.target.active_in_set != None)
+                active_out_set = [active_out for active_out in side_exit.target.active_in_set if active_out.val.of in block.alive_out_set]
+
+            self.allocate_block(block, active_out_set)
+
+            if any(edge.target is block for edge in block.terminator_edges()):
+                # The block loops on itself : allocate it again, ending with the locations it starts with, so that the
+                # back edge has nothing to resolve if they don't change
+                active_out_set = [active_in for active_in in block.active_in_set if active_in.val.of in block.alive_out_set]
+                self.reset_block(block)
+                self.allocate_block(block, active_out_set)
 
             # Queue up blocks that haven't been processed
             for predecessor in block.predecessors:
@@ -0,0 +1,425 @@
+from __future__ import annotations
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import dataclasses
+import itertools
+import json
+import time
+from stack_instruction import *
+from pipeline import Pipeline, PipelineConfig, StageCounters
+from fuzz import ALLOCATORS
+from corpus import *
+from spill_strategy import SPILL_STRATEGIES, FurthestUse
+
+# Allocation service : a long lived asyncio server allocating the functions local clients send it, on a Unix socket or
+# a localhost TCP port. The protocol is JSON, one object per line in both directions :
+# - request : {"id": ..., "function": {"local_vars": 3, "instructions": [["Push", [0]], ["StLocal", [0]], ...]},
+#   "num_regs": 4, "allocator": "rlsra", "strategy": "furthest-use", "calls": false, "args": [...]}. Everything but the
+#   function is optional. With args, the allocated function is run with the Interpreter and compared with the
+#   StackInterpreter
+#   allocator : one of fuzz.ALLOCATORS, rlsra, rlsra-hoist, rlsra-split, rlsra-reorder, rlsra-opt, rlsra-layout,
+#   rlsra-2addr, lsra, lsra-split, lsra-reorder, lsra-opt, lsra-layout, lsra-2addr, interval or coloring
+#   strategy : one of spill_strategy.SPILL_STRATEGIES, furthest-use (the default), weighted-cost, prefer-temps,
+#   prefer-locals or prefer-clean
+# - response : {"id": ..., "instructions": ..., "blocks": ..., "spills": ..., "restores": ..., "moves": ...,
+#   "verified": ...} (see pipeline.CompileResult), or {"id": ..., "error": "..."}. Responses come back in the order the
+#   allocations finish, the id tells which request they answer
+# - {"op": "metrics"} : answered right away with the counters of the service
+# The allocations run in a pool of worker processes started with the service and warmed up by a first allocation, every
+# worker keeping a pipeline.Pipeline (and its RecordPool) per configuration. Requests are sent to the workers in batches
+# : the batcher waits up to batch_delay for batch_size requests, so that small functions don't pay for a round trip to
+# a worker each. At most max_batches batches are in the workers at the same time, the requests after them wait in a
+# queue of queue_size requests, and once it's full the connections aren't read anymore until it has room (backpressure
+# : the clients' writes block on the socket).
+# Lines longer than LINE_LIMIT are answered with an error, the connection stays open. Verifying a function runs it for
+# at most max_steps steps (see PipelineConfig.max_steps), a function that doesn't terminate is answered with an error
+# instead of keeping its worker busy forever.
+
+@dataclasses.dataclass
+class ServiceConfig:
+    # Worker processes
+    jobs: int = 1
+    batch_size: int = 16
+    # Seconds the batcher waits for a batch to fill up
+    batch_delay: float = 0.002
+    # Requests waiting for a batch
+    queue_size: int = 256
+    # Batches in the workers at the same time, defaults to two per worker (one running, one waiting)
+    max_batches: int | None = None
+    # Steps the reference may take when verifying a function
+    max_steps: int = 1_000_000
+
+    def batches(self) -> int:
+        return self.max_batches if self.max_batches != None else 2 * self.jobs
+
+def encode_function(fn: StackFunction) -> dict:
+    return {"local_vars": fn.local_vars, "instructions": [[ins.kind.name, ins.operands] for ins in fn.instructions]}
+
+def decode_function(data: dict) -> StackFunction:
+    return StackFunction(
+        local_vars=data["local_vars"],
+        instructions=[StackInstruction(StackInstructionKind[kind], list(operands)) for kind, operands in data["instructions"]]
+    )
+
+def encode_request(id: Any, fn: StackFunction, num_regs: int, allocator: str = "rlsra", spill_strategy: str = FurthestUse.name, calls: bool = False, args: list[int] | None = None) -> dict:
+    request = {"id": id, "function": encode_function(fn), "num_regs": num_regs, "allocator": allocator, "strategy": spill_strategy, "calls": calls}
+    if args != None:
+        request["args"] = args
+    return request
+
+# Longest line read by the service and by its clients, requests and responses included
+LINE_LIMIT = 1 << 24
+
+# Latency percentiles are computed over the last requests only
+LATENCY_WINDOW = 10_000
+
+@dataclasses.dataclass
+class ServiceMetrics:
+    started: float = dataclasses.field(default_factory=time.perf_counter)
+    requests: int = 0
+    errors: int = 0
+    batches: int = 0
+    # Seconds from reading a request to writing its response
+    latencies: collections.deque = dataclasses.field(default_factory=lambda: collections.deque(maxlen=LATENCY_WINDOW))
+    # Stages of the pipelines of the workers
+    stages: dict[str, StageCounters] = dataclasses.field(default_factory=dict)
+
+    def percentile(self, fraction: float) -> float:
+        if len(self.latencies) == 0:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+    def snapshot(self, queued: int, in_flight: int) -> dict:
+        uptime = time.perf_counter() - self.started
+        return {
+            "uptime": uptime,
+            "requests": self.requests,
+            "errors": self.errors,
+            "throughput": self.requests / uptime if uptime != 0 else 0.0,
+            "batches": self.batches,
+            "mean_batch": self.requests / self.batches if self.batches != 0 else 0.0,
+            "queued": queued,
+            "in_flight_batches": in_flight,
+            "latency_ms": {name: 1000 * self.percentile(fraction) for name, fraction in [("p50", 0.5), ("p95", 0.95), ("p99", 0.99)]},
+            "stages": {stage: {"functions": counters.functions, "seconds": counters.seconds} for stage, counters in self.stages.items()},
+        }
+
+# Pipelines of a worker process, by configuration
+worker_pipelines: dict[tuple, Pipeline] = dict()
+# Step limit of the verifications of a worker process (see ServiceConfig.max_steps)
+worker_max_steps: int | None = None
+
+def worker_pipeline(request: dict) -> Pipeline:
+    config = PipelineConfig(
+        allocator=request.get("allocator", "rlsra"),
+        num_regs=request.get("num_regs", 4),
+        spill_strategy=request.get("strategy", FurthestUse.name),
+        calls=request.get("calls", False),
+        verify="args" in request,
+        max_steps=worker_max_steps,
+    )
+    if config.allocator not in ALLOCATORS:
+        raise Exception(f"unknown allocator {config.allocator}")
+    if config.spill_strategy not in SPILL_STRATEGIES:
+        raise Exception(f"unknown spill strategy {config.spill_strategy}")
+    key = dataclasses.astuple(config)
+    if key not in worker_pipelines:
+        worker_pipelines[key] = Pipeline(config)
+    return worker_pipelines[key]
+
+def compile_request(request: dict) -> dict:
+    try:
+        pipeline = worker_pipeline(request)
+        program = BenchmarkProgram(name=str(request.get("id")), fn=decode_function(request["function"]), args=request.get("args", []))
+        result = pipeline.compile(program)
+        response = dataclasses.asdict(result)
+        del response["name"]
+        return {"id": request.get("id"), **response}
+    except Exception as e:
+        return {"id": request.get("id"), "error": f"{type(e).__name__}: {e}"}
+
+# Runs in the workers : the responses of the batch, and the stage counters of its allocations
+def compile_batch(requests: list[dict]) -> tuple[list[dict], dict[str, tuple[int, float]]]:
+    for pipeline in worker_pipelines.values():
+        for counters in pipeline.counters.values():
+            counters.functions = 0
+            counters.seconds = 0.0
+    responses = [compile_request(request) for request in requests]
+    counters = dict()
+    for pipeline in worker_pipelines.values():
+        for stage, stage_counters in pipeline.counters.items():
+            if stage_counters.functions != 0:
+                functions, seconds = counters.get(stage, (0, 0.0))
+                counters[stage] = (functions + stage_counters.functions, seconds + stage_counters.seconds)
+    return responses, counters
+
+def warm_up(max_steps: int | None = None) -> None:
+    global worker_max_steps
+    worker_max_steps = max_steps
+    program = fib_program(10)
+    compile_request(encode_request(0, program.fn, 4, args=program.args))
+
+# Drops the rest of a line longer than the limit of the reader, False if the connection got closed before its end
+async def skip_line(reader: asyncio.StreamReader) -> bool:
+    while True:
+        try:
+            await reader.readuntil(b"\n")
+            return True
+        except asyncio.LimitOverrunError as e:
+            await reader.readexactly(e.consumed)
+        except asyncio.IncompleteReadError:
+            return False
+
+class AllocationService:
+    config: ServiceConfig
+    metrics: ServiceMetrics
+    executor: concurrent.futures.ProcessPoolExecutor
+    # Requests read from the connections, with the future of their response and when they were read
+    queue: asyncio.Queue
+    batch_slots: asyncio.Semaphore
+    in_flight: int
+
+    def __init__(self, config: ServiceConfig) -> None:
+        self.config = config
+        self.metrics = ServiceMetrics()
+        self.in_flight = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0, unix: str | None = None) -> asyncio.Server:
+        self.queue = asyncio.Queue(maxsize=self.config.queue_size)
+        self.batch_slots = asyncio.Semaphore(self.config.batches())
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.config.jobs, initializer=warm_up, initargs=(self.config.max_steps,))
+        # Starts every worker before the first request
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.executor, time.sleep, 0.01) for _ in range(self.config.jobs)))
+        self.metrics = ServiceMetrics()
+
+        self.batcher = asyncio.create_task(self.run_batcher())
+        if unix != None:
+            return await asyncio.start_unix_server(self.handle, path=unix, limit=LINE_LIMIT)
+        return await asyncio.start_server(self.handle, host=host, port=port, limit=LINE_LIMIT)
+
+    def close(self) -> None:
+        self.batcher.cancel()
+        self.executor.shutdown(cancel_futures=True)
+
+    def metrics_snapshot(self) -> dict:
+        return self.metrics.snapshot(self.queue.qsize(), self.in_flight)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        lock = asyncio.Lock()
+        responses = []
+
+        async def write(response: dict) -> None:
+            async with lock:
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+
+        async def respond(future: asyncio.Future, start: float) -> None:
+            response = await future
+            await write(response)
+            self.metrics.requests += 1
+            if "error" in response:
+                self.metrics.errors += 1
+            self.metrics.latencies.append(time.perf_counter() - start)
+
+        try:
+            while True:
+                try:
+                    line = await reader.readuntil(b"\n")
+                except asyncio.IncompleteReadError as e:
+                    # Last line without a newline, empty once the client closed the connection
+                    line = e.partial
+                except asyncio.LimitOverrunError:
+                    if not await skip_line(reader):
+                        break
+                    await write({"id": None, "error": f"invalid request : longer than {LINE_LIMIT} bytes"})
+                    continue
+                if len(line) == 0:
+                    break
+                start = time.perf_counter()
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError as e:
+                    await write({"id": None, "error": f"invalid request : {e}"})
+                    continue
+                if not isinstance(request, dict):
+                    await write({"id": None, "error": "invalid request : not a JSON object"})
+                    continue
+                if request.get("op") == "metrics":
+                    await write({"id": request.get("id"), "metrics": self.metrics_snapshot()})
+                    continue
+
+                future = asyncio.get_running_loop().create_future()
+                # Blocks the reading of the connection while the queue is full
+                await self.queue.put((request, future))
+                responses.append(asyncio.create_task(respond(future, start)))
+                if len(responses) >= self.config.queue_size:
+                    responses = [task for task in responses if not task.done()]
+
+            await asyncio.gather(*responses)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def run_batcher(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.config.batch_delay
+            while len(batch) < self.config.batch_size:
+                if self.queue.empty():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self.queue.get_nowait())
+
+            # Waits for a worker while they're all busy, the queue fills up meanwhile
+            await self.batch_slots.acquire()
+            self.in_flight += 1
+            asyncio.create_task(self.dispatch(batch))
+
+    async def dispatch(self, batch: list[tuple[dict, asyncio.Future]]) -> None:
+        try:
+            responses, counters = await asyncio.get_running_loop().run_in_executor(self.executor, compile_batch, [request for request, _ in batch])
+            for stage, (functions, seconds) in counters.items():
+                stage_counters = self.metrics.stages.setdefault(stage, StageCounters())
+                stage_counters.functions += functions
+                stage_counters.seconds += seconds
+        except Exception as e:
+            # The worker died or the request couldn't be sent to it
+            responses = [{"id": request.get("id"), "error": f"{type(e).__name__}: {e}"} for request, _ in batch]
+        finally:
+            self.in_flight -= 1
+            self.batch_slots.release()
+        self.metrics.batches += 1
+
+        for (_, future), response in zip(batch, responses):
+            if not future.done():
+                future.set_result(response)
+
+async def open_connection(host: str, port: int, unix: str | None) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    if unix != None:
+        return await asyncio.open_unix_connection(unix, limit=LINE_LIMIT)
+    return await asyncio.open_connection(host, port, limit=LINE_LIMIT)
+
+# Sends the programs to a running service with at most concurrency requests waiting for their response, and checks the
+# verified ones. Returns the responses in the order of the programs, and the latencies seen by the client
+async def run_client(programs: Iterable[BenchmarkProgram], reader: asyncio.StreamReader, writer: asyncio.StreamWriter, num_regs: int, allocator: str = "rlsra", spill_strategy: str = FurthestUse.name, calls: bool = False, verify: bool = False, concurrency: int = 64) -> tuple[list[dict], list[float]]:
+    slots = asyncio.Semaphore(concurrency)
+    pending: dict[int, tuple[asyncio.Future, float]] = dict()
+    loop = asyncio.get_running_loop()
+
+    async def read_responses() -> None:
+        while True:
+            line = await reader.readline()
+            if len(line) == 0:
+                raise ConnectionError("the service closed the connection")
+            response = json.loads(line)
+            future, start = pending.pop(response["id"])
+            future.set_result((response, time.perf_counter() - start))
+            slots.release()
+
+    reading = asyncio.create_task(read_responses())
+    futures = []
+    for id, program in enumerate(programs):
+        await slots.acquire()
+        if reading.done():
+            break
+        future = loop.create_future()
+        pending[id] = (future, time.perf_counter())
+        futures.append(future)
+        writer.write((json.dumps(encode_request(id, program.fn, num_regs, allocator, spill_strategy, calls, program.args if verify else None)) + "\n").encode())
+        await writer.drain()
+
+    received = asyncio.ensure_future(asyncio.gather(*futures))
+    await asyncio.wait([received, reading], return_when=asyncio.FIRST_COMPLETED)
+    if reading.done():
+        received.cancel()
+        # Raises the error of the reader
+        reading.result()
+    reading.cancel()
+    # The reader can be used again once the task is gone
+    await asyncio.wait([reading])
+
+    results = [future.result() for future in futures]
+    return [response for response, _ in results], [latency for _, latency in results]
+
+async def request_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> dict:
+    writer.write((json.dumps({"id": "metrics", "op": "metrics"}) + "\n").encode())
+    await writer.drain()
+    return json.loads(await reader.readline())["metrics"]
+
+async def serve(config: ServiceConfig, host: str, port: int, unix: str | None) -> None:
+    service = AllocationService(config)
+    server = await service.start(host, port, unix)
+    where = unix if unix != None else ", ".join(f"{address[0]}:{address[1]}" for address in (socket.getsockname() for socket in server.sockets))
+    print(f"allocation service listening on {where} with {config.jobs} workers")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+async def client(args: argparse.Namespace) -> int:
+    reader, writer = await open_connection(args.host, args.port, args.unix)
+    programs = itertools.islice(iter_generated_programs(args.seed, args.calls), args.client)
+    start = time.perf_counter()
+    responses, latencies = await run_client(programs, reader, writer, args.regs, args.allocator, args.strategy, args.calls, args.verify, args.concurrency)
+    seconds = time.perf_counter() - start
+
+    errors = [response for response in responses if "error" in response]
+    mismatches = [response for response in responses if response.get("verified") == False]
+    for response in errors[:10]:
+        print(f"request {response['id']} : {response['error']}")
+    for response in mismatches[:10]:
+        print(f"request {response['id']} : the allocated function doesn't return the same result as the reference")
+    latencies.sort()
+    percentile = lambda fraction: 1000 * latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] if len(latencies) != 0 else 0.0
+    print(f"{len(responses)} functions in {seconds:.2f} s, {len(responses) / seconds:.0f} functions/s, {len(errors)} errors, {len(mismatches)} mismatches")
+    print(f"client latency p50 {percentile(0.5):.1f} ms p95 {percentile(0.95):.1f} ms p99 {percentile(0.99):.1f} ms")
+
+    metrics = await request_metrics(reader, writer)
+    writer.close()
+    latency = metrics["latency_ms"]
+    print(f"service : {metrics['requests']} requests, {metrics['throughput']:.0f} requests/s since start, {metrics['batches']} batches (mean {metrics['mean_batch']:.1f} requests), latency p50 {latency['p50']:.1f} ms p95 {latency['p95']:.1f} ms p99 {latency['p99']:.1f} ms")
+    for stage, counters in metrics["stages"].items():
+        print(f"  {stage:<10} {counters['functions']:>8} functions {counters['seconds']:>8.2f} s")
+    return 1 if len(errors) != 0 or len(mismatches) != 0 else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves allocations to local clients over a Unix socket or a localhost TCP port, or sends generated functions to a running service (--client)")
+    parser.add_argument("--unix", metavar="PATH", help="listen on / connect to this Unix socket instead of TCP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes")
+    parser.add_argument("--batch", type=int, default=16, help="requests sent to a worker at once")
+    parser.add_argument("--batch-delay", type=float, default=2.0, metavar="MS", help="time the batcher waits for a batch to fill up")
+    parser.add_argument("--queue", type=int, default=256, help="requests waiting for a worker before the connections stop being read")
+    parser.add_argument("--max-steps", type=int, default=1_000_000, help="steps the reference may take when verifying a function, longer runs are answered with an error")
+    parser.add_argument("--client", type=int, metavar="COUNT", help="send COUNT generated functions to the service and show the metrics")
+    parser.add_argument("--concurrency", type=int, default=64, help="requests the client keeps waiting for their response")
+    parser.add_argument("--seed", type=int, default=0, help="first seed of the generated functions")
+    parser.add_argument("--allocator", choices=ALLOCATORS, default="rlsra")
+    parser.add_argument("--strategy", choices=SPILL_STRATEGIES.keys(), default=FurthestUse.name, help="spill heuristic used by the allocator")
+    parser.add_argument("--regs", type=int, default=4)
+    parser.add_argument("--calls", action="store_true", help="generate calls, allocated and run with the default calling convention")
+    parser.add_argument("--verify", action="store_true", help="send the arguments of the functions, so that the service runs and checks them")
+    args = parser.parse_args()
+
+    if args.client != None:
+        exit(asyncio.run(client(args)))
+
+    config = ServiceConfig(jobs=args.jobs, batch_size=args.batch, batch_delay=args.batch_delay / 1000, queue_size=args.queue, max_steps=args.max_steps)
+    try:
+        asyncio.run(serve(config, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
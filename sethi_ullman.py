@@ -0,0 +1,44 @@
+from __future__ import annotations
+from ir import *
+
+# Sethi-Ullman ordering : import_to_ir keeps the subtrees in stack order and the allocators evaluate them left to right,
+# holding the result of the left operand while the right one is evaluated. When the right operand needs more registers
+# (its Ershov number, see Tree.register_need), evaluating it first lowers the need of the whole tree :
+# max(left, right + 1) becomes max(right, left + 1).
+# Add, Mul and Eq are commutative, their subtrees are just swapped. Sub and Div are swapped with the swapped_operands flag,
+# the interpreters then read the left operand from subtrees[1].
+# Expressions have no side effects (stores are statements), so the evaluation order doesn't change the results.
+
+# Returns the register need of the tree after reordering, and the number of swapped BinOps
+def reorder_tree(tree: Tree) -> tuple[int, int]:
+    if tree.subtrees == []:
+        return (1 if tree.parent != None else 0), 0
+
+    needs = []
+    swaps = 0
+    for subtree in tree.subtrees:
+        need, subtree_swaps = reorder_tree(subtree)
+        needs.append(need)
+        swaps += subtree_swaps
+
+    if tree.kind == TreeKind.BinOp and needs[1] > needs[0]:
+        tree.subtrees.reverse()
+        needs.reverse()
+        if tree.operands[0] not in COMMUTATIVE_OPERATORS:
+            tree.operands[1:] = [not tree.swapped_operands()]
+        swaps += 1
+
+    return max(need + i for i, need in enumerate(needs)), swaps
+
+# Returns the number of swapped BinOps
+# Must run before allocation. Reindexes the ir, the alive sets don't change
+def reorder_subtrees(ir: Ir) -> int:
+    swaps = 0
+    for block in ir.block_execution_order():
+        statement = block.first_statemenent
+        while statement != None:
+            swaps += reorder_tree(statement.tree)[1]
+            statement = statement.next_statement
+
+    ir.reindex()
+    return swaps
@@ -0,0 +1,106 @@
+from __future__ import annotations
+from typing import *
+
+# Spill heuristics : when an allocator runs out of registers, it asks its strategy which of the candidate values gets
+# evicted. Strategies only rank values, the allocator gives them the information they need through the SpillContext
+# methods, so that the same strategy works both for LSRA (forward) and RLSRA (reverse).
+
+# Implemented by Rlsra and Lsra
+class SpillContext(Protocol):
+    # Number of trees between the current tree and the use of the value that would have to be fed by a restore if it was
+    # evicted. Values that are only used in other blocks are further away than any value used in the block
+    def use_distance(self, val: Value) -> int: ...
+
+    # Estimated execution frequency of that use
+    def use_frequency(self, val: Value) -> int: ...
+
+    # Whether memory already holds the value, in which case evicting it doesn't need a spill
+    def is_clean(self, val: Value) -> bool: ...
+
+# Distance of values that are only used in other blocks
+BLOCK_USE_DISTANCE = 1 << 30
+
+# Profiled block entries when there are some, otherwise a rough estimate : every loop level runs 10 times per execution of
+# its parent
+def block_frequency(block: BasicBlock) -> int:
+    if block.profile_count != None:
+        return block.profile_count
+    if block.loop == None:
+        return 1
+    return 10 ** block.loop.depth()
+
+class SpillStrategy:
+    name: str = ""
+    # Whether the allocator needs to recompute the loops before allocating (for block_frequency)
+    needs_loops: bool = False
+
+    # Lower is a better spill candidate
+    def rank(self, val: Value, context: SpillContext) -> Any:
+        raise NotImplementedError()
+
+    # Candidates are given in the order of the active values, ties go to the first one
+    def choose(self, candidates: list[Value], context: SpillContext) -> Value:
+        return min(candidates, key=lambda val: self.rank(val, context))
+
+    def __str__(self) -> str:
+        return self.name
+
+# Belady-like : evict the value used the furthest away
+class FurthestUse(SpillStrategy):
+    name = "furthest-use"
+
+    def rank(self, val: Value, context: SpillContext) -> Any:
+        return -context.use_distance(val)
+
+# Evict the value that is the cheapest to restore (and spill, if it's dirty) per tree it frees its register for,
+# counting operations in loops as more expensive
+class WeightedCost(SpillStrategy):
+    name = "weighted-cost"
+    needs_loops = True
+
+    spill_weight: float
+    restore_weight: float
+
+    def __init__(self, spill_weight: float = 1.0, restore_weight: float = 1.0) -> None:
+        self.spill_weight = spill_weight
+        self.restore_weight = restore_weight
+
+    def rank(self, val: Value, context: SpillContext) -> Any:
+        cost = self.restore_weight
+        if not context.is_clean(val):
+            cost += self.spill_weight
+        return cost * context.use_frequency(val) / (context.use_distance(val) + 1)
+
+# Evict tree temps before locals, furthest use first among each
+class PreferTemps(SpillStrategy):
+    name = "prefer-temps"
+
+    def rank(self, val: Value, context: SpillContext) -> Any:
+        return (isinstance(val.of, int), -context.use_distance(val))
+
+# Evict locals before tree temps, furthest use first among each
+class PreferLocals(SpillStrategy):
+    name = "prefer-locals"
+
+    def rank(self, val: Value, context: SpillContext) -> Any:
+        return (not isinstance(val.of, int), -context.use_distance(val))
+
+# Evict values memory already holds first (no spill needed), furthest use first among each
+class PreferClean(SpillStrategy):
+    name = "prefer-clean"
+
+    def rank(self, val: Value, context: SpillContext) -> Any:
+        return (not context.is_clean(val), -context.use_distance(val))
+
+SPILL_STRATEGIES: dict[str, Callable[[], SpillStrategy]] = {
+    FurthestUse.name: FurthestUse,
+    WeightedCost.name: WeightedCost,
+    PreferTemps.name: PreferTemps,
+    PreferLocals.name: PreferLocals,
+    PreferClean.name: PreferClean,
+}
+
+def get_spill_strategy(name: str) -> SpillStrategy:
+    if name not in SPILL_STRATEGIES:
+        raise Exception(f"Unknown spill strategy {name}")
+    return SPILL_STRATEGIES[name]()
@@ -0,0 +1,64 @@
+from __future__ import annotations
+from typing import *
+import ir as irepr
+
+# Live range splitting : a local that lives across a high pressure region (a loop, or a single block) without being used
+# in it would otherwise keep a register at the start of the region until it gets evicted somewhere in the middle of it,
+# costing a spill / restore there, every iteration for loops. Instead its live range is split at the boundaries of the
+# region : it lives in memory inside the region (spilled on the entry edges) and is restored after it, possibly in a
+# different register.
+# The allocators only need to leave these locals out of the active sets of the blocks of the region, the spills and
+# restores at the split points are the usual edge resolution.
+
+# Locals read or written in the block
+def block_referenced_locals(block: irepr.BasicBlock) -> set[int]:
+    referenced = set()
+    for tree in block.tree_execution_order():
+        if tree.kind == irepr.TreeKind.LdLocal or tree.kind == irepr.TreeKind.StLocal:
+            referenced.add(tree.operands[0])
+    return referenced
+
+# Rough estimate of the pressure : locals alive at the edges of the block and the registers needed by its most demanding
+# statement
+def block_pressure(block: irepr.BasicBlock) -> int:
+    tree_need = max(tree.register_need() for tree in block.tree_execution_order() if tree.parent == None)
+    return len(block.alive_in_set | block.alive_out_set) + tree_need
+
+# Picks the locals to keep in memory in every block, by block id. A region only gets as many locals split as its pressure
+# is over the number of registers
+# loops : split around loops (all the blocks of the loop at once)
+# blocks : split around single blocks
+# Preconditions : recompute_alive_sets executed, and recompute_loops if loops is set
+def find_split_locals(ir: irepr.Ir, num_regs: int, loops: bool = True, blocks: bool = False) -> dict[int, set[int]]:
+    split_locals: dict[int, set[int]] = dict()
+
+    def split(region: list[irepr.BasicBlock], transparent: set[int], pressure: int) -> None:
+        excess = pressure - num_regs
+        if excess <= 0 or len(transparent) == 0:
+            return
+
+        # Locals that are already kept in memory for an enclosing region relieve the pressure too
+        already_split = set.intersection(*(split_locals.get(id(block), set()) for block in region))
+        excess -= len(already_split)
+        candidates = transparent - already_split
+        if excess <= 0 or len(candidates) == 0:
+            return
+
+        selected = set(sorted(candidates)[:excess])
+        for block in region:
+            split_locals.setdefault(id(block), set()).update(selected)
+
+    if loops:
+        # Outer loops come first
+        for loop in ir.loops:
+            transparent = loop.header.alive_in_set - loop.referenced_locals()
+            split(loop.blocks, transparent, max(block_pressure(block) for block in loop.blocks))
+
+    if blocks:
+        for block in ir.block_execution_order():
+            if block.alive_in_set == None:
+                continue
+            transparent = (block.alive_in_set & block.alive_out_set) - block_referenced_locals(block)
+            split([block], transparent, block_pressure(block))
+
+    return split_locals
@@ -12,6 +12,8 @@ class StackInstructionKind(enum.Enum):
     Mul = enum.auto()
     Div = enum.auto()
     Eq = enum.auto()
+    # Operands : the name of the callee (see CALLEES), its arguments are popped from the stack
+    Call = enum.auto()
     Jmp = enum.auto()
     Branch = enum.auto()
     Ret = enum.auto()
@@ -39,7 +41,8 @@ def import_to_ir(fn: StackFunction) -> Ir:
         res = tree_stack[l - n:]
         tree_stack = tree_stack[:l - n]
 
-        new_tree = Tree(kind=kind, subtrees=res, operands=operands, parent=None, block=block)
+        # The operands are copied : passes and allocators modify the operands of trees, not the ones of the instructions
+        new_tree = Tree(kind=kind, subtrees=res, operands=list(operands), parent=None, block=block)
         for subtree in new_tree.subtrees:
             subtree.parent = new_tree
 
@@ -83,6 +86,9 @@ def import_to_ir(fn: StackFunction) -> Ir:
             case StackInstructionKind.Eq:
                 fold(current_block, TreeKind.BinOp, 2, [Operator.Eq])
 
+            case StackInstructionKind.Call:
+                fold(current_block, TreeKind.Call, CALLEES[ins.operands[0]][0], ins.operands)
+
             case StackInstructionKind.Jmp:
                 target = blocks.get_or_insert_block_at(ins.operands[0])
                 fold(current_block, TreeKind.Jmp, 0, [BlockEdge(source=None, target=target)])
@@ -0,0 +1,86 @@
+from stack_instruction import *
+
+# Reference evaluator : executes a StackFunction directly on a value stack, without going through the ir or any
+# register allocation. Used to check the results of the allocators against
+class StackInterpreter:
+    fn: StackFunction
+    locals: list[int | None]
+    stack: list[int]
+    pc: int
+    max_steps: int | None
+    step_count: int
+
+    def __init__(self, fn: StackFunction, max_steps: int | None = None) -> None:
+        self.fn = fn
+        self.locals = [None for _ in range(fn.local_vars)]
+        self.stack = []
+        self.pc = 0
+        self.max_steps = max_steps
+        self.step_count = 0
+
+    def pop(self) -> int:
+        if self.stack == []:
+            raise Exception("Not enough stack operands")
+        return self.stack.pop()
+
+    def run(self, args: list[int] = []) -> int:
+        # The arguments are passed in the first locals
+        assert len(args) <= self.fn.local_vars, "too many arguments"
+        for i, arg in enumerate(args):
+            self.locals[i] = arg
+
+        while True:
+            if self.pc >= len(self.fn.instructions):
+                raise Exception("Execution fell past the last instruction")
+
+            self.step_count += 1
+            if self.max_steps is not None and self.step_count > self.max_steps:
+                raise Exception("Step limit exceeded")
+
+            ins = self.fn.instructions[self.pc]
+            self.pc += 1
+
+            match ins.kind:
+                case StackInstructionKind.LdLocal:
+                    val = self.locals[ins.operands[0]]
+                    if val is None:
+                        raise Exception(f"Read of uninitialized local {ins.operands[0]}")
+                    self.stack.append(val)
+                case StackInstructionKind.StLocal:
+                    self.locals[ins.operands[0]] = self.pop()
+                case StackInstructionKind.Push:
+                    self.stack.append(ins.operands[0])
+                case StackInstructionKind.Pop:
+                    self.pop()
+                case StackInstructionKind.Add | StackInstructionKind.Sub | StackInstructionKind.Mul | StackInstructionKind.Div | StackInstructionKind.Eq:
+                    rhs = self.pop()
+                    lhs = self.pop()
+
+                    match ins.kind:
+                        case StackInstructionKind.Add:
+                            res = lhs + rhs
+                        case StackInstructionKind.Sub:
+                            res = lhs - rhs
+                        case StackInstructionKind.Mul:
+                            res = lhs * rhs
+                        case StackInstructionKind.Div:
+                            res = lhs // rhs
+                        case StackInstructionKind.Eq:
+                            res = 1 if lhs == rhs else 0
+
+                    self.stack.append(res)
+                case StackInstructionKind.Call:
+                    arity, callee = CALLEES[ins.operands[0]]
+                    args = [self.pop() for _ in range(arity)]
+                    args.reverse()
+                    self.stack.append(callee(*args))
+                case StackInstructionKind.Jmp:
+                    self.pc = ins.operands[0]
+                case StackInstructionKind.Branch:
+                    # Same convention as the ir interpreter : only 1 takes the first target
+                    if self.pop() == 1:
+                        self.pc = ins.operands[0]
+                    else:
+                        self.pc = ins.operands[1]
+                case StackInstructionKind.Ret:
+                    return self.pop()
@@ -0,0 +1,216 @@
+from __future__ import annotations
+import argparse
+import dataclasses
+from stack_instruction import *
+from stack_interpreter import StackInterpreter
+from interpreter import Interpreter
+from rlsra import Rlsra
+from corpus import *
+
+# Superblocks : the interpreter records the blocks a hot loop actually runs through (a trace, see Interpreter.record_trace),
+# and the trace is merged into its header as a single block. The terminators in the middle of the trace become guards :
+# when the condition goes the other way, the guard leaves the superblock through a side exit to the original block, and
+# execution goes on in the regular per block code. The superblock ends with a jump to itself.
+# Rlsra allocates the superblock as one straight line region, so the hot path has no edges left to resolve except the
+# back edge, which Rlsra also tries to make free for blocks looping on themselves.
+# The original blocks stay for the side exits (and the other paths), the ones only the trace was using are removed.
+
+# Number of backward jumps to a loop header before recording a trace from it
+TRACE_THRESHOLD = 8
+
+@dataclasses.dataclass
+class Trace:
+    # (il_idx of the block, index of the edge taken among its terminator edges), starting with the loop header. The last
+    # edge goes back to the header
+    steps: list[tuple[int, int]]
+
+    def header(self) -> int:
+        return self.steps[0][0]
+
+    # None if the trace leaves a block through a side exit (it was recorded in a superblock)
+    @staticmethod
+    def from_edges(edges: list[BlockEdge]) -> Trace | None:
+        steps = []
+        for edge in edges:
+            index = next((i for i, terminator_edge in enumerate(edge.source.terminator_edges()) if terminator_edge is edge), None)
+            if index == None:
+                return None
+            steps.append((edge.source.il_idx, index))
+        return Trace(steps=steps)
+
+def clone_tree(tree: Tree, block: BasicBlock, parent: Tree | None) -> Tree:
+    clone = Tree(kind=tree.kind, subtrees=[], operands=list(tree.operands), parent=parent, block=block)
+    clone.subtrees = [clone_tree(subtree, block, clone) for subtree in tree.subtrees]
+    return clone
+
+# Merges the blocks of the trace into its header. Returns False if the trace doesn't match the ir or goes through another
+# superblock
+# The caller is responsible for calling recompute_predecessors afterwards
+def form_superblock(ir: Ir, trace: Trace) -> bool:
+    blocks = {block.il_idx: block for block in ir.block_execution_order()}
+
+    # The block of every step, checking that the steps follow the edges
+    trace_blocks = []
+    for i, (il_idx, index) in enumerate(trace.steps):
+        block = blocks.get(il_idx)
+        if block == None or len(block.side_exits) != 0:
+            return False
+        if i != 0 and il_idx == trace.header():
+            return False
+
+        edges = list(block.terminator_edges())
+        next_il_idx = trace.steps[i + 1][0] if i + 1 < len(trace.steps) else trace.header()
+        if index >= len(edges) or edges[index].target.il_idx != next_il_idx:
+            return False
+        trace_blocks.append(block)
+
+    header = trace_blocks[0]
+    for i, ((_, index), block) in enumerate(zip(trace.steps, trace_blocks)):
+        terminator = block.last_statement.tree
+        terminator_il_idx = block.last_statement.il_idx
+        if i == 0:
+            header.remove_statement(header.last_statement)
+        else:
+            statement = block.first_statemenent
+            while statement is not block.last_statement:
+                header.append_tree(statement.il_idx, clone_tree(statement.tree, header, None))
+                statement = statement.next_statement
+
+        if terminator.kind == TreeKind.Branch:
+            condition = terminator.subtrees[0] if i == 0 else clone_tree(terminator.subtrees[0], header, None)
+            exit_edge = BlockEdge(source=header, target=terminator.operands[1 - index].target)
+            # The first edge of a branch is taken when the condition is 1
+            guard = Tree(kind=TreeKind.Guard, subtrees=[condition], operands=[exit_edge, 1 if index == 0 else 0], parent=None, block=header)
+            condition.parent = guard
+            condition.block = header
+            header.append_tree(terminator_il_idx, guard)
+            header.side_exits.append(exit_edge)
+
+    header.append_tree(header.il_idx, Tree(
+        kind=TreeKind.Jmp,
+        subtrees=[],
+        operands=[BlockEdge(source=header, target=header)],
+        parent=None,
+        block=header
+    ))
+
+    return True
+
+# Returns the number of superblocks formed
+def form_superblocks(ir: Ir, traces: list[Trace]) -> int:
+    formed = 0
+    for trace in traces:
+        if form_superblock(ir, trace):
+            formed += 1
+
+    if formed != 0:
+        ir.recompute_predecessors()
+        ir.remove_unreachable_blocks()
+        ir.recompute_predecessors()
+        ir.recompute_alive_sets()
+        ir.reindex()
+
+    return formed
+
+# Runs a function with trace recording, and allocates it again with superblocks for the new traces after every call that
+# recorded some. The new allocation is used from the next call on
+class TracingFunction:
+    fn: StackFunction
+    num_regs: int
+    trace_threshold: int
+
+    traces: list[Trace]
+    superblocks: int
+    ir: Ir
+    pending: tuple[Ir, int] | None
+    # Backward jumps to every block of the current ir, by block id : loops running a few iterations per call get hot
+    # across calls
+    header_counts: dict[int, int]
+
+    # Statistics of all the calls
+    calls: int
+    spill_count: int
+    restore_count: int
+    move_count: int
+    jump_count: int
+
+    def __init__(self, fn: StackFunction, num_regs: int, trace_threshold: int = TRACE_THRESHOLD) -> None:
+        self.fn = fn
+        self.num_regs = num_regs
+        self.trace_threshold = trace_threshold
+        self.traces = []
+        self.ir, self.superblocks = self.compile()
+        self.pending = None
+        self.header_counts = dict()
+        self.calls = 0
+        self.spill_count = 0
+        self.restore_count = 0
+        self.move_count = 0
+        self.jump_count = 0
+
+    def compile(self) -> tuple[Ir, int]:
+        ir = import_to_ir(self.fn)
+        superblocks = form_superblocks(ir, self.traces)
+        Rlsra(num_regs=self.num_regs).do_reverse_linear_scan(ir)
+        return ir, superblocks
+
+    def call(self, args: list[int] = []) -> int:
+        if self.pending != None:
+            self.ir, self.superblocks = self.pending
+            self.pending = None
+            self.header_counts = dict()
+
+        interpreter = Interpreter(num_regs=self.num_regs, ir=self.ir, trace_threshold=self.trace_threshold)
+        interpreter.header_counts = self.header_counts
+        result = interpreter.run(args)
+
+        self.calls += 1
+        self.spill_count += interpreter.spill_count
+        self.restore_count += interpreter.restore_count
+        self.move_count += interpreter.move_count
+        self.jump_count += interpreter.jump_count
+
+        # One trace per header : loops that are superblocks already get recorded again
+        known = set(trace.header() for trace in self.traces)
+        new_traces = []
+        for edges in interpreter.traces:
+            trace = Trace.from_edges(edges)
+            if trace != None and trace.header() not in known:
+                known.add(trace.header())
+                new_traces.append(trace)
+
+        if len(new_traces) != 0:
+            self.traces += new_traces
+            self.pending = self.compile()
+
+        return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the benchmark corpus with Rlsra, with and without superblocks for the hot loops")
+    parser.add_argument("--regs", type=int, nargs="+", default=[2, 3, 4, 6])
+    parser.add_argument("--calls", type=int, default=10, help="calls of every function")
+    parser.add_argument("--threshold", type=int, default=TRACE_THRESHOLD, help="backward jumps to a loop header before recording a trace")
+    parser.add_argument("--generated", type=int, default=40, help="number of generated programs in the corpus")
+    args = parser.parse_args()
+
+    corpus = benchmark_corpus(args.generated)
+
+    for num_regs in args.regs:
+        print(f"{num_regs} registers :")
+        # A threshold nothing reaches : plain Rlsra
+        for name, threshold in [("rlsra", 1 << 62), ("rlsra superblocks", args.threshold)]:
+            spills = restores = moves = jumps = superblocks = 0
+            for program in corpus:
+                expected = StackInterpreter(program.fn).run(program.args)
+                function = TracingFunction(program.fn, num_regs, threshold)
+                for _ in range(args.calls):
+                    result = function.call(program.args)
+                    assert result == expected, f"{program.name} : returned {result} instead of {expected} with {function.superblocks} superblocks"
+
+                spills += function.spill_count
+                restores += function.restore_count
+                moves += function.move_count
+                jumps += function.jump_count
+                superblocks += function.superblocks if function.pending == None else function.pending[1]
+
+            print(f"  {name:<20} spills {spills:>8} restores {restores:>8} moves {moves:>8} jumps {jumps:>8} superblocks {superblocks:>4}")
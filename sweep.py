@@ -0,0 +1,177 @@
+from __future__ import annotations
+import argparse
+import dataclasses
+import gc
+import multiprocessing
+import time
+from stack_instruction import *
+from fuzz import ALLOCATORS, UNCONSTRAINED_ALLOCATORS, allocate, prepare
+from rlsra import RecordPool
+from resolution import edge_resolution
+from corpus import *
+from spill_strategy import SPILL_STRATEGIES, FurthestUse
+
+# Register budget sweep : allocates the same function for a list of register counts, to find out how many registers it
+# needs. The function is imported once, with its liveness, indices and the passes of the allocator variant (see
+# fuzz.prepare), and the ir is allocated again for every budget after forgetting the previous allocation
+# (Ir.clear_allocation). The annotations of a budget are released into a RecordPool and reused by the next one.
+# With several jobs, the budgets are shared between worker processes, each of them importing the function once.
+# The counts are static (the spill code of the function, edges included) : they don't depend on the arguments.
+# Some of the traffic doesn't depend on the budget : the arguments are restored from memory where they're first read,
+# Rlsra stores some locals through to memory, edges restore values the allocators leave in memory... and is there with
+# any number of registers, so a zero count is rarely reached (only by coloring). The result is the saturation point
+# instead : the smallest budget from which more registers don't remove any spill or restore, the ones left being the
+# traffic that doesn't depend on the budget.
+
+@dataclasses.dataclass
+class SweepRow:
+    num_regs: int
+    spills: int
+    restores: int
+    moves: int
+
+    def spill_free(self) -> bool:
+        return self.spills == 0 and self.restores == 0
+
+    def traffic(self) -> int:
+        return self.spills + self.restores
+
+@dataclasses.dataclass
+class SweepResult:
+    rows: list[SweepRow]
+    # Smallest register count from which the larger budgets don't have fewer spills and restores, None if the largest
+    # budget still has fewer than the one before it (the function could use more registers than swept)
+    saturation: int | None
+    # Spills and restores left at the saturation point
+    saturation_traffic: int
+    # Smallest register count allocated without any spill or restore, None if every budget has some
+    min_spill_free: int | None
+
+def saturation_point(rows: list[SweepRow]) -> SweepRow | None:
+    if len(rows) == 0:
+        return None
+    least = min(row.traffic() for row in rows)
+    row = next(row for row in rows if row.traffic() == least)
+    if row is rows[-1] and len(rows) > 1 and rows[-2].traffic() > least:
+        return None
+    return row
+
+# Annotations of the trees, and the ones Interpreter.jump (or resolution.resolve_edges) adds on the edges
+def count_annotations(ir: Ir, num_regs: int) -> SweepRow:
+    row = SweepRow(num_regs=num_regs, spills=0, restores=0, moves=0)
+    for block in ir.block_execution_order():
+        if block.active_in_set is None:
+            # Never reached by the allocator
+            continue
+
+        for tree in block.tree_execution_order():
+            row.spills += len(tree.pre_spills) + len(tree.post_spills)
+            row.restores += len(tree.pre_restores) + len(tree.post_restores)
+            row.moves += len(tree.pre_moves) + len(tree.post_moves)
+
+        for edge in block.outgoing_edges():
+            active_out_set = edge.active_out_set if edge.active_out_set is not None else block.active_out_set
+            spills, restores, moves = edge_resolution(active_out_set, edge.target.active_in_set)
+            row.spills += len(spills)
+            row.restores += len(restores)
+            row.moves += len(moves)
+
+    return row
+
+# Imports and allocates the function for a single budget, what sweep_budgets saves
+def allocate_budget(fn: StackFunction, num_regs: int, allocator: str = "rlsra", spill_strategy: str = FurthestUse.name, calls: bool = False) -> SweepRow:
+    convention = CallingConvention.default(num_regs) if calls and allocator not in UNCONSTRAINED_ALLOCATORS else None
+    ir = import_to_ir(fn)
+    allocate(ir, allocator, num_regs, spill_strategy, convention)
+    return count_annotations(ir, num_regs)
+
+def sweep_budgets(fn: StackFunction, budgets: list[int], allocator: str = "rlsra", spill_strategy: str = FurthestUse.name, calls: bool = False) -> list[SweepRow]:
+    ir = import_to_ir(fn)
+    prepare(ir, allocator)
+    # The two-address allocators swap commutative BinOps : every budget starts from the operands of the import
+    binops = [(tree, tree.operands[1:]) for tree in ir.tree_execution_order() if tree.kind == TreeKind.BinOp]
+    # Only Rlsra and Lsra take their records from a pool
+    pool = RecordPool() if allocator not in UNCONSTRAINED_ALLOCATORS else None
+
+    rows = []
+    for i, num_regs in enumerate(budgets):
+        if i != 0:
+            if pool is not None:
+                pool.release(ir)
+            ir.clear_allocation()
+            for tree, swapped in binops:
+                tree.operands[1:] = swapped
+
+        convention = CallingConvention.default(num_regs) if calls and allocator not in UNCONSTRAINED_ALLOCATORS else None
+        allocate(ir, allocator, num_regs, spill_strategy, convention, pool, prepared=True)
+        rows.append(count_annotations(ir, num_regs))
+
+    return rows
+
+def _sweep_budgets_star(args: tuple[StackFunction, list[int], str, str, bool]) -> list[SweepRow]:
+    return sweep_budgets(*args)
+
+# jobs : worker processes, 1 to allocate every budget in this process
+def sweep(fn: StackFunction, budgets: list[int], allocator: str = "rlsra", spill_strategy: str = FurthestUse.name, calls: bool = False, jobs: int = 1) -> SweepResult:
+    budgets = sorted(set(budgets))
+
+    if jobs == 1 or len(budgets) == 1:
+        rows = sweep_budgets(fn, budgets, allocator, spill_strategy, calls)
+    else:
+        # Small budgets take longer to allocate (more spills), every worker gets some of them
+        work = [(fn, budgets[i::jobs], allocator, spill_strategy, calls) for i in range(min(jobs, len(budgets)))]
+        with multiprocessing.Pool(processes=len(work)) as pool:
+            rows = sorted((row for rows in pool.map(_sweep_budgets_star, work) for row in rows), key=lambda row: row.num_regs)
+
+    min_spill_free = next((row.num_regs for row in rows if row.spill_free()), None)
+    saturation = saturation_point(rows)
+    return SweepResult(
+        rows=rows,
+        saturation=saturation.num_regs if saturation != None else None,
+        saturation_traffic=saturation.traffic() if saturation != None else rows[-1].traffic(),
+        min_spill_free=min_spill_free
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Allocates the benchmark corpus for a range of register counts and shows the smallest one from which every program stops spilling less")
+    parser.add_argument("--allocator", choices=ALLOCATORS, default="rlsra")
+    parser.add_argument("--strategy", choices=SPILL_STRATEGIES.keys(), default=FurthestUse.name, help="spill heuristic used by the allocator")
+    parser.add_argument("--regs", type=int, nargs="+", default=list(range(2, 33)), help="register budgets")
+    parser.add_argument("--generated", type=int, default=40, help="number of generated programs in the corpus")
+    parser.add_argument("--calls", action="store_true", help="use generated programs with calls, allocated with the default calling convention")
+    parser.add_argument("--program", help="only sweep this program, showing the counts of every budget")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes sharing the budgets of every program")
+    parser.add_argument("--compare", action="store_true", help="also import the programs again for every budget, and compare the times")
+    args = parser.parse_args()
+
+    corpus = generated_programs(args.generated, calls=True) if args.calls else benchmark_corpus(args.generated)
+    if args.program != None:
+        corpus = [program for program in corpus if program.name == args.program]
+        if len(corpus) == 0:
+            parser.error(f"unknown program {args.program}")
+
+    sweep_seconds = baseline_seconds = 0.0
+    for program in corpus:
+        gc.collect()
+        start = time.perf_counter()
+        result = sweep(program.fn, args.regs, args.allocator, args.strategy, args.calls, args.jobs)
+        sweep_seconds += time.perf_counter() - start
+
+        if args.compare:
+            start = time.perf_counter()
+            baseline = [allocate_budget(program.fn, num_regs, args.allocator, args.strategy, args.calls) for num_regs in sorted(set(args.regs))]
+            baseline_seconds += time.perf_counter() - start
+            assert baseline == result.rows, f"{program.name} : the sweep doesn't allocate like a new import"
+
+        largest = result.rows[-1].num_regs
+        if result.saturation == None:
+            saturation = f"still spilling less at {largest} registers ({result.saturation_traffic} spills / restores left)"
+        else:
+            saturation = f"no fewer spills / restores from {result.saturation} registers ({result.saturation_traffic} left)"
+        spill_free = f"spill free from {result.min_spill_free} registers" if result.min_spill_free != None else f"not spill free up to {largest} registers"
+        print(f"{program.name:<20} {saturation}, {spill_free}")
+        if args.program != None:
+            for row in result.rows:
+                print(f"  {row.num_regs:>3} registers : spills {row.spills:>6} restores {row.restores:>6} moves {row.moves:>6}")
+
+    print(f"sweep {1000 * sweep_seconds:.1f} ms" + (f", importing for every budget {1000 * baseline_seconds:.1f} ms" if args.compare else ""))
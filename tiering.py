@@ -0,0 +1,189 @@
+from __future__ import annotations
+import argparse
+import dataclasses
+import time
+from stack_instruction import *
+from stack_interpreter import StackInterpreter
+from interpreter import Interpreter
+from fuzz import ALLOCATORS, allocate
+from corpus import *
+from spill_strategy import SPILL_STRATEGIES, FurthestUse
+
+# Tiered allocation, like a JIT : every function starts with the cheapest allocation, runs with a profiling interpreter,
+# and gets allocated again with a more expensive allocator once it's hot enough. The new allocation is swapped in at the
+# next entry of the function (no on stack replacement : a call that's already running finishes with the old one).
+# Hotness is the number of entries of the function plus the number of loop iterations (jumps going backwards). The block
+# entries are given to the next tiers through BasicBlock.profile_count, so that their frequency weighted heuristics use
+# measured frequencies instead of the loop depth estimate.
+
+@dataclasses.dataclass
+class Tier:
+    allocator: str
+    spill_strategy: str = FurthestUse.name
+    # Hotness the function needs before getting allocated with this tier
+    threshold: int = 0
+
+    def __str__(self) -> str:
+        return f"{self.allocator} ({self.spill_strategy})"
+
+# The frequency weighted linear scans (ex : "rlsra:weighted-cost@200") also work as an upper tier, but the interval scan
+# already spills less than them on the benchmark corpus
+DEFAULT_TIERS = [
+    Tier("interval"),
+    Tier("coloring", threshold=200),
+]
+
+@dataclasses.dataclass
+class Profile:
+    entries: int = 0
+    back_edges: int = 0
+    # Block entries, by block il_idx (the same for every import of the function)
+    blocks: dict[int, int] = dataclasses.field(default_factory=dict)
+
+    def hotness(self) -> int:
+        return self.entries + self.back_edges
+
+    def record(self, ir: Ir, interpreter: Interpreter) -> None:
+        self.entries += 1
+        self.back_edges += interpreter.back_edge_count
+
+        # Blocks inserted on edges share the il_idx of their target : only the target is counted
+        counts: dict[int, int] = dict()
+        for block in ir.block_execution_order():
+            count = interpreter.block_entries.get(id(block), 0)
+            counts[block.il_idx] = max(counts.get(block.il_idx, 0), count)
+        for il_idx, count in counts.items():
+            self.blocks[il_idx] = self.blocks.get(il_idx, 0) + count
+
+def apply_profile(ir: Ir, profile: Profile) -> None:
+    for block in ir.block_execution_order():
+        block.profile_count = profile.blocks.get(block.il_idx, 0)
+
+@dataclasses.dataclass
+class Compilation:
+    tier: int
+    # Number of calls done before the compilation
+    calls: int
+    seconds: float
+
+class TieredFunction:
+    fn: StackFunction
+    num_regs: int
+    tiers: list[Tier]
+
+    tier: int
+    ir: Ir
+    # Allocated by a higher tier, waiting for the next entry
+    pending: tuple[int, Ir] | None
+    profile: Profile
+    compilations: list[Compilation]
+
+    # Statistics of all the calls
+    calls: int
+    spill_count: int
+    restore_count: int
+    move_count: int
+
+    def __init__(self, fn: StackFunction, num_regs: int, tiers: list[Tier] = DEFAULT_TIERS) -> None:
+        assert len(tiers) != 0 and tiers[0].threshold == 0, "the first tier must be used right away"
+        self.fn = fn
+        self.num_regs = num_regs
+        self.tiers = tiers
+        self.pending = None
+        self.profile = Profile()
+        self.compilations = []
+        self.calls = 0
+        self.spill_count = 0
+        self.restore_count = 0
+        self.move_count = 0
+
+        self.tier = 0
+        self.ir = self.compile(0)
+
+    def compile(self, tier: int) -> Ir:
+        start = time.perf_counter()
+        ir = import_to_ir(self.fn)
+        if tier != 0:
+            apply_profile(ir, self.profile)
+        allocate(ir, self.tiers[tier].allocator, self.num_regs, self.tiers[tier].spill_strategy)
+        self.compilations.append(Compilation(tier=tier, calls=self.calls, seconds=time.perf_counter() - start))
+        return ir
+
+    # Highest tier the current hotness allows
+    def target_tier(self) -> int:
+        tier = self.tier
+        while tier + 1 < len(self.tiers) and self.profile.hotness() >= self.tiers[tier + 1].threshold:
+            tier += 1
+        return tier
+
+    def call(self, args: list[int] = []) -> int:
+        if self.pending != None:
+            self.tier, self.ir = self.pending
+            self.pending = None
+
+        # The last tier doesn't need a profile anymore
+        profiling = self.tier + 1 < len(self.tiers)
+        interpreter = Interpreter(num_regs=self.num_regs, ir=self.ir, profile=profiling)
+        result = interpreter.run(args)
+
+        self.calls += 1
+        self.spill_count += interpreter.spill_count
+        self.restore_count += interpreter.restore_count
+        self.move_count += interpreter.move_count
+
+        if profiling:
+            self.profile.record(self.ir, interpreter)
+            tier = self.target_tier()
+            if tier != self.tier:
+                self.pending = (tier, self.compile(tier))
+
+        return result
+
+def parse_tier(text: str) -> Tier:
+    # allocator[:strategy]@threshold
+    allocator, _, threshold = text.partition("@")
+    allocator, _, strategy = allocator.partition(":")
+    if allocator not in ALLOCATORS:
+        raise argparse.ArgumentTypeError(f"unknown allocator {allocator}")
+    if strategy != "" and strategy not in SPILL_STRATEGIES:
+        raise argparse.ArgumentTypeError(f"unknown spill strategy {strategy}")
+    return Tier(allocator, strategy or FurthestUse.name, int(threshold or 0))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the benchmark corpus through tiered allocation and compares it with allocating every function with a single tier")
+    parser.add_argument("--regs", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--calls", type=int, default=50, help="calls of every function")
+    parser.add_argument("--generated", type=int, default=40, help="number of generated programs in the corpus")
+    parser.add_argument("--tier", type=parse_tier, action="append", metavar="ALLOCATOR[:STRATEGY]@THRESHOLD", help="can be repeated, defaults to " + ", ".join(f"{tier.allocator}:{tier.spill_strategy}@{tier.threshold}" for tier in DEFAULT_TIERS))
+    args = parser.parse_args()
+
+    tiers = args.tier or DEFAULT_TIERS
+    corpus = benchmark_corpus(args.generated)
+
+    for num_regs in args.regs:
+        print(f"{num_regs} registers :")
+        configurations = [("tiered", tiers)] + [(str(tier), [Tier(tier.allocator, tier.spill_strategy)]) for tier in tiers]
+        for name, configuration in configurations:
+            spills = restores = moves = 0
+            first_compile = compile_seconds = 0.0
+            promoted = 0
+            for program in corpus:
+                expected = StackInterpreter(program.fn).run(program.args)
+                function = TieredFunction(program.fn, num_regs, configuration)
+                for _ in range(args.calls):
+                    result = function.call(program.args)
+                    assert result == expected, f"{program.name} : tier {function.tier} returned {result} instead of {expected}"
+
+                spills += function.spill_count
+                restores += function.restore_count
+                moves += function.move_count
+                first_compile += function.compilations[0].seconds
+                compile_seconds += sum(compilation.seconds for compilation in function.compilations)
+                if function.tier != 0 or function.pending != None:
+                    promoted += 1
+
+            print(
+                f"  {name:<28} spills {spills:>8} restores {restores:>8} moves {moves:>8}" +
+                f" first compile {1000 * first_compile:>7.1f} ms total compile {1000 * compile_seconds:>7.1f} ms" +
+                (f" promoted {promoted}/{len(corpus)}" if len(configuration) > 1 else "")
+            )